@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the application served by the benchmarks, the backend of main.py with Bedrock
+and Redis replaced by their offline stand-ins. Configured through environment variables:
+    BENCH_TTFT, BENCH_TOKENS_PER_SECOND, BENCH_REPLY_TOKENS, BENCH_ERROR_RATE: the fake chat model
+    BENCH_SLOW_RATE, BENCH_SLOW_TTFT: share and time to first token of the slow calls of the fake chat model
+    BENCH_PREFILL_TPS: input tokens read per second by the fake chat model outside its prompt cache, 0 for instant
+    BENCH_ENDPOINTS: number of fake endpoints of the primary model, hedged and failed over when above 1
+    BENCH_REDIS: 'memory' for an in-process fakeredis (default), or host:port of a Redis server
+Serve it from the project root, e.g. `uvicorn benchmarks.bench_app:app --workers 2`.
+"""
+import logging
+import os
+from pathlib import Path
+from typing import Union
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import BaseChatModel
+# project imports
+import main
+from benchmarks.fakes import FakeBedrockChatModel, FakeRedisPool
+from src.chat_engines import Converse_Bedrock
+from src.resilience import ResilientChatModel
+from src.utils.proj_paths import *
+from src.utils.redis_pool import RedisPool
+from src.utils.utils import get_service_config
+
+
+def fake_chat_model() -> FakeBedrockChatModel:
+    return FakeBedrockChatModel(
+        ttft=float(os.environ.get("BENCH_TTFT", 0.3)),
+        tokens_per_second=float(os.environ.get("BENCH_TOKENS_PER_SECOND", 60)),
+        reply_tokens=int(os.environ.get("BENCH_REPLY_TOKENS", 120)),
+        error_rate=float(os.environ.get("BENCH_ERROR_RATE", 0.0)),
+        slow_rate=float(os.environ.get("BENCH_SLOW_RATE", 0.0)),
+        slow_ttft=float(os.environ.get("BENCH_SLOW_TTFT", 5.0)),
+        prefill_tokens_per_second=float(os.environ.get("BENCH_PREFILL_TPS", 0.0)),
+    )
+
+def primary_chat_model(config_path: Union[str, Path] = BACKEND_CONFIG) -> BaseChatModel:
+    """The fake primary model, behind the resilience layer of 'model_endpoints' when BENCH_ENDPOINTS is above 1."""
+    _count = int(os.environ.get("BENCH_ENDPOINTS", 1))
+    if _count == 1:
+        return fake_chat_model()
+    _endpoints = [fake_chat_model() for _ in range(_count)]
+    return ResilientChatModel.from_config(
+        get_service_config(config_path, 'model_endpoints'), endpoints=_endpoints, endpoint_names=[f"fake-{i}" for i in range(_count)]
+    )
+
+def redis_pool(config_path: Union[str, Path] = BACKEND_CONFIG):
+    _target = os.environ.get("BENCH_REDIS", "memory")
+    if _target == "memory":
+        return FakeRedisPool()
+    _host, _port = _target.rsplit(":", 1)
+    return RedisPool({**get_service_config(config_path, 'redis'), 'host': _host, 'port': int(_port), 'db': 0})
+
+def initialize_converse_engine(logger: logging.Logger, config_path: Union[str, Path] = BACKEND_CONFIG) -> Converse_Bedrock:
+    return Converse_Bedrock(
+        logger=logger,
+        config_path=config_path,
+        llm=primary_chat_model(config_path),
+        tier_llms={_tier: fake_chat_model() for _tier in get_service_config(config_path, 'model_router')['tiers']},
+        summary_llm=fake_chat_model(),
+        redis_pool=redis_pool(config_path),
+        embeddings=DeterministicFakeEmbedding(size=1024),
+    )
+
+
+# the lifespan of main.py builds the engine through this hook
+main.initialize_converse_engine = initialize_converse_engine
+app = main.app
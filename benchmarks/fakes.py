@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the offline stand-ins of Bedrock and Redis used by the benchmarks
+"""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+from botocore.exceptions import ClientError
+import fakeredis
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+# project imports
+from src.prompt_cache import is_cache_point
+
+
+_VOCABULARY = (
+    "Renke works on machine learning systems and large language model applications, he studied "
+    "computer science and enjoys building reliable backend services, data pipelines and research "
+    "prototypes that turn ideas into products used by real people every day"
+).split()
+
+
+class FakeBedrockChatModel(BaseChatModel):
+    """
+    Chat model replying with generated text at the pace of a Bedrock model, without calling AWS.
+    The async path sleeps on the event loop instead of holding an executor thread, so that the
+    benchmark measures the service rather than the thread pool of the stand-in.
+
+    Attributes:
+        model_id (str): Reported like the model id of ChatBedrockConverse
+        ttft (float): Seconds before the first token
+        tokens_per_second (float): Generation speed after the first token
+        reply_tokens (int): Mean length of a reply in tokens, each reply varies by +-25%
+        error_rate (float): Share of calls failing with a Bedrock ThrottlingException
+        slow_rate (float): Share of calls waiting `slow_ttft` seconds before the first token, the latency tail
+        slow_ttft (float): Seconds before the first token of the slow calls
+        prefill_tokens_per_second (float): Speed of reading the input tokens not found in the prompt cache,
+            added to the time to first token, 0 to read the input instantly
+        cache_points (list): Indexes of the messages carrying a cache point, for each call
+    """
+    model_id: str = "fake-bedrock"
+    ttft: float = 0.3
+    tokens_per_second: float = 60.0
+    reply_tokens: int = 120
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_ttft: float = 5.0
+    prefill_tokens_per_second: float = 0.0
+    # prompt cache of the stand-in, hash of a marked prefix -> its length in tokens
+    _prompt_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _cache_points: List[List[int]] = PrivateAttr(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-bedrock"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self._maybe_fail()
+        usage = self._input_usage(messages)
+        tokens = self._reply(kwargs.get("max_tokens"))
+        time.sleep(self._ttft(usage) + len(tokens) / self.tokens_per_second)
+        return self._result(usage, tokens)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        self._maybe_fail()
+        usage = self._input_usage(messages)
+        tokens = self._reply(kwargs.get("max_tokens"))
+        await asyncio.sleep(self._ttft(usage) + len(tokens) / self.tokens_per_second)
+        return self._result(usage, tokens)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        self._maybe_fail()
+        usage = self._input_usage(messages)
+        time.sleep(self._ttft(usage))
+        tokens = self._reply(kwargs.get("max_tokens"))
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(usage, tokens)))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        self._maybe_fail()
+        usage = self._input_usage(messages)
+        await asyncio.sleep(self._ttft(usage))
+        tokens = self._reply(kwargs.get("max_tokens"))
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(usage, tokens)))
+
+    def _maybe_fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "Too many requests, please wait before trying again."}},
+                "ConverseStream",
+            )
+
+    @property
+    def cache_points(self) -> List[List[int]]:
+        return self._cache_points
+
+    def _ttft(self, usage: Optional[dict] = None) -> float:
+        _ttft = self.slow_ttft if self.slow_rate and random.random() < self.slow_rate else self.ttft
+        if usage and self.prefill_tokens_per_second:
+            _ttft += (usage["input_tokens"] + usage["cache_creation"]) / self.prefill_tokens_per_second
+        return _ttft
+
+    def _input_usage(self, messages: List[BaseMessage]) -> dict:
+        """
+        Input tokens split like Bedrock: at the last cache point, the longest prefix cached by an earlier
+        call (ending at any message) is read, the tokens from there to the cache point are written, and
+        the ones after it are uncached.
+        """
+        _hash = hashlib.sha256()
+        _prefixes: List[tuple] = [] # (hash, tokens) of the prefix ending at each message
+        _tokens, _points = 0, []
+        for i, _message in enumerate(messages):
+            # about 4 characters per token, like the history policy
+            _tokens += len(_message.text()) // 4
+            _hash.update(_message.text().encode())
+            _prefixes.append((_hash.hexdigest(), _tokens))
+            if isinstance(_message.content, list) and any(is_cache_point(b) for b in _message.content):
+                _points.append(i)
+        self._cache_points.append(_points)
+        if not _points:
+            return {"input_tokens": _tokens, "cache_read": 0, "cache_creation": 0}
+        _read = next((n for h, n in reversed(_prefixes[:_points[-1] + 1]) if h in self._prompt_cache), 0)
+        _marked = _prefixes[_points[-1]][1]
+        for i in _points:
+            self._prompt_cache[_prefixes[i][0]] = _prefixes[i][1]
+            self._prompt_cache.move_to_end(_prefixes[i][0])
+        while len(self._prompt_cache) > 10000:
+            self._prompt_cache.popitem(last=False)
+        return {"input_tokens": _tokens - _marked, "cache_read": _read, "cache_creation": _marked - _read}
+
+    def _reply(self, max_tokens: Optional[int] = None) -> List[str]:
+        _length = max(1, round(self.reply_tokens * random.uniform(0.75, 1.25)))
+        if max_tokens:
+            _length = min(_length, max_tokens)
+        return [random.choice(_VOCABULARY) + " " for _ in range(_length)]
+
+    def _result(self, usage: dict, tokens: List[str]) -> ChatResult:
+        _message = AIMessage(content="".join(tokens), usage_metadata=self._usage(usage, tokens))
+        return ChatResult(generations=[ChatGeneration(message=_message)])
+
+    @staticmethod
+    def _usage(usage: dict, tokens: List[str]) -> dict:
+        _input = usage["input_tokens"] + usage["cache_read"] + usage["cache_creation"]
+        return {
+            "input_tokens": usage["input_tokens"], 
+            "output_tokens": len(tokens), 
+            "total_tokens": _input + len(tokens), 
+            "input_token_details": {"cache_read": usage["cache_read"], "cache_creation": usage["cache_creation"]},
+        }
+
+
+class FakeRedisPool():
+    """
+    In-memory stand-in of RedisPool, every pool created on the same server shares its data.
+    Only shared within one process, several workers share a TcpFakeServer through RedisPool instead.
+
+    Attributes:
+        client (fakeredis.FakeRedis): Blocking client
+        async_client (fakeredis.FakeAsyncRedis): Asyncio client
+    """
+    def __init__(self, server: Optional[fakeredis.FakeServer] = None):
+        self.server = server or fakeredis.FakeServer()
+        self.client = fakeredis.FakeRedis(server=self.server)
+        self.async_client = fakeredis.FakeAsyncRedis(server=self.server)
+
+    def ping(self) -> bool:
+        return self.client.ping()
+
+    async def aping(self) -> bool:
+        return await self.async_client.ping()
+
+    async def aclose(self):
+        await self.async_client.aclose()
+        self.client.close()
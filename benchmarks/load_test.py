@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the load test driver of the chat service. Concurrent multi-turn sessions are
+fired at the chat endpoints, and the throughput, latency percentiles, time to first token and memory
+per worker are written to a JSON file, optionally compared against the results of a previous run.
+
+Usage, from the project root:
+    # serve benchmarks.bench_app (fake Bedrock and Redis) and load it
+    python -m benchmarks.load_test --spawn --workers 2 --sessions 64 --turns 4 --ttft 0.3
+    # load a running deployment, fail if p95 latency or throughput regressed by more than 10%
+    python -m benchmarks.load_test --url http://127.0.0.1:8080 --baseline benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from datetime import datetime as dt
+import json
+import os
+from pathlib import Path
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+import uuid
+import httpx
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS = ROOT/'benchmarks'/'results'
+ENDPOINTS = ("simple_chat", "stream_chat", "rag_chat", "rag_stream_chat", "ws_chat")
+
+_TOPICS = (
+    "your education", "your work experience", "the projects you built", "your research interests",
+    "the programming languages you use", "your experience with large language models",
+    "the teams you worked with", "your hobbies", "your publications", "the tools you prefer",
+)
+_OPENERS = (
+    "Hi, could you tell me about {topic}?",
+    "What can you share about {topic}?",
+    "I'm a recruiter looking for a backend engineer, can you walk me through {topic}?",
+    "Tell me more about {topic}, in particular anything related to {other}.",
+)
+_FOLLOW_UPS = (
+    "Interesting, can you elaborate?",
+    "How does that relate to {topic}?",
+    "What was the hardest part?",
+    "Can you give a concrete example of that, with the technologies involved and the results?",
+    "Thanks. Switching topics, what about {topic}?",
+)
+_FILLER = (
+    "We are hiring for a role that involves distributed systems, cloud infrastructure and applied "
+    "machine learning, and the team cares a lot about code quality, testing and ownership of services "
+    "in production, so I would like to understand how your background fits."
+).split()
+
+
+class QueryGenerator():
+    """
+    Queries with the length distribution of real users: mostly one sentence, with a long tail of
+    detailed questions. A share of the first turns repeats a common question, as returning visitors do.
+    """
+    def __init__(self, rng: random.Random, repeat_ratio: float):
+        self.rng = rng
+        self.repeat_ratio = repeat_ratio
+
+    def first(self) -> str:
+        if self.rng.random() < self.repeat_ratio:
+            return _OPENERS[0].format(topic=_TOPICS[0])
+        _opener = self.rng.choice(_OPENERS).format(topic=self.rng.choice(_TOPICS), other=self.rng.choice(_TOPICS))
+        return self._pad(_opener)
+
+    def follow_up(self) -> str:
+        return self._pad(self.rng.choice(_FOLLOW_UPS).format(topic=self.rng.choice(_TOPICS)))
+
+    def _pad(self, query: str) -> str:
+        # log-normal number of extra words, median ~3, capped
+        _extra = min(len(_FILLER), int(self.rng.lognormvariate(1.1, 1.2)))
+        return query if _extra < 3 else f"{query} {' '.join(_FILLER[:_extra])}"
+
+
+@dataclass
+class Sample():
+    """Outcome of one chat turn."""
+    endpoint: str
+    start: float
+    latency: float
+    ttft: Optional[float]
+    status: int
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200 and self.error is None
+
+
+# =========================================================================================================
+# Chat turns
+# =========================================================================================================
+async def simple_turn(client: httpx.AsyncClient, endpoint: str, query: str, session_id: Optional[str]) -> tuple:
+    _start = time.perf_counter()
+    try:
+        _res = await client.post(f"/{endpoint}", json={"query": query, "session_id": session_id})
+    except httpx.HTTPError as e:
+        return Sample(endpoint, _start, time.perf_counter() - _start, None, 0, type(e).__name__), session_id
+    _latency = time.perf_counter() - _start
+    if _res.status_code != 200:
+        return Sample(endpoint, _start, _latency, None, _res.status_code, _res.text[:200]), session_id
+    # the whole reply arrives at once, the first token is the last
+    return Sample(endpoint, _start, _latency, _latency, 200), _res.json()["session_id"]
+
+async def stream_turn(client: httpx.AsyncClient, endpoint: str, query: str, session_id: Optional[str]) -> tuple:
+    _start = time.perf_counter()
+    _ttft, _error, _event = None, None, None
+    try:
+        async with client.stream("POST", f"/{endpoint}", json={"query": query, "session_id": session_id}) as _res:
+            if _res.status_code != 200:
+                await _res.aread()
+                return Sample(endpoint, _start, time.perf_counter() - _start, None, _res.status_code, _res.text[:200]), session_id
+            async for _line in _res.aiter_lines():
+                if _line.startswith("event: "):
+                    _event = _line[7:]
+                elif _line.startswith("data: "):
+                    _data = json.loads(_line[6:])
+                    session_id = _data.get("session_id") or session_id
+                    if _event == "token" and _ttft is None:
+                        _ttft = time.perf_counter() - _start
+                    elif _event == "error":
+                        _error = _data.get("content") or "error"
+    except httpx.HTTPError as e:
+        return Sample(endpoint, _start, time.perf_counter() - _start, _ttft, 0, type(e).__name__), session_id
+    return Sample(endpoint, _start, time.perf_counter() - _start, _ttft, 200, _error), session_id
+
+async def ws_turn(websocket, query: str, session_id: Optional[str]) -> tuple:
+    _start = time.perf_counter()
+    _ttft = None
+    try:
+        await websocket.send(json.dumps({"query": query, "session_id": session_id}))
+        while True:
+            _data = json.loads(await websocket.recv())
+            session_id = _data.get("session_id") or session_id
+            if _data["event"] == "token" and _ttft is None:
+                _ttft = time.perf_counter() - _start
+            elif _data["event"] == "end":
+                return Sample("ws_chat", _start, time.perf_counter() - _start, _ttft, 200), session_id
+            elif _data["event"] in ("error", "cancelled"):
+                return Sample("ws_chat", _start, time.perf_counter() - _start, _ttft, 200, _data.get("content") or _data["event"]), session_id
+    except Exception as e:
+        return Sample("ws_chat", _start, time.perf_counter() - _start, _ttft, 0, type(e).__name__), session_id
+
+
+async def run_session(base_url: str, endpoint: str, turns: int, think_time: float, queries: QueryGenerator, samples: List[Sample]):
+    """One user: a first question followed by follow-ups on the same session, over one connection."""
+    session_id = None
+    if endpoint == "ws_chat":
+        import websockets
+        async with websockets.connect(base_url.replace("http", "ws", 1) + "/ws/chat", max_size=None) as _ws:
+            for _turn in range(turns):
+                _sample, session_id = await ws_turn(_ws, queries.first() if _turn == 0 else queries.follow_up(), session_id)
+                samples.append(_sample)
+                await asyncio.sleep(think_time * queries.rng.uniform(0.5, 1.5))
+        return
+    _turn_fn = stream_turn if endpoint.endswith("stream_chat") else simple_turn
+    async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(120.0), limits=httpx.Limits(max_connections=1)) as client:
+        for _turn in range(turns):
+            _sample, session_id = await _turn_fn(client, endpoint, queries.first() if _turn == 0 else queries.follow_up(), session_id)
+            samples.append(_sample)
+            # a failed first turn leaves the session without history, start over
+            if not _sample.ok and _turn == 0:
+                session_id = None
+            await asyncio.sleep(think_time * queries.rng.uniform(0.5, 1.5))
+
+async def run_load(args, endpoint: str) -> tuple:
+    """Fires `sessions` concurrent sessions at the endpoint, starting them over the ramp-up period."""
+    samples: List[Sample] = []
+    rng = random.Random(args.seed)
+    async def _delayed(i: int):
+        await asyncio.sleep(args.ramp_up * i / max(1, args.sessions))
+        await run_session(args.url, endpoint, args.turns, args.think_time, QueryGenerator(random.Random(rng.random()), args.repeat_ratio), samples)
+    _start = time.perf_counter()
+    await asyncio.gather(*[_delayed(i) for i in range(args.sessions)])
+    return samples, time.perf_counter() - _start
+
+
+# =========================================================================================================
+# Server under test
+# =========================================================================================================
+class MemorySampler():
+    """Samples the resident memory of a process and of its children (the uvicorn workers) from /proc."""
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak: Dict[int, int] = {}
+        self.last: Dict[int, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            for _pid in [self.pid] + self._children(self.pid):
+                _rss = self._rss(_pid)
+                if _rss is not None:
+                    self.last[_pid] = _rss
+                    self.peak[_pid] = max(_rss, self.peak.get(_pid, 0))
+            self._stop.wait(self.interval)
+
+    @staticmethod
+    def _children(pid: int) -> List[int]:
+        try:
+            _children = [int(p) for t in os.listdir(f"/proc/{pid}/task") for p in Path(f"/proc/{pid}/task/{t}/children").read_text().split()]
+            # skip the resource tracker of multiprocessing
+            return [c for c in _children if b"resource_tracker" not in Path(f"/proc/{c}/cmdline").read_bytes()]
+        except OSError:
+            return []
+
+    @staticmethod
+    def _rss(pid: int) -> Optional[int]:
+        try:
+            for _line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if _line.startswith("VmRSS:"):
+                    return int(_line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+    def report(self) -> Dict[str, dict]:
+        # with several workers the first process is the supervisor
+        return {
+            ("supervisor" if _pid == self.pid and len(self.peak) > 1 else "worker") + f"_{_pid}": {
+                "rss_peak_mb": round(self.peak[_pid] / 2**20, 1), "rss_end_mb": round(self.last[_pid] / 2**20, 1)
+            }
+            for _pid in self.peak
+        }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def spawn_server(args) -> Iterator[subprocess.Popen]:
+    """
+    Serves benchmarks.bench_app with the fake chat model. Several workers share a TCP fakeredis
+    started here, unless a Redis server is given with --redis.
+    """
+    _redis_server = None
+    _redis = args.redis
+    if _redis == "memory" and args.workers > 1:
+        import fakeredis
+        _redis_server = fakeredis.TcpFakeServer(("127.0.0.1", _free_port()))
+        threading.Thread(target=_redis_server.serve_forever, daemon=True).start()
+        _redis = "{}:{}".format(*_redis_server.server_address)
+    _port = _free_port()
+    args.url = f"http://127.0.0.1:{_port}"
+    _env = {
+        **os.environ,
+        "BENCH_TTFT": str(args.ttft),
+        "BENCH_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "BENCH_REPLY_TOKENS": str(args.reply_tokens),
+        "BENCH_ERROR_RATE": str(args.error_rate),
+        "BENCH_REDIS": _redis,
+    }
+    _process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.bench_app:app", "--host", "127.0.0.1", "--port", str(_port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=ROOT, env=_env,
+    )
+    try:
+        _wait_ready(args.url, _process, timeout=60)
+        yield _process
+    finally:
+        _process.terminate()
+        try:
+            _process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            _process.kill()
+        if _redis_server is not None:
+            _redis_server.shutdown()
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float):
+    _deadline = time.monotonic() + timeout
+    while time.monotonic() < _deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming ready.")
+        try:
+            if httpx.get(f"{url}/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server not ready after {timeout}s.")
+
+
+# =========================================================================================================
+# Report
+# =========================================================================================================
+def _percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    _p50, _p95, _p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "p50": round(float(_p50), 4), "p95": round(float(_p95), 4), "p99": round(float(_p99), 4),
+        "mean": round(float(np.mean(values)), 4), "max": round(float(np.max(values)), 4),
+    }
+
+def summarize(samples: List[Sample], wall_time: float) -> dict:
+    _ok = [s for s in samples if s.ok]
+    _statuses: Dict[str, int] = {}
+    for s in samples:
+        _key = str(s.status) if s.error is None or s.status != 200 else "stream_error"
+        _statuses[_key] = _statuses.get(_key, 0) + 1
+    return {
+        "requests": len(samples),
+        "succeeded": len(_ok),
+        "error_rate": round(1 - len(_ok) / len(samples), 4) if samples else 0.0,
+        "statuses": _statuses,
+        "wall_time": round(wall_time, 3),
+        "throughput_rps": round(len(_ok) / wall_time, 3) if wall_time else 0.0,
+        "latency": _percentiles([s.latency for s in _ok]),
+        "ttft": _percentiles([s.ttft for s in _ok if s.ttft is not None]),
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of the throughput and the p95 latency/TTFT beyond `tolerance`, relative to the baseline."""
+    regressions = []
+    for endpoint, current in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if previous is None:
+            continue
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{endpoint} throughput {previous['throughput_rps']} -> {current['throughput_rps']} rps")
+        for metric in ("latency", "ttft"):
+            if previous.get(metric) and current.get(metric) and current[metric]["p95"] > previous[metric]["p95"] * (1 + tolerance):
+                regressions.append(f"{endpoint} {metric} p95 {previous[metric]['p95']} -> {current[metric]['p95']} s")
+        if current["error_rate"] > previous["error_rate"] + tolerance:
+            regressions.append(f"{endpoint} error rate {previous['error_rate']} -> {current['error_rate']}")
+    return regressions
+
+def print_report(results: dict):
+    print(f"\n{'endpoint':<12} {'ok/total':>10} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ttft p50':>9} {'ttft p95':>9}")
+    for endpoint, r in results["endpoints"].items():
+        _lat = r["latency"] or {}
+        _ttft = r["ttft"] or {}
+        print(
+            f"{endpoint:<12} {r['succeeded']:>5}/{r['requests']:<4} {r['throughput_rps']:>8} "
+            f"{_lat.get('p50', '-'):>8} {_lat.get('p95', '-'):>8} {_lat.get('p99', '-'):>8} "
+            f"{_ttft.get('p50', '-'):>9} {_ttft.get('p95', '-'):>9}"
+        )
+        if set(r["statuses"]) != {"200"}:
+            print(f"{'':<12} statuses: {r['statuses']}")
+    for worker, mem in (results.get("memory") or {}).items():
+        print(f"{worker}: rss peak {mem['rss_peak_mb']} MB, end {mem['rss_end_mb']} MB")
+
+
+# =========================================================================================================
+# Entry point
+# =========================================================================================================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the chat endpoints.")
+    _target = parser.add_argument_group("target")
+    _target.add_argument('--url', default=None, help='Base URL of a running service')
+    _target.add_argument('--spawn', action='store_true', help='Serve benchmarks.bench_app with the fake model')
+    _target.add_argument('--workers', type=int, default=1, help='Workers of the spawned server')
+    _target.add_argument('--redis', default="memory", help="'memory' or host:port of the Redis used by the spawned server")
+    _target.add_argument('--server-pid', type=int, default=None, help='Sample the memory of this process and its workers')
+    _model = parser.add_argument_group("fake model (with --spawn)")
+    _model.add_argument('--ttft', type=float, default=0.3)
+    _model.add_argument('--tokens-per-second', type=float, default=60.0)
+    _model.add_argument('--reply-tokens', type=int, default=120)
+    _model.add_argument('--error-rate', type=float, default=0.0)
+    _load = parser.add_argument_group("load")
+    _load.add_argument('--endpoints', nargs='+', default=["simple_chat", "stream_chat"], choices=ENDPOINTS)
+    _load.add_argument('--sessions', type=int, default=32, help='Concurrent sessions per endpoint')
+    _load.add_argument('--turns', type=int, default=4, help='Turns per session')
+    _load.add_argument('--think-time', type=float, default=0.5, help='Mean pause between the turns of a session')
+    _load.add_argument('--ramp-up', type=float, default=2.0, help='Seconds over which the sessions start')
+    _load.add_argument('--repeat-ratio', type=float, default=0.2, help='Share of first turns repeating a common question')
+    _load.add_argument('--seed', type=int, default=0)
+    _out = parser.add_argument_group("results")
+    _out.add_argument('--output', type=Path, default=None, help='Results file, default benchmarks/results/<timestamp>.json')
+    _out.add_argument('--baseline', type=Path, default=None, help='Results of a previous run to compare against')
+    _out.add_argument('--tolerance', type=float, default=0.1, help='Relative regression allowed against the baseline')
+    args = parser.parse_args(argv)
+    if not args.spawn and not args.url:
+        parser.error("either --url or --spawn is required")
+    return args
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = {
+        "timestamp": dt.now().isoformat(timespec="seconds"),
+        "run_id": uuid.uuid4().hex[:8],
+        "config": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+        "endpoints": {},
+        "memory": None,
+    }
+    with (spawn_server(args) if args.spawn else nullcontext()) as _process:
+        _pid = _process.pid if _process is not None else args.server_pid
+        results["config"]["url"] = args.url
+        with (MemorySampler(_pid) if _pid else nullcontext()) as _memory:
+            for endpoint in args.endpoints:
+                print(f"Loading {endpoint} with {args.sessions} sessions x {args.turns} turns ...")
+                samples, wall_time = asyncio.run(run_load(args, endpoint))
+                results["endpoints"][endpoint] = summarize(samples, wall_time)
+        if _memory is not None:
+            results["memory"] = _memory.report()
+    print_report(results)
+    # save machine readable results
+    output = args.output or RESULTS/f"{dt.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nResults saved to {output}")
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION: {r}")
+        if regressions:
+            return 1
+        print(f"No regression against {args.baseline} (tolerance {args.tolerance:.0%}).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,55 +7,149 @@ FastAPI application to serve simple chat and RAG chat endpoints.
 # Standard imports
 import argparse
 import asyncio
-from contextlib import asynccontextmanager
-from datetime import datetime as dt
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import (
-    APIRouter, BackgroundTasks, FastAPI, HTTPException, 
-    Request, Response, status, WebSocket, WebSocketDisconnect,
-    Query
+    FastAPI, HTTPException, Request, Response, status, 
+    WebSocket, WebSocketDisconnect
     )
-from fastapi.responses import (
-    HTMLResponse, ORJSONResponse, FileResponse, StreamingResponse, 
-    PlainTextResponse, JSONResponse
-    )
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-import json
+from fastapi.responses import StreamingResponse
+import hmac
+import importlib
 import logging
+import math
+import os
 from pathlib import Path
-from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST
 import sys
-from typing import TYPE_CHECKING, Optional, List, Dict, Union 
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union 
 import uuid
 import uvicorn
 # project imports
 from src.api_models import *
-from src.chat_engines import Converse_Bedrock
-from src.utils.loggers import setup_logging
+from src.rate_limiter import Bucket, Decision, RateLimiter, RateLimitMiddleware, client_id
+from src.scheduler import ChatScheduler
+from src.session_cache import SessionAffinityMiddleware
+from src.utils.diagnostics import InstrumentedThreadPoolExecutor, LoopMonitor, SamplingProfiler, debug_token
+from src.utils.exceptions import InvalidRequestError, TooManyRequestsError, UserAuthenticationError
+from src.utils.lifecycle import WORKERS_VAR, ServiceLifecycle, resolve_workers
+from src.utils.loggers import LOG_PER_PROCESS_VAR, setup_logging
+from src.utils.metrics import (
+    ERRORS, INFLIGHT_REQUESTS, REQUEST_LATENCY, TimingHeaderMiddleware, 
+    count_request_tokens, mark_worker_dead, render_metrics, setup_multiprocess_metrics
+)
 from src.utils.proj_paths import *
+from src.utils.startup import PROFILE_STARTUP_VAR, STARTUP, process_uptime
 from src.utils.utils import (
     get_service_config, 
     BUDDHA
 )
+if TYPE_CHECKING:
+    from src.chat_engines import Converse_Bedrock
+# interpreter start-up and the imports above, the engine stack is imported in the lifespan
+STARTUP.record("import", process_uptime())
 
 # =========================================================================================================
 # Initialization of web application backend, including chat engine, databases, ect.
 # =========================================================================================================
-setup_logging()
 logger = logging.getLogger("app_logger")
+query_logger = logging.getLogger("query_logger")
+# readiness and graceful drain of this worker
+LIFECYCLE = ServiceLifecycle(logger=logger)
+# one sampling profile at a time per worker
+PROFILE_LOCK = asyncio.Lock()
 
 # executed before the application start up
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global CONVERSE_ENGINE
-    CONVERSE_ENGINE = initialize_converse_engine(logger=logger, config_path=BACKEND_CONFIG)
+    global CONVERSE_ENGINE, SCHEDULER, LOOP_MONITOR
+    _config = get_service_config(BACKEND_CONFIG, 'fastapi')
+    STARTUP.profile = STARTUP.profile or _config.get('profile_startup', False)
+    with STARTUP.phase("logging"):
+        setup_logging()
+    # the engine pulls in langchain and the Bedrock clients, imported here to keep the import of the app light
+    with STARTUP.phase("engine.import"):
+        importlib.import_module("src.chat_engines")
+    with STARTUP.phase("engine.init"):
+        CONVERSE_ENGINE = initialize_converse_engine(logger=logger, config_path=BACKEND_CONFIG)
+    # per-session serialization and admission control in front of the engine
+    SCHEDULER = ChatScheduler(
+        get_service_config(BACKEND_CONFIG, 'scheduler'), 
+        async_redis_client=CONVERSE_ENGINE.async_redis_client, 
+        logger=logger, 
+        workers=int(os.environ.get(WORKERS_VAR, 1))
+    )
+    # shared request and token budgets of the clients, applied by the RateLimitMiddleware
+    _limit_config = get_service_config(BACKEND_CONFIG, 'rate_limit')
+    if _limit_config.get('enabled'):
+        app.state.rate_limiter = RateLimiter(_limit_config, async_redis_client=CONVERSE_ENGINE.async_redis_client, logger=logger)
+    # langchain_aws offloads the blocking boto3 calls to the loop's default executor, 
+    # size it to the engine's in-flight cap instead of the small interpreter default
+    _executor = InstrumentedThreadPoolExecutor(max_workers=CONVERSE_ENGINE.max_inflight, thread_name_prefix="bedrock")
+    asyncio.get_running_loop().set_default_executor(_executor)
+    # event loop lag, stacks of the blocking code and executor utilization
+    LOOP_MONITOR = LoopMonitor(get_service_config(BACKEND_CONFIG, 'diagnostics'), logger=logger, executor=_executor)
+    LOOP_MONITOR.start()
+    # only report ready once the connection pools and the model clients are warm
+    with STARTUP.phase("warmup", profile=False):
+        await CONVERSE_ENGINE.awarmup()
+    LIFECYCLE.install_drain_handler(timeout=_config['drain_timeout'])
+    LIFECYCLE.ready = True
     logger.info(f"RenkeBot backend initialization completed, ready for handling requests.")
+    STARTUP.record("ready", process_uptime())
+    STARTUP.report(logger)
     logger.info(BUDDHA)
     yield
+    LIFECYCLE.ready = False
+    await LIFECYCLE.wait_drained(timeout=_config['drain_timeout'])
+    await CONVERSE_ENGINE.aclose()
+    await LOOP_MONITOR.aclose()
+    mark_worker_dead()
 # create the application with lifespan events, refer to https://fastapi.tiangolo.com/advanced/events/
 app = FastAPI(lifespan=lifespan)
+# Server-Timing header with the stage timings, for every request or on `X-Request-Timing: 1`
+app.add_middleware(TimingHeaderMiddleware, always=get_service_config(BACKEND_CONFIG, 'metrics')['timing_header'])
+# affinity cookie keeping the sessions on the instance that caches them
+_affinity_config = get_service_config(BACKEND_CONFIG, 'session_cache').get('affinity', {})
+if _affinity_config.get('enabled'):
+    app.add_middleware(
+        SessionAffinityMiddleware, 
+        paths=_affinity_config['paths'], 
+        cookie=_affinity_config['cookie'], 
+        max_age=get_service_config(BACKEND_CONFIG, 'redis')['ttl'], 
+        instance_id=_affinity_config.get('instance_id', "")
+    )
+# per-client and per-session rate limits of the chat endpoints, outermost to reject before any other work
+_limit_config = get_service_config(BACKEND_CONFIG, 'rate_limit')
+if _limit_config.get('enabled'):
+    app.add_middleware(RateLimitMiddleware, paths=_limit_config['paths'], client_header=_limit_config.get('client_header', ""))
+
+def log_query(endpoint:str, client, req_pl:SimpleChatQuery):
+    """Records the user query as a structured record of query.log, written in the background."""
+    logger.info(f"Received [{endpoint}] request from {client}, session {req_pl.session_id}.")
+    query_logger.info("query", extra={
+        "endpoint": endpoint, 
+        "client": f"{client.host}:{client.port}" if client else None, 
+        "session_id": req_pl.session_id, 
+        "query": req_pl.query
+    })
 
-def initialize_converse_engine(logger:logging.Logger, config_path:Union[str,Path]=BACKEND_CONFIG) -> Converse_Bedrock:
+@contextmanager
+def serving(endpoint:str):
+    """Tracks a request for the graceful drain and the in-flight gauges, and times it."""
+    with LIFECYCLE.track(), INFLIGHT_REQUESTS.labels(endpoint).track_inprogress(), REQUEST_LATENCY.labels(endpoint).time():
+        yield
+
+def to_http_exception(e: Exception) -> HTTPException:
+    """Maps an application error to the HTTP error returned to the client."""
+    _headers = {"Retry-After": str(e.retry_after)} if hasattr(e, 'retry_after') else None
+    return HTTPException(
+        status_code=getattr(e, 'status_code', status.HTTP_500_INTERNAL_SERVER_ERROR), 
+        detail=str(e), 
+        headers=_headers
+    )
+
+def initialize_converse_engine(logger:logging.Logger, config_path:Union[str,Path]=BACKEND_CONFIG) -> "Converse_Bedrock":
+    from src.chat_engines import Converse_Bedrock
     return Converse_Bedrock(logger=logger, config_path=config_path)
 
 # =========================================================================================================
@@ -63,21 +157,285 @@ def initialize_converse_engine(logger:logging.Logger, config_path:Union[str,Path
 # =========================================================================================================
 @app.post("/simple_chat", status_code=status.HTTP_200_OK)
 async def simple_chat(req_pl: SimpleChatQuery, request: Request) -> SimpleChatResponse:
+    return await _chat_reply(sys._getframe().f_code.co_name, req_pl, request)
+
+@app.post("/rag_chat", status_code=status.HTTP_200_OK)
+async def rag_chat(req_pl: SimpleChatQuery, request: Request) -> SimpleChatResponse:
+    """Chat grounded on the documents of the RAG index, retrieved for every turn."""
+    return await _chat_reply(sys._getframe().f_code.co_name, req_pl, request, rag=True)
+
+async def _chat_reply(endpoint: str, req_pl: SimpleChatQuery, request: Request, rag: bool = False) -> SimpleChatResponse:
     try:
-        # log the user query
-        logger.info(f"Received [{sys._getframe().f_code.co_name}] request from {request.client}: '{req_pl.query}'.")
-        # assign new seesion_id if not included in the request payload
-        if not req_pl.session_id: 
-            req_pl.session_id = str(uuid.uuid4()) # generate an id for the new session
-            logger.info(f"Generated new session id: {req_pl.session_id}")
-        # invoke chat engine to complete the conversation
-        _res = await asyncio.to_thread(CONVERSE_ENGINE.chat, req_pl.query, req_pl.session_id)
-        # generate the return response
-        response= SimpleChatResponse(message=_res, session_id=req_pl.session_id)
-        return response
+        with serving(endpoint):
+            # assign new seesion_id if not included in the request payload
+            if not req_pl.session_id: 
+                req_pl.session_id = str(uuid.uuid4()) # generate an id for the new session
+                logger.info(f"Generated new session id: {req_pl.session_id}")
+            # log the user query
+            log_query(endpoint, request.client, req_pl)
+            # invoke chat engine to complete the conversation, one turn per session at a time
+            async with SCHEDULER.slot(req_pl.session_id):
+                _res = await CONVERSE_ENGINE.achat(req_pl.query, req_pl.session_id, rag=rag)
+            # generate the return response
+            response= SimpleChatResponse(message=_res, session_id=req_pl.session_id)
+            return response
     except Exception as e:
+        ERRORS.labels(endpoint, type(e).__name__).inc()
         logger.error(f"Failed to reply. Error: {e}.")
-        raise HTTPException(status_code=getattr(e, 'status_code', status.HTTP_500_INTERNAL_SERVER_ERROR), detail=str(e))
+        raise to_http_exception(e)
+
+@app.post("/stream_chat", status_code=status.HTTP_200_OK)
+async def stream_chat(req_pl: SimpleChatQuery, request: Request) -> StreamingResponse:
+    """
+    Streams the reply as server-sent events, one 'token' event per token followed by an 'end' event.
+    Starlette cancels the stream when the client disconnects, which cancels the upstream generation.
+    """
+    return _stream_reply(sys._getframe().f_code.co_name, req_pl, request)
+
+@app.post("/rag_stream_chat", status_code=status.HTTP_200_OK)
+async def rag_stream_chat(req_pl: SimpleChatQuery, request: Request) -> StreamingResponse:
+    """Streaming version of /rag_chat, with the events of /stream_chat."""
+    return _stream_reply(sys._getframe().f_code.co_name, req_pl, request, rag=True)
+
+def _stream_reply(endpoint: str, req_pl: SimpleChatQuery, request: Request, rag: bool = False) -> StreamingResponse:
+    if not req_pl.session_id: 
+        req_pl.session_id = str(uuid.uuid4()) # generate an id for the new session
+        logger.info(f"Generated new session id: {req_pl.session_id}")
+    log_query(endpoint, request.client, req_pl)
+    # reject before the stream starts when the wait queue is full
+    try:
+        SCHEDULER.admit()
+    except TooManyRequestsError as e:
+        ERRORS.labels(endpoint, type(e).__name__).inc()
+        raise to_http_exception(e)
+    async def _event_stream():
+        try:
+            with serving(endpoint):
+                async with SCHEDULER.slot(req_pl.session_id):
+                    async for _token in CONVERSE_ENGINE.astream_chat(req_pl.query, req_pl.session_id, rag=rag):
+                        yield _sse(ChatStreamEvent(event="token", content=_token, session_id=req_pl.session_id))
+                yield _sse(ChatStreamEvent(event="end", session_id=req_pl.session_id))
+        except asyncio.CancelledError:
+            logger.info(f"Client disconnected, cancelled the reply of session {req_pl.session_id}.")
+            raise
+        except Exception as e:
+            ERRORS.labels(endpoint, type(e).__name__).inc()
+            logger.error(f"Failed to stream reply. Error: {e}.")
+            yield _sse(ChatStreamEvent(event="error", content=str(e), session_id=req_pl.session_id))
+    return StreamingResponse(
+        _event_stream(), 
+        media_type="text/event-stream", 
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _sse(event: ChatStreamEvent) -> str:
+    return f"event: {event.event}\ndata: {event.model_dump_json()}\n\n"
+
+@app.post("/batch_chat", status_code=status.HTTP_200_OK)
+async def batch_chat(req_pl: BatchChatQuery, request: Request) -> StreamingResponse:
+    """
+    Answers many queries at once, streaming one BatchChatResult JSON line per item as it completes.
+    The items go through the rate limits and the scheduler like interactive turns, and back off when it is saturated.
+    Resubmitting a batch with the same batch_id only answers the items missing from its results.
+    """
+    # the batch runner is only imported by the workers serving batches
+    from src.batch import BatchRunner, RedisCheckpoint
+    _endpoint = sys._getframe().f_code.co_name
+    _config = get_service_config(BACKEND_CONFIG, 'batch')
+    if len(req_pl.items) > _config['max_items']:
+        ERRORS.labels(_endpoint, InvalidRequestError.__name__).inc()
+        raise to_http_exception(InvalidRequestError(f"Too many items, at most {_config['max_items']} per batch."))
+    logger.info(f"Received [{_endpoint}] request from {request.client} with {len(req_pl.items)} items, batch {req_pl.batch_id}.")
+    _checkpoint = None
+    if req_pl.batch_id:
+        _checkpoint = RedisCheckpoint(CONVERSE_ENGINE.async_redis_client, req_pl.batch_id, ttl=_config['checkpoint_ttl'])
+    # the middleware charged the batch itself, its items are paced through the rate limits of the client
+    _admit = None
+    _limiter: Optional[RateLimiter] = getattr(request.app.state, "rate_limiter", None)
+    if _limiter is not None:
+        _client = client_id(request.scope, _limit_config.get('client_header', "").lower().encode())
+        _admit = lambda item: _limiter.paced(_client, item.get("session_id"), item["query"])
+    _runner = BatchRunner(_config, CONVERSE_ENGINE, logger=logger, slot=SCHEDULER.slot, admit=_admit)
+    async def _results():
+        try:
+            with serving(_endpoint):
+                async for _result in _runner.arun([i.model_dump() for i in req_pl.items], checkpoint=_checkpoint, rag=req_pl.rag):
+                    yield BatchChatResult(**_result).model_dump_json() + "\n"
+        except Exception as e:
+            ERRORS.labels(_endpoint, type(e).__name__).inc()
+            logger.error(f"Failed to run batch {req_pl.batch_id}. Error: {e}.")
+            yield BatchChatResult(id="", status="error", error=str(e)).model_dump_json() + "\n"
+    return StreamingResponse(_results(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+@app.get("/metrics", status_code=status.HTTP_200_OK)
+async def metrics() -> Response:
+    """Prometheus metrics of the service."""
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/health", status_code=status.HTTP_200_OK)
+async def health() -> Dict:
+    """Liveness probe."""
+    return {"status": "alive"}
+
+@app.get("/ready", status_code=status.HTTP_200_OK)
+async def ready(response: Response) -> Dict:
+    """Readiness probe, ready once the engine is warm and until the worker starts draining."""
+    if not LIFECYCLE.is_ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "draining" if LIFECYCLE.draining else "starting", "inflight": LIFECYCLE.inflight}
+    return {"status": "ready", "inflight": LIFECYCLE.inflight}
+
+@app.get("/stats/cache", status_code=status.HTTP_200_OK)
+async def cache_stats() -> Dict:
+    """Hit/miss counters of the response cache."""
+    if CONVERSE_ENGINE.response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **CONVERSE_ENGINE.response_cache.stats()}
+
+@app.get("/stats/session_cache", status_code=status.HTTP_200_OK)
+async def session_cache_stats() -> Dict:
+    """Hit ratio and memory of the in-process session cache of this worker."""
+    if CONVERSE_ENGINE.session_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **CONVERSE_ENGINE.session_cache.stats()}
+
+@app.get("/stats/startup", status_code=status.HTTP_200_OK)
+async def startup_stats() -> Dict:
+    """Seconds spent in each start-up phase of this worker."""
+    return STARTUP.stats()
+
+@app.get("/stats/scheduler", status_code=status.HTTP_200_OK)
+async def scheduler_stats() -> Dict:
+    """Wait queue of the scheduler."""
+    return {"queue_depth": SCHEDULER.queue_depth, "retry_after": SCHEDULER.retry_after}
+
+@app.get("/debug/profile", status_code=status.HTTP_200_OK)
+async def debug_profile(request: Request, seconds: float = 10) -> Response:
+    """
+    Samples the stacks of this worker over `seconds` of live traffic, returned in the collapsed format
+    of flamegraph.pl and speedscope. Requires the X-Debug-Token header, disabled without a token.
+    """
+    _config = get_service_config(BACKEND_CONFIG, 'diagnostics')
+    _token = debug_token(_config)
+    if _token is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("x-debug-token", "").encode(), _token.encode()):
+        raise to_http_exception(UserAuthenticationError("Invalid debug token."))
+    if PROFILE_LOCK.locked():
+        raise to_http_exception(TooManyRequestsError(
+            "A profile is already running on this worker.", status_code=status.HTTP_409_CONFLICT, retry_after=int(seconds) + 1
+        ))
+    _seconds = min(max(seconds, 0.1), _config['max_profile_seconds'])
+    async with PROFILE_LOCK:
+        logger.info(f"Profiling worker {os.getpid()} for {_seconds}s.")
+        _stacks = await SamplingProfiler(_config['profile_interval_ms'] / 1000).arun(_seconds)
+    return Response(
+        _stacks, 
+        media_type="text/plain", 
+        headers={"Content-Disposition": f'attachment; filename="profile-{os.getpid()}.collapsed"'}
+    )
+
+# =========================================================================================================
+# WebSocket API endpoints
+# =========================================================================================================
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    """
+    Streams replies over a WebSocket. The client sends SimpleChatQuery payloads and receives
+    ChatStreamEvent messages. A message received while a reply is streaming cancels it, and is
+    then answered as the next query, unless its query is empty (a cancellation only). A disconnect
+    cancels the reply as well. Each query is charged to the rate limits like a chat request.
+    """
+    await websocket.accept()
+    logger.info(f"Accepted [{sys._getframe().f_code.co_name}] connection from {websocket.client}.")
+    # one pending receive at a time, kept across the replies so that no message is lost
+    _listen: Optional[asyncio.Task] = None
+    _reply: Optional[asyncio.Task] = None
+    try:
+        while True:
+            _listen = _listen or asyncio.create_task(websocket.receive())
+            _message = await _listen
+            _listen = None
+            if _message["type"] == "websocket.disconnect":
+                return
+            try:
+                req_pl = _ws_query(_message)
+            except Exception as e:
+                await websocket.send_json(ChatStreamEvent(event="error", content=f"Invalid request: {e}").model_dump())
+                continue
+            if not req_pl.session_id: 
+                req_pl.session_id = str(uuid.uuid4()) # generate an id for the new session
+                logger.info(f"Generated new session id: {req_pl.session_id}")
+            log_query("ws_chat", websocket.client, req_pl)
+            _decision, _tokens = await _ws_admit(websocket, req_pl)
+            if _decision is not None and not _decision.admitted:
+                _retry = max(1, math.ceil(_decision.wait))
+                await websocket.send_json(ChatStreamEvent(
+                    event="error", content=f"Rate limit exceeded, please retry in {_retry} seconds.", session_id=req_pl.session_id
+                ).model_dump())
+                continue
+            # stream the reply while listening to the client
+            _reply = asyncio.create_task(_ws_stream_reply(websocket, req_pl, _decision, _tokens))
+            _listen = asyncio.create_task(websocket.receive())
+            done, _ = await asyncio.wait({_reply, _listen}, return_when=asyncio.FIRST_COMPLETED)
+            if _reply not in done:
+                _reply.cancel()
+                await asyncio.wait({_reply})
+                if _listen.result()["type"] == "websocket.disconnect":
+                    logger.info(f"Client disconnected, cancelled the reply of session {req_pl.session_id}.")
+                    return
+                await websocket.send_json(ChatStreamEvent(event="cancelled", session_id=req_pl.session_id).model_dump())
+                # the message is answered next, unless it only cancelled the reply
+                if _ws_cancel_only(_listen.result()):
+                    _listen = None
+                continue
+            try:
+                _reply.result()
+            except WebSocketDisconnect:
+                return
+            except Exception as e:
+                ERRORS.labels("ws_chat", type(e).__name__).inc()
+                logger.error(f"Failed to stream reply. Error: {e}.")
+                await websocket.send_json(ChatStreamEvent(event="error", content=str(e), session_id=req_pl.session_id).model_dump())
+            else:
+                await websocket.send_json(ChatStreamEvent(event="end", session_id=req_pl.session_id).model_dump())
+    finally:
+        _pending = [_task for _task in (_reply, _listen) if _task is not None and not _task.done()]
+        for _task in _pending:
+            _task.cancel()
+        if _pending:
+            await asyncio.wait(_pending)
+
+def _ws_query(message: dict) -> SimpleChatQuery:
+    return SimpleChatQuery.model_validate_json(message.get("text") or message.get("bytes") or b"")
+
+def _ws_cancel_only(message: dict) -> bool:
+    """Whether a message received while a reply was streaming only cancels it: its query is empty."""
+    try:
+        return not _ws_query(message).query.strip()
+    except Exception:
+        return False
+
+async def _ws_admit(websocket: WebSocket, req_pl: SimpleChatQuery) -> Tuple[Optional[Decision], List[Bucket]]:
+    """Charges a query of the WebSocket to the rate limits, the RateLimitMiddleware only sees the handshake."""
+    _limiter: Optional[RateLimiter] = getattr(websocket.app.state, "rate_limiter", None)
+    if _limiter is None:
+        return None, []
+    _client = client_id(websocket.scope, _limit_config.get('client_header', "").lower().encode())
+    _requests, _tokens = _limiter.buckets(_client, req_pl.session_id, _limiter.estimate_tokens([req_pl.query]))
+    return await _limiter.aadmit(_requests + _tokens), _tokens
+
+async def _ws_stream_reply(websocket: WebSocket, req_pl: SimpleChatQuery, decision: Optional[Decision], tokens: List[Bucket]):
+    with serving("ws_chat"), count_request_tokens() as _used:
+        try:
+            if decision is not None and decision.wait:
+                await asyncio.sleep(decision.wait)
+            async with SCHEDULER.slot(req_pl.session_id):
+                async for _token in CONVERSE_ENGINE.astream_chat(req_pl.query, req_pl.session_id):
+                    await websocket.send_json(ChatStreamEvent(event="token", content=_token, session_id=req_pl.session_id).model_dump())
+        finally:
+            if decision is not None:
+                await websocket.app.state.rate_limiter.areconcile(tokens, _used["input"] + _used["output"])
 
 # =========================================================================================================
 # Start application and listen to specified port
@@ -88,7 +446,12 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--mode', default='dev', 
                         choices=['dev', 'prod'], 
                         help='Serve APIs under dev (http) or production mode')
+    parser.add_argument('--profile-startup', action='store_true', 
+                        help='Log the time and the cProfile of each start-up phase of the workers')
     args = parser.parse_args()
+    # inherited by the worker processes
+    if args.profile_startup:
+        os.environ[PROFILE_STARTUP_VAR] = "1"
     # verify hosting environment
     if args.mode == 'dev':
         _config = get_service_config(BACKEND_CONFIG, 'fastapi')
@@ -96,5 +459,17 @@ if __name__ == '__main__':
         uvicorn.run("main:app", host=_config['host'], port=_config['port'], reload=True)
     elif args.mode == 'prod':
         _config = get_service_config(BACKEND_CONFIG, 'fastapi')
-        # Start application under HTTP protocol
-        uvicorn.run("main:app", host=_config['host'], port=_config['port'])        
+        _workers = resolve_workers(_config['workers'])
+        os.environ[WORKERS_VAR] = str(_workers)
+        # workers aggregate their metrics through a shared directory, and write log files of their own
+        if _workers > 1:
+            setup_multiprocess_metrics()
+            os.environ[LOG_PER_PROCESS_VAR] = "1"
+        # Start application under HTTP protocol, one process per worker
+        uvicorn.run(
+            "main:app", 
+            host=_config['host'], 
+            port=_config['port'], 
+            workers=_workers, 
+            timeout_graceful_shutdown=_config['timeout_graceful_shutdown']
+        )        
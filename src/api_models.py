@@ -17,4 +17,62 @@ class SimpleChatResponse(BaseModel):
         message (str): Response from simple chat endpoint
     """
     message: str
-    session_id: Optional[str] = None
\ No newline at end of file
+    session_id: Optional[str] = None
+
+class ChatStreamEvent(BaseModel):
+    """
+    Event emitted by the streaming chat endpoints (SSE and WebSocket)
+    Attributes:
+        event (str): One of 'token', 'end', 'cancelled' or 'error'
+        content (str): The token for 'token' events, the error detail for 'error' events
+        session_id (str): Id of the conversation session
+    """
+    event: str
+    content: Optional[str] = None
+    session_id: Optional[str] = None
+
+class BatchChatItem(BaseModel):
+    """
+    One query of a batch
+    Attributes:
+        query (str): The query to be sent to the LLM agent
+        session_id (str): Conversation to continue, items of the same session are answered in order
+        id (str): Id of the item in the results, defaults to its position in the batch
+    """
+    query: str
+    session_id: Optional[str] = None
+    id: Optional[str] = None
+
+class BatchChatQuery(BaseModel):
+    """
+    Batch of queries answered by the /batch_chat endpoint
+    Attributes:
+        items (list): The queries
+        batch_id (str): Resubmitting a batch with the same id skips the items already answered
+        rag (bool): Answer with the documents of the RAG index
+    """
+    items: List[BatchChatItem]
+    batch_id: Optional[str] = None
+    rag: bool = False
+
+class BatchChatResult(BaseModel):
+    """
+    Result of one batch item, streamed as a JSON line once the item completes
+    Attributes:
+        id (str): Id of the item
+        session_id (str): Id of the conversation session
+        status (str): 'ok' or 'error'
+        message (str): Response of the LLM agent
+        error (str): Error detail of a failed item
+        attempts (int): Attempts made, more than one when throttled
+        latency (float): Seconds to answer the item, including retries
+        resumed (bool): Whether the result was taken from the checkpoint of the batch
+    """
+    id: str
+    session_id: Optional[str] = None
+    status: str
+    message: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    latency: Optional[float] = None
+    resumed: bool = False
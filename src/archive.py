@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the background archival of the conversation turns to Postgres
+"""
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import List, Optional, Tuple
+import asyncpg
+# project imports
+from src.utils.metrics import ARCHIVE_FLUSH_LATENCY, ARCHIVE_QUEUE_DEPTH, ARCHIVE_RECORDS
+from src.utils.proj_paths import ARCHIVE_SPILL
+
+COLUMNS = ("session_id", "created_at", "query", "reply", "model_tier", "rag", "source")
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id BIGSERIAL PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    query TEXT NOT NULL,
+    reply TEXT NOT NULL,
+    model_tier TEXT,
+    rag BOOLEAN NOT NULL DEFAULT FALSE,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS {table}_session_idx ON {table} (session_id, created_at);
+"""
+
+
+class ConversationArchiver():
+    """
+    Archives the completed turns to Postgres without adding latency to the chat replies.
+    - `submit` only enqueues the turn in memory and never waits.
+    - A background task flushes the queue in batches of up to `batch_size` turns, at least every
+      `flush_interval` seconds, with COPY through a small asyncpg pool.
+    - Backpressure: when the queue is full, because Postgres is slow or down, the turns go to a bounded
+      overflow buffer that a background task appends to a spill file of the worker, the chat path never
+      touches the disk. A batch that fails to be written is spilled as well, and the flusher backs off
+      exponentially. Once Postgres accepts writes again, the spill files left by any worker are claimed
+      and replayed. The file I/O runs in threads, off the event loop.
+
+    Attributes:
+        table (str): Table of the archived turns, created if missing
+        batch_size (int): Maximum number of turns written by one COPY
+        flush_interval (float): Seconds a turn may wait in the queue for a batch to fill
+        queue (asyncio.Queue): Turns waiting to be written
+        overflow (deque): Turns waiting to be spilled, beyond `spill_buffer` of them they are dropped
+        spill_dir (Path): Directory of the spill files
+    """
+    def __init__(self, archive_config: dict, db_config: dict, logger: logging.Logger, spill_dir: Path = ARCHIVE_SPILL):
+        self.table = archive_config.get('table', 'chat_turns')
+        self.batch_size = archive_config.get('batch_size', 500)
+        self.flush_interval = archive_config.get('flush_interval', 2)
+        self.backoff_cap = archive_config.get('backoff_cap', 60)
+        self.drain_timeout = archive_config.get('drain_timeout', 5)
+        self.pool_size = archive_config.get('pool_size', 2)
+        self.db_config = db_config
+        self.logger = logger
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=archive_config.get('queue_size', 10000))
+        self.spill_dir = Path(spill_dir)
+        self.spill_path = self.spill_dir / f"spill-{os.getpid()}.jsonl"
+        self.spill_buffer = archive_config.get('spill_buffer', 10000)
+        self.overflow: deque = deque()
+        self._overflowed = asyncio.Event()
+        # the spill writer and the flusher append to the same file from their threads
+        self._spill_lock = threading.Lock()
+        self._pool = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._spiller: Optional[asyncio.Task] = None
+        self._failures = 0
+        self._closing = False
+
+    # ---------------------------------- chat path ----------------------------------
+    def submit(self, session_id: str, query: str, reply: str, model_tier: Optional[str] = None, rag: bool = False, source: str = "model"):
+        """Enqueues a completed turn, handed to the spill writer when the queue is full."""
+        _record = (session_id, datetime.now(timezone.utc), query, reply, model_tier, rag, source)
+        try:
+            self.queue.put_nowait(_record)
+        except asyncio.QueueFull:
+            if len(self.overflow) >= self.spill_buffer:
+                ARCHIVE_RECORDS.labels("dropped").inc()
+            else:
+                self.overflow.append(_record)
+                self._overflowed.set()
+        ARCHIVE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    # ---------------------------------- lifecycle ----------------------------------
+    async def astart(self):
+        """Starts the flusher, the connection to Postgres is retried in the background if it fails."""
+        await asyncio.to_thread(self.spill_dir.mkdir, parents=True, exist_ok=True)
+        await asyncio.to_thread(self._release_claims)
+        self._flusher = asyncio.create_task(self._aflush_forever())
+        self._spiller = asyncio.create_task(self._aspill_forever())
+
+    async def aclose(self):
+        """Lets the flusher drain the queue within `drain_timeout` seconds, spills what is left and closes the pool."""
+        self._closing = True
+        _drained = True
+        if self._flusher is not None:
+            _, _pending = await asyncio.wait([self._flusher], timeout=self.drain_timeout)
+            if _pending:
+                _drained = False
+                self._flusher.cancel()
+                await asyncio.gather(self._flusher, return_exceptions=True)
+        if self._spiller is not None:
+            self._spiller.cancel()
+            await asyncio.gather(self._spiller, return_exceptions=True)
+        await asyncio.to_thread(self._spill, self._take_overflow() + self._take(self.queue.qsize()))
+        if self._pool is not None:
+            # a write cut short by the timeout may still hold its connection
+            await self._pool.close() if _drained else self._pool.terminate()
+
+    # ---------------------------------- background flusher ----------------------------------
+    async def _aflush_forever(self):
+        """Writes the queue until the archiver is closed and the queue is empty, the failed writes are spilled."""
+        while not (self._closing and self.queue.empty()):
+            if self._pool is None and not await self._aconnect():
+                if self._closing:
+                    return
+                await self._abackoff()
+                continue
+            _batch = await self._anext_batch()
+            if _batch and not await self._awrite(_batch, "written"):
+                await asyncio.to_thread(self._spill, _batch)
+                if self._closing:
+                    return
+                await self._abackoff()
+                continue
+            if not self._closing and (not _batch or self.queue.empty()) and not await self._areplay_spills():
+                await self._abackoff()
+
+    async def _aconnect(self) -> bool:
+        try:
+            self._pool = await asyncpg.create_pool(
+                host=self.db_config['host'],
+                port=self.db_config['port'],
+                database=self.db_config['database'],
+                user=self.db_config['user'],
+                password=self.db_config['password'],
+                timeout=self.db_config.get('connect_timeout', 7),
+                min_size=1,
+                max_size=self.pool_size,
+            )
+            async with self._pool.acquire() as conn:
+                await conn.execute(CREATE_TABLE.format(table=self.table))
+            self._failures = 0
+            self.logger.info(f"Connected the conversation archive to Postgres, table {self.table}.")
+            return True
+        except Exception as e:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            self.logger.warning(f"Failed to connect the conversation archive to Postgres. Error: {e}.")
+            return False
+
+    async def _anext_batch(self) -> List[tuple]:
+        """Waits for the first turn, then up to `flush_interval` seconds for the batch to fill."""
+        if self._closing:
+            return self._take(self.batch_size)
+        try:
+            _batch = [await asyncio.wait_for(self.queue.get(), timeout=self.flush_interval)]
+        except asyncio.TimeoutError:
+            return []
+        _deadline = time.monotonic() + self.flush_interval
+        while len(_batch) < self.batch_size:
+            _batch.extend(self._take(self.batch_size - len(_batch)))
+            _remaining = _deadline - time.monotonic()
+            if len(_batch) >= self.batch_size or _remaining <= 0:
+                break
+            try:
+                _batch.append(await asyncio.wait_for(self.queue.get(), timeout=_remaining))
+            except asyncio.TimeoutError:
+                break
+        ARCHIVE_QUEUE_DEPTH.set(self.queue.qsize())
+        return _batch
+
+    async def _aspill_forever(self):
+        """Appends the overflow of the queue to the spill file, in a thread."""
+        while True:
+            await self._overflowed.wait()
+            self._overflowed.clear()
+            await asyncio.to_thread(self._spill, self._take_overflow())
+
+    def _take_overflow(self) -> List[tuple]:
+        _batch = list(self.overflow)
+        self.overflow.clear()
+        return _batch
+
+    def _take(self, count: int) -> List[tuple]:
+        _batch = []
+        while len(_batch) < count and not self.queue.empty():
+            _batch.append(self.queue.get_nowait())
+        ARCHIVE_QUEUE_DEPTH.set(self.queue.qsize())
+        return _batch
+
+    async def _awrite(self, batch: List[tuple], outcome: str) -> bool:
+        try:
+            with ARCHIVE_FLUSH_LATENCY.time():
+                async with self._pool.acquire() as conn:
+                    await conn.copy_records_to_table(self.table, records=batch, columns=COLUMNS)
+            ARCHIVE_RECORDS.labels(outcome).inc(len(batch))
+            self._failures = 0
+            return True
+        except Exception as e:
+            self.logger.warning(f"Failed to archive {len(batch)} turns to Postgres. Error: {e}.")
+            return False
+
+    async def _abackoff(self):
+        self._failures += 1
+        await asyncio.sleep(min(self.backoff_cap, 2 ** self._failures))
+
+    # ---------------------------------- spill files ----------------------------------
+    def _spill(self, batch: List[tuple]):
+        if not batch:
+            return
+        try:
+            with self._spill_lock:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                with open(self.spill_path, "a") as f:
+                    for _record in batch:
+                        f.write(json.dumps(dict(zip(COLUMNS, _record)), default=str) + "\n")
+            ARCHIVE_RECORDS.labels("spilled").inc(len(batch))
+        except OSError as e:
+            ARCHIVE_RECORDS.labels("dropped").inc(len(batch))
+            self.logger.error(f"Failed to spill {len(batch)} turns to {self.spill_path}, they are lost. Error: {e}.")
+
+    async def _areplay_spills(self) -> bool:
+        """
+        Claims the spill files of every worker by renaming them, and writes them to Postgres.
+        Returns False if a write failed, the turns not written are spilled again.
+        """
+        for _path in await asyncio.to_thread(lambda: sorted(self.spill_dir.glob("spill-*.jsonl"))):
+            _claimed = _path.with_suffix(f".replay-{os.getpid()}")
+            try:
+                await asyncio.to_thread(os.rename, _path, _claimed)
+            except OSError:
+                continue # claimed by another worker
+            _records = await asyncio.to_thread(self._read_spill, _claimed)
+            for i in range(0, len(_records), self.batch_size):
+                if not await self._awrite(_records[i:i + self.batch_size], "replayed"):
+                    await asyncio.to_thread(self._spill, _records[i:])
+                    await asyncio.to_thread(_claimed.unlink)
+                    return False
+            await asyncio.to_thread(_claimed.unlink)
+            self.logger.info(f"Replayed {len(_records)} spilled turns from {_path.name}.")
+        return True
+
+    def _release_claims(self):
+        """Returns the spill files claimed by workers that died while replaying them."""
+        for _path in self.spill_dir.glob("spill-*.replay-*"):
+            _pid = int(_path.suffix.rsplit("-", 1)[1])
+            try:
+                os.kill(_pid, 0)
+            except ProcessLookupError:
+                os.rename(_path, _path.with_name(f"{_path.stem}-{_pid}.jsonl"))
+            except PermissionError:
+                pass # alive, owned by another user
+
+    @staticmethod
+    def _read_spill(path: Path) -> List[Tuple]:
+        _records = []
+        with open(path) as f:
+            for _line in f:
+                try:
+                    _row = json.loads(_line)
+                except json.JSONDecodeError:
+                    continue # torn write of a crashed worker
+                _row['created_at'] = datetime.fromisoformat(_row['created_at'])
+                _records.append(tuple(_row[c] for c in COLUMNS))
+        return _records
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the batch runner answering many queries through the chat engine, used by the
+/batch_chat endpoint and by the offline batch mode:
+    python -m src.batch --input queries.jsonl --output results.jsonl [--concurrency 16] [--rag]
+Every input line is a JSON object with a query and optionally a session_id and an id. Results are
+appended to the output as they complete, and a rerun skips the items already answered there.
+Other layouts are mapped with --query-field/--id-field, e.g. `--query-field body --id-field request_id`.
+"""
+import argparse
+import asyncio
+from contextlib import nullcontext
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import time
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, Set
+import uuid
+import redis.asyncio as aioredis
+# project imports
+from src.utils.exceptions import TooManyRequestsError, UpstreamUnavailableError, is_throttled
+from src.utils.metrics import BATCH_CONCURRENCY, BATCH_ITEMS
+
+def is_throttling_error(e: Exception) -> bool:
+    """Whether the error asks to slow down: Bedrock throttling, the 429 of the scheduler or the 503 of the model endpoints."""
+    return isinstance(e, (TooManyRequestsError, UpstreamUnavailableError)) or is_throttled(e)
+
+
+class AdaptiveLimiter():
+    """
+    Concurrency limit adjusted by additive increase / multiplicative decrease: the limit grows by one
+    after a full window of successes and halves on throttling, at most once per window so that a
+    burst of throttled calls already in flight only counts once.
+
+    Attributes:
+        limit (int): Current number of calls allowed in flight
+        min_limit (int): Floor of the limit
+        max_limit (int): Ceiling of the limit
+    """
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: Optional[int] = None):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial
+        self.inflight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < self.limit)
+            self.inflight += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.max_limit:
+            self._successes = 0
+            self._set_limit(self.limit + 1)
+
+    def on_throttle(self, window: float = 1.0):
+        _now = time.monotonic()
+        if _now - self._last_decrease < window:
+            return
+        self._last_decrease = _now
+        self._successes = 0
+        self._set_limit(max(self.min_limit, self.limit // 2))
+
+    def _set_limit(self, limit: int):
+        self.limit = limit
+        BATCH_CONCURRENCY.set(limit)
+        # wake the waiters when the limit grew
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+
+class FileCheckpoint():
+    """Results appended to a JSONL file, which doubles as the output of the offline batch mode."""
+    def __init__(self, path: Path, restart: bool = False):
+        self.path = Path(path)
+        if restart and self.path.exists():
+            self.path.unlink()
+        self._file = None
+
+    async def aload(self) -> Dict[str, dict]:
+        """Results of the items answered by previous runs, by item id."""
+        done = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted run
+                        continue
+                    if result.get("status") == "ok":
+                        done[result["id"]] = result
+        return done
+
+    async def arecord(self, result: dict):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # an interrupted run may have left a partial line, start on a line of our own
+            _partial = False
+            if self.path.exists() and self.path.stat().st_size:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    _partial = f.read(1) != b"\n"
+            self._file = open(self.path, 'a')
+            if _partial:
+                self._file.write("\n")
+        self._file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    async def aclose(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class RedisCheckpoint():
+    """Results of a /batch_chat batch kept in a Redis hash, so that a client resubmitting the batch_id resumes it."""
+    def __init__(self, async_redis_client: aioredis.Redis, batch_id: str, ttl: int):
+        self.async_redis_client = async_redis_client
+        self.key = f"batch:{batch_id}"
+        self.ttl = ttl
+
+    async def aload(self) -> Dict[str, dict]:
+        _results = await self.async_redis_client.hgetall(self.key)
+        return {k.decode(): json.loads(v) for k, v in _results.items()}
+
+    async def arecord(self, result: dict):
+        if result["status"] != "ok":
+            return
+        pipe = self.async_redis_client.pipeline(transaction=False)
+        pipe.hset(self.key, result["id"], json.dumps(result, ensure_ascii=False))
+        pipe.expire(self.key, self.ttl)
+        await pipe.execute()
+
+    async def aclose(self):
+        pass
+
+
+class BatchRunner():
+    """
+    Answers a batch of queries through the chat engine with bounded, throttling-aware concurrency,
+    yielding each result as soon as it completes.
+    - Items of the same session run in input order, so that a conversation can be replayed; items
+      without a session_id start a session of their own.
+    - Throttled items are retried with jittered exponential backoff, and halve the concurrency limit.
+    - Items already in the checkpoint are returned from it without calling the engine.
+    - Each call of an item may first be admitted by `admit`, e.g. paced through the rate limits of the client.
+
+    Attributes:
+        concurrency (int): Upper bound of the adaptive concurrency limit
+        min_concurrency (int): Lower bound of the adaptive concurrency limit
+        max_retries (int): Retries of a throttled item
+        backoff_base (float): First retry delay in seconds, doubled per retry
+        backoff_cap (float): Longest retry delay in seconds
+    """
+    def __init__(self, batch_config: dict, engine, logger: logging.Logger, slot: Optional[Callable] = None, admit: Optional[Callable] = None):
+        self.concurrency = batch_config['concurrency']
+        self.min_concurrency = batch_config.get('min_concurrency', 1)
+        self.max_retries = batch_config['max_retries']
+        self.backoff_base = batch_config.get('backoff_base', 0.5)
+        self.backoff_cap = batch_config.get('backoff_cap', 20)
+        self.engine = engine
+        self.logger = logger
+        # admission of an item by session, e.g. the scheduler of the server
+        self.slot = slot or (lambda session_id: nullcontext())
+        # admission of an item, e.g. the rate limits of the client of the batch
+        self.admit = admit or (lambda item: nullcontext())
+
+    async def arun(self, items: Iterable[dict], checkpoint=None, rag: bool = False) -> AsyncIterator[dict]:
+        """Runs the items ({"id", "query", "session_id"}) and yields their results in completion order."""
+        limiter = AdaptiveLimiter(self.concurrency, self.min_concurrency)
+        BATCH_CONCURRENCY.set(limiter.limit)
+        done = await checkpoint.aload() if checkpoint is not None else {}
+        results: asyncio.Queue = asyncio.Queue()
+        # bounds the items read ahead of the running ones
+        _pending = asyncio.Semaphore(4 * self.concurrency)
+        _tails: Dict[str, asyncio.Task] = {}
+        _tasks: Set[asyncio.Task] = set()
+
+        def _release_tail(session_id: str, task: asyncio.Task):
+            if _tails.get(session_id) is task:
+                del _tails[session_id]
+
+        async def _item(item: dict, previous: Optional[asyncio.Task]):
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                result = await self._arun_item(item, limiter, rag)
+                if checkpoint is not None:
+                    await checkpoint.arecord(result)
+                await results.put(result)
+            finally:
+                _pending.release()
+
+        async def _feed():
+            for index, item in enumerate(items):
+                item = {**item, "id": str(index if item.get("id") is None else item["id"])}
+                if item["id"] in done:
+                    BATCH_ITEMS.labels("checkpoint").inc()
+                    await results.put({**done[item["id"]], "resumed": True})
+                    continue
+                await _pending.acquire()
+                session_id = item.get("session_id")
+                _task = asyncio.create_task(_item(item, _tails.get(session_id) if session_id else None))
+                _tasks.add(_task)
+                _task.add_done_callback(_tasks.discard)
+                if session_id:
+                    _tails[session_id] = _task
+                    _task.add_done_callback(lambda t, s=session_id: _release_tail(s, t))
+            await asyncio.gather(*list(_tasks))
+            await results.put(None)
+
+        _feeder = asyncio.create_task(_feed())
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                yield result
+            await _feeder
+        finally:
+            # the consumer went away, e.g. the client disconnected
+            for _task in [_feeder, *_tasks]:
+                _task.cancel()
+            await asyncio.gather(_feeder, *_tasks, return_exceptions=True)
+            if checkpoint is not None:
+                await checkpoint.aclose()
+
+    async def _arun_item(self, item: dict, limiter: AdaptiveLimiter, rag: bool) -> dict:
+        session_id = item.get("session_id") or str(uuid.uuid4())
+        _start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with limiter:
+                    async with self.admit(item), self.slot(session_id):
+                        _reply = await self.engine.achat(item["query"], session_id, rag=rag)
+                limiter.on_success()
+                BATCH_ITEMS.labels("ok").inc()
+                return {
+                    "id": item["id"], "session_id": session_id, "status": "ok", "message": _reply,
+                    "attempts": attempt + 1, "latency": round(time.perf_counter() - _start, 3),
+                }
+            except Exception as e:
+                if not is_throttling_error(e) or attempt == self.max_retries:
+                    BATCH_ITEMS.labels("error").inc()
+                    self.logger.warning(f"Batch item {item['id']} failed after {attempt + 1} attempts. Error: {e}.")
+                    return {
+                        "id": item["id"], "session_id": session_id, "status": "error", "error": str(e),
+                        "attempts": attempt + 1, "latency": round(time.perf_counter() - _start, 3),
+                    }
+                limiter.on_throttle()
+                BATCH_ITEMS.labels("throttled").inc()
+                # full jitter, honouring the Retry-After of the scheduler
+                _delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                await asyncio.sleep(max(_delay, getattr(e, "retry_after", 0)))
+
+
+# =========================================================================================================
+# Offline batch mode
+# =========================================================================================================
+def read_items(path: Path, query_field: str, id_field: str, session_field: str) -> Iterable[dict]:
+    with open(path, 'r') as f:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield {"id": record.get(id_field, index), "query": record[query_field], "session_id": record.get(session_field)}
+
+async def amain(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from src.chat_engines import Converse_Bedrock
+    from src.utils.proj_paths import BACKEND_CONFIG
+    from src.utils.utils import get_service_config
+    logger = logging.getLogger("app_logger")
+    _config = get_service_config(BACKEND_CONFIG, 'batch')
+    if args.concurrency:
+        _config['concurrency'] = args.concurrency
+    engine = Converse_Bedrock(logger=logger)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=engine.max_inflight, thread_name_prefix="bedrock"))
+    await engine.awarmup()
+    runner = BatchRunner(_config, engine, logger)
+    _counts = {"ok": 0, "error": 0, "resumed": 0}
+    _start = time.perf_counter()
+    try:
+        items = read_items(args.input, args.query_field, args.id_field, args.session_field)
+        async for result in runner.arun(items, checkpoint=FileCheckpoint(args.output, restart=args.restart), rag=args.rag):
+            _counts["resumed" if result.get("resumed") else result["status"]] += 1
+            if sum(_counts.values()) % 100 == 0:
+                logger.info(f"Batch progress: {_counts}, {time.perf_counter() - _start:.0f}s.")
+    finally:
+        await engine.aclose()
+    logger.info(f"Batch completed in {time.perf_counter() - _start:.1f}s: {_counts}, results in {args.output}.")
+
+
+if __name__ == '__main__':
+    from src.utils.loggers import setup_logging
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=Path, required=True, help='JSONL file of the queries')
+    parser.add_argument('--output', type=Path, required=True, help='JSONL file of the results, also the checkpoint')
+    parser.add_argument('--restart', action='store_true', help='Discard the results of previous runs')
+    parser.add_argument('--concurrency', type=int, default=None, help="Overrides 'concurrency' of the 'batch' config")
+    parser.add_argument('--rag', action='store_true', help='Answer with the documents of the RAG index')
+    parser.add_argument('--query-field', default='query')
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--session-field', default='session_id')
+    args = parser.parse_args()
+    setup_logging(policy="block")
+    asyncio.run(amain(args))
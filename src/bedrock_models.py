@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the Bedrock models of the engine and of the RAG ingestion. It pulls in boto3 and
+langchain_aws, the slowest imports of the backend, and is only imported once the engine builds its Bedrock models.
+"""
+import asyncio
+import threading
+from langchain_aws import BedrockEmbeddings, ChatBedrockConverse
+from langchain_core.runnables.config import run_in_executor
+
+
+# the event streams opened by the converse_stream calls of the executor thread, see `_capture_stream`
+_CAPTURE = threading.local()
+
+
+def _capture_stream(parsed=None, **kwargs):
+    """Hook of the ConverseStream calls, collecting the event stream of the call for the thread running it."""
+    _streams = getattr(_CAPTURE, "streams", None)
+    if _streams is not None and isinstance(parsed, dict) and parsed.get("stream") is not None:
+        _streams.append(parsed["stream"])
+
+
+class CancellableChatBedrockConverse(ChatBedrockConverse):
+    """
+    ChatBedrockConverse whose async stream releases the Bedrock event stream as soon as the
+    consumer stops iterating (e.g. the client disconnected), which ends the upstream generation
+    and frees its HTTP connection. The base class drives the blocking boto3 stream from the
+    executor and leaves it dangling.
+    """
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.client.meta.events.register(
+            "after-call.bedrock-runtime.ConverseStream", _capture_stream, unique_id="renkebot-capture-stream"
+        )
+        iterator = await run_in_executor(
+            None, self._stream, messages, stop, run_manager.get_sync() if run_manager else None, **kwargs
+        )
+        # a generator can't be closed while an executor thread is advancing it
+        lock = threading.Lock()
+        done = object()
+        streams = []
+        def _next():
+            with lock:
+                _CAPTURE.streams = streams
+                try:
+                    return next(iterator, done)
+                finally:
+                    _CAPTURE.streams = None
+        def _close():
+            with lock:
+                iterator.close()
+                for _stream in streams:
+                    _stream.close()
+        try:
+            while True:
+                item = await run_in_executor(None, _next)
+                if item is done:
+                    break
+                yield item
+        finally:
+            asyncio.get_running_loop().run_in_executor(None, _close)
+
+
+def bedrock_embeddings(model_config: dict, default_region: str, queries: bool = False) -> BedrockEmbeddings:
+    """
+    Embedding model of a 'RAG_embedding_model' entry, on the endpoint of its region_name (`default_region`
+    otherwise). The ingestion and the engine both build it here, so that the index and the queries are
+    embedded by the same endpoint. With `queries`, the batches are embedded as search queries.
+    """
+    return BedrockEmbeddings(
+        model_id=model_config['modelId'],
+        region_name=model_config.get('region_name', default_region),
+        # Cohere embeds the batches as documents unless told otherwise
+        model_kwargs={"input_type": "search_query"} if queries and model_config.get('provider', '').lower() == "cohere" else None
+    )
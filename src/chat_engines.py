@@ -1,36 +1,118 @@
-import os
-import boto3
-from typing import TYPE_CHECKING, Dict, List, Union
+import asyncio
+import hashlib
+import json
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Optional, Union
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory, RedisChatMessageHistory
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.output_parsers import StrOutputParser
-from langchain_aws import ChatBedrockConverse
-#from langchain_redis import RedisChatMessageHistory
-from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables import ConfigurableField, Runnable, RunnableConfig, RunnablePassthrough
 import logging
 import redis
-import yaml
 # project imports
+from src.archive import ConversationArchiver
+from src.chat_history import CompactRedisChatMessageHistory
+from src.coalescer import SingleFlight
+from src.embedding_batcher import BatchingEmbeddings
+from src.history_policy import HistoryPolicy
+from src.model_router import ModelRouter
+from src.prompt_cache import PromptCachePoints
+from src.rag_index import VectorIndex
+from src.resilience import ResilientChatModel
+from src.response_cache import ResponseCache
+from src.retriever import Retriever
+from src.session_cache import SessionCache
+from src.session_lifecycle import SessionLifecycle
 from src.utils.proj_paths import *
 from src.utils.exceptions import *
+from src.utils.callbacks import MetricsCallbackHandler
+from src.utils.redis_pool import RedisPool
+from src.utils.startup import STARTUP
 from src.utils.utils import get_service_config
 
 
 class Converse_Bedrock():
-    def __init__(self, logger:logging.Logger, config_path:Union[str,Path]=BACKEND_CONFIG):
-        """Initializes the chat engine with Bedrock Chat Model."""
+    def __init__(
+        self, 
+        logger:logging.Logger, 
+        config_path:Union[str,Path]=BACKEND_CONFIG, 
+        llm:Optional[BaseChatModel]=None, 
+        tier_llms:Optional[Dict[str, BaseChatModel]]=None, 
+        summary_llm:Optional[BaseChatModel]=None, 
+        redis_pool:Optional[RedisPool]=None, 
+        embeddings:Optional[Embeddings]=None
+    ):
+        """
+        Initializes the chat engine with Bedrock Chat Model.
+        `llm`, `tier_llms`, `summary_llm`, `redis_pool` and `embeddings` replace the Bedrock models and
+        the Redis pool built from the config, e.g. with the offline stand-ins of the benchmarks.
+        """
         try:
             self.logger = logger
+            self._config_path = config_path
             # parse config file
             self._engine_config = get_service_config(config_path, 'converse_engine')
             print(self._engine_config)
             self._redis_config = get_service_config(config_path, 'redis')
+            self._runtime_config = get_service_config(config_path, 'converse_runtime')
+            self._history_policy_config = get_service_config(config_path, 'history_policy')
+            self._history_store_config = get_service_config(config_path, 'history_store')
+            self._session_cache_config = get_service_config(config_path, 'session_cache')
+            self._session_lifecycle_config = get_service_config(config_path, 'session_lifecycle')
+            self._coalescing_config = get_service_config(config_path, 'coalescing')
+            self._archive_config = get_service_config(config_path, 'archive')
+            self._summary_model_config = get_service_config(config_path, 'content_generation_model')
+            self._cache_config = get_service_config(config_path, 'response_cache')
+            self._embedding_model_config = get_service_config(config_path, 'RAG_embedding_model')
+            self._rag_config = get_service_config(config_path, 'rag')
+            self._router_config = get_service_config(config_path, 'model_router')
+            self._embedding_batcher_config = get_service_config(config_path, 'embedding_batcher')
+            self._endpoints_config = get_service_config(config_path, 'model_endpoints')
+            self._prompt_cache_config = get_service_config(config_path, 'prompt_cache')
+            # cap on concurrent Bedrock calls, the boto3 connection pool is sized to match
+            self.max_inflight = self._runtime_config['max_inflight_requests']
+            self._inflight = asyncio.Semaphore(self.max_inflight)
             # create llm and chain
-            self.llm = ChatBedrockConverse(**self._engine_config)
-            self.chain = self.get_conversation_chain()
+            self.llm = llm or self.get_primary_llm()
+            # the router sends simple turns to cheaper tiers of the chat model
+            self.router = ModelRouter(self._router_config) if self._router_config.get('enabled') else None
+            self.chat_model = self.get_tiered_llm(tier_llms or {})
+            # connection pool shared by all session histories
+            self._redis_pool = redis_pool or RedisPool(self._redis_config)
+            # tails of the recent sessions, kept in memory between the turns served by this worker
+            self.session_cache = SessionCache(self._session_cache_config) if self._session_cache_config.get('enabled') else None
+            # shared by the retrieval and the semantic response cache
+            self.embeddings = self.get_batching_embeddings(embeddings or self.get_embeddings(), with_fallback=embeddings is None)
+            # bounds the history injected into the prompt, older turns are summarized by the cheap model
+            self.history_policy = HistoryPolicy(
+                self._history_policy_config, 
+                summary_llm=summary_llm or self.get_summary_llm(), 
+                redis_client=self._redis_pool.client, 
+                async_redis_client=self._redis_pool.async_client, 
+                logger=self.logger, 
+                ttl=self._redis_config['ttl']
+            )
+            # cache points of the stable prompt prefix, for the models supporting prompt caching
+            self.prompt_cache = PromptCachePoints(
+                self._prompt_cache_config, tier_models=self._tier_models(), count_tokens=HistoryPolicy.count_tokens
+            )
+            # sliding expiry, size caps and memory budget of the sessions in Redis
+            self.session_lifecycle = self.get_session_lifecycle()
+            self._core_chain = self.get_conversation_core_chain()
+            self.chain = self._with_history(self._core_chain)
+            self.retriever = self.get_retriever()
+            self._rag_core_chain = self.get_rag_core_chain() if self.retriever else None
+            self.rag_chain = self._with_history(self._rag_core_chain) if self.retriever else None
+            self.response_cache = self.get_response_cache()
+            # identical first turns in flight at the same time share one model call
+            self.coalescer = SingleFlight() if self._coalescing_config.get('enabled') else None
+            # durable transcripts of the turns, written to Postgres in the background
+            self.archiver = ConversationArchiver(
+                self._archive_config, get_service_config(config_path, 'backend_db'), self.logger
+            ) if self._archive_config.get('enabled') else None
             self.logger.info(f"Successfully initialized LLM instance and chat chain, config: {self._engine_config}")
         except Exception as e:
             raise AppInitializationError(f"Failed to initialize LLM instance, error: {e}")
@@ -40,65 +122,435 @@ class Converse_Bedrock():
         except Exception as e:
             raise
         
-    def get_conversation_chain(self):
-        """Defines the full conversation chain with prompt and history."""
+    def get_conversation_core_chain(self) -> Runnable:
+        """Defines the conversation chain with prompt and bounded history, the session history is added by `_with_history`."""
         # Define the Chat Prompt Template
         with open(CONVERSE_SYS_PROMPT, 'r') as f:
-            _sys_prompt = f.read()
+            self._sys_prompt = f.read()
             prompt = ChatPromptTemplate.from_messages(
                 [
-                    ("system", _sys_prompt),
+                    ("system", self._sys_prompt),
                     MessagesPlaceholder(variable_name="history"), # This is where the chat history will be injected
                     ("user", "{input}"), # This is where the new user input will go
                 ]
             )
-        # Create the basic chain: Prompt -> Model -> Output Parser
-        _core_chain = prompt | self.llm | StrOutputParser()
-        # Add history management to the chain
+        # Create the basic chain: History policy -> Prompt -> Cache points -> Model -> Output Parser
+        _core_chain = (
+            RunnablePassthrough.assign(history=self.history_policy.as_runnable()) 
+            | prompt | self.prompt_cache.as_runnable() | self.chat_model | StrOutputParser()
+        )
+        return _core_chain
+
+    def get_rag_core_chain(self) -> Runnable:
+        """Defines the RAG conversation chain, the documents retrieved for the input are injected into the system prompt."""
+        with open(RAG_SYS_PROMPT, 'r') as f:
+            prompt = ChatPromptTemplate.from_messages(
+                [
+                    ("system", self._sys_prompt), 
+                    ("system", f.read()), # {context} receives the retrieved documents, after the cache point of the system prompt
+                    MessagesPlaceholder(variable_name="history"),
+                    ("user", "{input}"),
+                ]
+            )
+        # the history and the documents are fetched concurrently
+        _core_chain = (
+            RunnablePassthrough.assign(history=self.history_policy.as_runnable(), context=self.retriever.as_runnable()) 
+            | prompt | self.prompt_cache.as_runnable(history=False) | self.chat_model | StrOutputParser()
+        )
+        return _core_chain
+
+    def _with_history(self, core_chain):
+        """Adds the session history management and the metrics callbacks to a chain."""
         _chain_with_history = RunnableWithMessageHistory(
-            runnable=_core_chain, 
+            runnable=core_chain, 
             get_session_history=self.get_session_history, 
             input_messages_key="input", 
             history_messages_key="history",
         )
-        return _chain_with_history
+        # time the stages of the chain and count tokens
+        return _chain_with_history.with_config(callbacks=[MetricsCallbackHandler()])
+
+    def get_primary_llm(self) -> BaseChatModel:
+        """
+        Creates the primary model ('converse_engine'). With 'model_endpoints' enabled, the calls are
+        hedged and failed over across the equivalent endpoints listed there.
+        """
+        if not self._endpoints_config.get('enabled'):
+            return self._bedrock_chat_model(**self._engine_config)
+        _endpoints = [
+            self._bedrock_chat_model(**{**self._engine_config, **_endpoint}) 
+            for _endpoint in self._endpoints_config['endpoints']
+        ]
+        _names = [f"{_e.region_name}/{_e.model_id}" for _e in _endpoints]
+        return ResilientChatModel.from_config(self._endpoints_config, endpoints=_endpoints, endpoint_names=_names)
+
+    def _bedrock_chat_model(self, **model_config) -> BaseChatModel:
+        """Creates a Bedrock chat model, the Bedrock client stack is only imported here."""
+        from botocore.config import Config as BotoConfig
+        from src.bedrock_models import CancellableChatBedrockConverse
+        return CancellableChatBedrockConverse(
+            **model_config, 
+            config=BotoConfig(max_pool_connections=self.max_inflight)
+        )
+
+    def get_tiered_llm(self, tier_llms:Dict[str, BaseChatModel]):
+        """
+        Chat model of the chains: the primary model ('converse_engine'), with the tiers of the
+        'model_router' config as alternatives selected per turn through the `model_tier` field.
+        """
+        self.tier_llms: Dict[str, BaseChatModel] = {}
+        if self.router is None:
+            return self.llm
+        self.tier_llms = _alternatives = {
+            _tier: tier_llms.get(_tier) or self._build_tier_llm(_tier_config) 
+            for _tier, _tier_config in self._router_config['tiers'].items()
+        }
+        return self.llm.configurable_alternatives(
+            ConfigurableField(id="model_tier"), default_key="primary", **_alternatives
+        )
+
+    def _tier_models(self) -> Dict[str, str]:
+        """Config section of the model of each tier, the primary tier is 'converse_engine'."""
+        _tiers = self._router_config.get('tiers', {}) if self.router is not None else {}
+        return {"primary": "converse_engine", **{_tier: _tier_config['model'] for _tier, _tier_config in _tiers.items()}}
+
+    def _build_tier_llm(self, tier_config:dict) -> BaseChatModel:
+        """Creates the model of a tier from the config section it names, with the overrides of the tier."""
+        _model_config = get_service_config(self._config_path, tier_config['model'])
+        return self._bedrock_chat_model(
+            model_id=_model_config.get('model_id') or _model_config['modelId'], 
+            region_name=_model_config.get('region_name', self._engine_config['region_name']), 
+            temperature=tier_config.get('temperature', _model_config['temperature']), 
+            max_tokens=tier_config.get('max_tokens') or _model_config.get('max_tokens') or _model_config['maxTokens'], 
+        )
+
+    def get_summary_llm(self) -> BaseChatModel:
+        """Creates the cheap model used for history summaries from the 'content_generation_model' config."""
+        from langchain_aws import ChatBedrockConverse
+        return ChatBedrockConverse(
+            model_id=self._summary_model_config['modelId'], 
+            region_name=self._engine_config['region_name'], 
+            temperature=self._summary_model_config['temperature'], 
+            max_tokens=self._summary_model_config['maxTokens'], 
+        )
+
+    def get_embeddings(self) -> Optional[Embeddings]:
+        """Creates the embedding model selected by the 'rag' config, if the retrieval or the semantic cache needs one."""
+        if not (self._rag_config.get('enabled') or self._cache_config.get('semantic', {}).get('enabled')):
+            return None
+        return self._query_embeddings(self._rag_config['embedding_model'])
+
+    def _query_embeddings(self, model_key:str) -> Embeddings:
+        """Creates the model of a 'RAG_embedding_model' entry embedding queries, also when given a batch."""
+        from src.bedrock_models import bedrock_embeddings
+        return bedrock_embeddings(self._embedding_model_config[model_key], self._engine_config['region_name'], queries=True)
+
+    def get_batching_embeddings(self, embeddings:Optional[Embeddings], with_fallback:bool=True) -> Optional[Embeddings]:
+        """
+        Batches the query embeddings of the concurrent turns with 'embedding_batcher' enabled. The batches
+        fail over to the `fallback_model` entry of 'RAG_embedding_model' if it is the same model as the
+        one of the 'rag' config, vectors of another model could not be compared with the index.
+        """
+        if embeddings is None or not self._embedding_batcher_config.get('enabled'):
+            return embeddings
+        _fallback = None
+        _fallback_key = self._embedding_batcher_config.get('fallback_model')
+        _model_key = self._rag_config['embedding_model']
+        if with_fallback and _fallback_key and _fallback_key != _model_key:
+            if self._embedding_model_config[_fallback_key]['modelId'] == self._embedding_model_config[_model_key]['modelId']:
+                _fallback = self._query_embeddings(_fallback_key)
+            else:
+                self.logger.warning(f"Embedding model '{_fallback_key}' differs from '{_model_key}', it is not used as fallback.")
+        return BatchingEmbeddings(self._embedding_batcher_config, embeddings, logger=self.logger, fallback=_fallback)
+
+    def get_retriever(self) -> Optional[Retriever]:
+        """Maps the RAG index built by `python -m src.rag_ingest`, the chunks are looked up per turn."""
+        if not self._rag_config.get('enabled'):
+            return None
+        _index = VectorIndex(
+            RAG_INDEX, 
+            self.logger, 
+            reload_interval=self._rag_config.get('reload_interval', 30), 
+            query_model_id=self._embedding_model_config[self._rag_config['embedding_model']]['modelId']
+        )
+        if not len(_index):
+            self.logger.warning(f"RAG index {RAG_INDEX} is empty, run `python -m src.rag_ingest` to build it.")
+        return Retriever(self._rag_config, index=_index, embeddings=self.embeddings, logger=self.logger)
+
+    def get_response_cache(self) -> Optional[ResponseCache]:
+        """Creates the response cache, scoped to the current system prompt and model config."""
+        if not self._cache_config.get('enabled'):
+            return None
+        _fingerprint = hashlib.sha256(
+            (self._sys_prompt + json.dumps([self._engine_config, self._router_config], sort_keys=True)).encode()
+        ).hexdigest()[:16]
+        _embeddings = self.embeddings if self._cache_config.get('semantic', {}).get('enabled') else None
+        return ResponseCache(
+            self._cache_config, 
+            fingerprint=_fingerprint, 
+            async_redis_client=self._redis_pool.async_client, 
+            logger=self.logger, 
+            embeddings=_embeddings
+        )
+
+    def get_session_lifecycle(self) -> Optional[SessionLifecycle]:
+        if not self._session_lifecycle_config.get('enabled'):
+            return None
+        _store_prefix = self._history_store_config['key_prefix']
+        return SessionLifecycle(
+            self._session_lifecycle_config, 
+            redis_client=self._redis_pool.client, 
+            async_redis_client=self._redis_pool.async_client, 
+            logger=self.logger, 
+            # every key of a session: messages, version, summary, legacy copy
+            key_patterns=[(_store_prefix, ""), (_store_prefix, ":v"), (self.history_policy.key_prefix, ":summary")] + (
+                [(self._history_store_config['legacy_prefix'], "")] if self._history_store_config.get('legacy_prefix') else []
+            ), 
+            ttl=self._redis_config['ttl']
+        )
 
     def get_session_history(self, session_id: str) -> BaseChatMessageHistory:
         """Gets or creates a chat message history for a given session ID."""
-        return RedisChatMessageHistory(session_id, url=self._redis_url, ttl=self._redis_config['ttl'])
+        return CompactRedisChatMessageHistory(
+            session_id, 
+            redis_client=self._redis_pool.client, 
+            async_redis_client=self._redis_pool.async_client, 
+            key_prefix=self._history_store_config['key_prefix'], 
+            ttl=self._redis_config['ttl'], 
+            tail_messages=self._history_store_config.get('tail_messages'), 
+            compress_threshold=self._history_store_config.get('compress_threshold', 512), 
+            legacy_prefix=self._history_store_config.get('legacy_prefix'), 
+            cache=self.session_cache, 
+            lifecycle=self.session_lifecycle
+        )
 
     def _verify_redis(self):
         """verify the existence of Redis database"""
         try:
-            r = redis.Redis(
-                host=self._redis_config['host'], 
-                port=self._redis_config['port'], 
-                db=self._redis_config['db'], 
-                socket_connect_timeout=1
-            )
-            r.ping()
+            self._redis_pool.ping()
             self.logger.info("Successfully connected to Redis server.")
         except redis.exceptions.ConnectionError as e:
             raise AppInitializationError(f"Could not connect to Redis server: {e}")
         except redis.exceptions.RedisError as e:
             raise UndefinedDatabaseError(f"An error occurred with Redis: {e}")
 
+    @property
+    def async_redis_client(self):
+        """Asyncio Redis client of the engine's shared pool."""
+        return self._redis_pool.async_client
+
     @property
     def _redis_url(self):
-        return f"redis://{self._redis_config['host']}:{self._redis_config['port']}/{self._redis_config['db']} "
+        return f"redis://{self._redis_config['host']}:{self._redis_config['port']}/{self._redis_config['db']}"
 
     def chat(self, input:str, session_id:str) -> Union[None, str]:
         """
         Start or continue (if session_id is provided) a conversation
         """
-        config: RunnableConfig = {"configurable": {"session_id":session_id}}
         # validate user input and chat session
         if not input.strip():
             return
+        config = self._turn_config(input, session_id)
         # Invoke the conversation chain with the user input and session config
         _response = self.chain.invoke({"input": input}, config=config)
         return _response
 
+    async def achat(self, input:str, session_id:str, rag:bool=False) -> Union[None, str]:
+        """
+        Asynchronous version of `chat`, awaits the chain and the Redis history natively.
+        The number of concurrent Bedrock calls is capped by `max_inflight_requests`.
+        With `rag`, the reply is grounded on the documents retrieved from the RAG index.
+        """
+        # validate user input and chat session
+        if not input.strip():
+            return
+        config = self._turn_config(input, session_id)
+        _chain = self._select_chain(rag)
+        _history = self.get_session_history(session_id)
+        if self.session_lifecycle is not None:
+            await self.session_lifecycle.acheck(session_id)
+        # answer repeated questions from the cache
+        _first_turn = await self._afirst_turn(_history, rag)
+        _cached, _cacheable = await self._alookup_cache(input, _first_turn, rag)
+        if _cached is not None:
+            await _history.aadd_messages([HumanMessage(input), AIMessage(_cached)])
+            self._archive(session_id, input, _cached, config, rag, "cache")
+            return _cached
+        # share the model call with the identical first turns in flight
+        if self._coalescible(_first_turn):
+            _response = "".join([_t async for _t in self._acoalesced_stream(input, config, rag, _cacheable)])
+            await _history.aadd_messages([HumanMessage(input), AIMessage(_response)])
+            self._archive(session_id, input, _response, config, rag)
+            return _response
+        # Invoke the conversation chain without holding a worker thread while waiting
+        async with self._inflight:
+            _response = await _chain.ainvoke({"input": input}, config=config)
+        if _cacheable:
+            await self.response_cache.aset(input, _response)
+        self._archive(session_id, input, _response, config, rag)
+        return _response
+
+    async def astream_chat(self, input:str, session_id:str, rag:bool=False) -> AsyncIterator[str]:
+        """
+        Streams the reply of the conversation token by token, the full reply is written to the
+        session history once the generation completes. Closing or cancelling the iterator before
+        that cancels the upstream generation, and the unfinished turn is not recorded.
+        """
+        # validate user input and chat session
+        if not input.strip():
+            return
+        config = self._turn_config(input, session_id)
+        _chain = self._select_chain(rag)
+        _history = self.get_session_history(session_id)
+        if self.session_lifecycle is not None:
+            await self.session_lifecycle.acheck(session_id)
+        # answer repeated questions from the cache, in a single chunk
+        _first_turn = await self._afirst_turn(_history, rag)
+        _cached, _cacheable = await self._alookup_cache(input, _first_turn, rag)
+        if _cached is not None:
+            await _history.aadd_messages([HumanMessage(input), AIMessage(_cached)])
+            self._archive(session_id, input, _cached, config, rag, "cache")
+            yield _cached
+            return
+        _reply = []
+        # fan out the stream of an identical first turn in flight
+        if self._coalescible(_first_turn):
+            _stream = self._acoalesced_stream(input, config, rag, _cacheable)
+            try:
+                async for _token in _stream:
+                    _reply.append(_token)
+                    yield _token
+            finally:
+                await _stream.aclose()
+            await _history.aadd_messages([HumanMessage(input), AIMessage("".join(_reply))])
+            self._archive(session_id, input, "".join(_reply), config, rag)
+            return
+        async with self._inflight:
+            _stream = _chain.astream({"input": input}, config=config)
+            try:
+                async for _token in _stream:
+                    if _token:
+                        _reply.append(_token)
+                        yield _token
+            finally:
+                await _stream.aclose()
+        if _cacheable:
+            await self.response_cache.aset(input, "".join(_reply))
+        self._archive(session_id, input, "".join(_reply), config, rag)
+
+    def _archive(self, session_id:str, input:str, reply:str, config:RunnableConfig, rag:bool, source:str="model"):
+        """Hands a completed turn to the archiver, which never delays the reply."""
+        if self.archiver is not None:
+            self.archiver.submit(session_id, input, reply, config["configurable"].get("model_tier"), rag, source)
+
+    async def _afirst_turn(self, history:CompactRedisChatMessageHistory, rag:bool) -> bool:
+        """
+        Whether the turn opens its session, read once per turn for the response cache and the coalescing.
+        False without reading the session when neither depends on it.
+        """
+        _cache = self.response_cache is not None and not rag and self.response_cache.first_turn_only
+        if not (_cache or self.coalescer is not None):
+            return False
+        return await history.alen() == 0
+
+    def _coalescible(self, first_turn:bool) -> bool:
+        """Whether the turn may share its model call: only first turns, whose prompt has no history."""
+        return self.coalescer is not None and first_turn
+
+    def _acoalesced_stream(self, input:str, config:RunnableConfig, rag:bool, cacheable:bool) -> AsyncIterator[str]:
+        """
+        Streams the reply of a first turn from the call shared by the identical first turns in flight,
+        keyed by the query, the model tier and the chain. The caller records the turn in its session.
+        """
+        _tier = config["configurable"].get("model_tier", "primary")
+        _key = hashlib.sha256(json.dumps([input, _tier, rag]).encode()).hexdigest()
+        # the shared call runs without the session of the caller that started it
+        _config: RunnableConfig = {"configurable": {"model_tier": _tier}, "metadata": config.get("metadata", {})}
+        _chain = (self._rag_core_chain if rag else self._core_chain).with_config(callbacks=[MetricsCallbackHandler()])
+        async def _astream():
+            _reply = []
+            async with self._inflight:
+                async for _token in _chain.astream({"input": input, "history": []}, config=_config):
+                    if _token:
+                        _reply.append(_token)
+                        yield _token
+            if cacheable:
+                await self.response_cache.aset(input, "".join(_reply))
+        return self.coalescer.asubscribe(_key, _astream)
+
+    def _turn_config(self, input:str, session_id:str) -> RunnableConfig:
+        """Run config of a chat turn, with the model tier picked by the router."""
+        config: RunnableConfig = {"configurable": {"session_id":session_id}}
+        if self.router is not None:
+            _tier, _rule = self.router.route(input)
+            config["configurable"]["model_tier"] = _tier
+            # labels the metrics of the model call
+            config["metadata"] = {"model_tier": _tier}
+            self.logger.debug(f"Routed turn of session {session_id} to the {_tier} tier (rule {_rule}).")
+        return config
+
+    def _select_chain(self, rag:bool):
+        if not rag:
+            return self.chain
+        if self.rag_chain is None:
+            raise InvalidRequestError("RAG chat is not enabled.")
+        return self.rag_chain
+
+    async def _alookup_cache(self, input:str, first_turn:bool, rag:bool=False) -> tuple:
+        """
+        Looks up the response cache, returns the cached reply (None on a miss) and whether the
+        reply generated for this turn may be cached. RAG replies depend on the index and are not cached.
+        """
+        if self.response_cache is None or rag:
+            return None, False
+        if self.response_cache.first_turn_only and not first_turn:
+            return None, False
+        return await self.response_cache.aget(input), True
+
+    async def awarmup(self):
+        """
+        Warms up the engine ahead of the first requests, the steps run concurrently and are timed as
+        start-up phases: the Redis connections, the model clients (credentials, TLS connections) with a
+        one-token call per endpoint, the pages of the RAG index, the archiver and the session sweeper.
+        """
+        async def _timed(name, step):
+            with STARTUP.phase(f"warmup.{name}", profile=False):
+                await step
+        _steps = [_timed("redis", self._awarm_redis())]
+        if self._runtime_config.get('prime_llm', True):
+            _steps.append(_timed("llm", self._aprime_llm()))
+        if self.retriever is not None:
+            _steps.append(_timed("rag_index", asyncio.get_running_loop().run_in_executor(None, self.retriever.index.warm)))
+        if self.archiver is not None:
+            _steps.append(_timed("archive", self.archiver.astart()))
+        if self.session_lifecycle is not None:
+            _steps.append(_timed("session_lifecycle", self.session_lifecycle.astart()))
+        await asyncio.gather(*_steps)
+
+    async def _awarm_redis(self):
+        _connections = min(8, self._redis_config.get('max_connections', 8))
+        await asyncio.gather(*[self._redis_pool.aping() for _ in range(_connections)])
+        self.logger.info(f"Warmed up {_connections} Redis connections.")
+
+    async def _aprime_llm(self):
+        """Sends a one-token call to every endpoint and tier of the chat model, a failure is only logged."""
+        _models = list(getattr(self.llm, 'endpoints', None) or [self.llm]) + list(self.tier_llms.values())
+        async def _aprime(model):
+            try:
+                await model.ainvoke("Hi", max_tokens=1)
+            except Exception as e:
+                self.logger.warning(f"Failed to prime {getattr(model, 'model_id', type(model).__name__)}. Error: {e}.")
+        await asyncio.gather(*[_aprime(m) for m in _models])
+        self.logger.info(f"Primed {len(_models)} chat model clients.")
+
+    async def aclose(self):
+        """Releases the connections held by the engine, after the archiver flushed its queue."""
+        if self.archiver is not None:
+            await self.archiver.aclose()
+        if self.session_lifecycle is not None:
+            await self.session_lifecycle.aclose()
+        await self._redis_pool.aclose()
+
     def start_chat(self):
         """
         Starts an interactive chat session in terminal to test the conversation capability.
@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the Redis backed chat message histories used by the chat engines
+"""
+import json
+from typing import TYPE_CHECKING, List, Optional, Sequence
+import zlib
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+import msgpack
+import redis
+import redis.asyncio as aioredis
+# project imports
+from src.utils.metrics import stage_timer
+
+if TYPE_CHECKING:
+    from src.session_cache import SessionCache
+    from src.session_lifecycle import SessionLifecycle
+
+
+def _decode_legacy(items: List[bytes]) -> List[BaseMessage]:
+    """Messages of a session of the legacy layout of langchain_community's RedisChatMessageHistory."""
+    # JSON encoded messages pushed to the head of the list, newest first
+    return messages_from_dict([json.loads(m) for m in items[::-1]])
+
+
+class CompactRedisChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat message history stored compactly in a Redis list, of which each turn only reads the tail.
+    - Messages are appended with RPUSH (oldest first) as msgpack arrays [type, content, extras], where
+      extras only holds the fields a prompt needs (e.g. tool calls). The response metadata, usage and
+      ids of the JSON layout are dropped. Encodings longer than `compress_threshold` bytes are zlib
+      compressed, the first byte of each item tells which.
+    - Reads fetch the newest `tail_messages` messages with the length of the list in the same round
+      trip, `offset` is then the index of the first message read in the whole session.
+    - Appends and the TTL refresh are pipelined into one round trip.
+    - Sessions still stored in the legacy layout (LPUSH of JSON messages) under `legacy_prefix` are
+      converted on their first read and the legacy key is deleted, in a transaction watching both keys
+      so that concurrent first reads convert a session once.
+    - With a `cache`, every append increments the version counter of the session, and a turn reading
+      a session whose version matches the cached tail only reads the counter. Appends write through.
+    - With a `lifecycle`, every append also records the activity and the size of the session in its
+      index and refreshes the expiry of every key of the session, in the same round trip.
+
+    Attributes:
+        session_id (str): Id of the conversation session
+        redis_client (redis.Redis): Synchronous client, used by the blocking methods
+        async_redis_client (redis.asyncio.Redis): Asynchronous client, used by the async methods
+        key_prefix (str): Prefix of the Redis key that holds the messages
+        ttl (int): Expiry of the session in seconds, refreshed on every write
+        tail_messages (int): Number of newest messages read per turn, all of them when None
+        compress_threshold (int): Size in bytes above which an encoded message is compressed
+        legacy_prefix (str): Key prefix of the sessions to migrate, None to skip the migration
+        cache (SessionCache): In-process cache of the session tails, shared by the histories of a worker
+        lifecycle (SessionLifecycle): Index and bounds of the sessions stored in Redis
+        offset (int): Index in the session of the first message of the last read
+    """
+    _RAW, _ZLIB = b"\x00", b"\x01"
+    # fields of the messages kept besides the type and the content
+    _EXTRA_FIELDS = ("name", "tool_calls", "tool_call_id")
+
+    def __init__(
+        self,
+        session_id: str,
+        redis_client: redis.Redis,
+        async_redis_client: aioredis.Redis,
+        key_prefix: str = "history:",
+        ttl: Optional[int] = None,
+        tail_messages: Optional[int] = None,
+        compress_threshold: int = 512,
+        legacy_prefix: Optional[str] = "message_store:",
+        cache: Optional["SessionCache"] = None,
+        lifecycle: Optional["SessionLifecycle"] = None,
+    ):
+        self.session_id = session_id
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.tail_messages = tail_messages
+        self.compress_threshold = compress_threshold
+        self.legacy_prefix = legacy_prefix
+        self.cache = cache
+        self.lifecycle = lifecycle
+        self.offset = 0
+
+    @property
+    def key(self) -> str:
+        return self.key_prefix + self.session_id
+
+    @property
+    def version_key(self) -> str:
+        return self.key + ":v"
+
+    @property
+    def legacy_key(self) -> Optional[str]:
+        return self.legacy_prefix + self.session_id if self.legacy_prefix else None
+
+    def _encode(self, message: BaseMessage) -> bytes:
+        _data = message_to_dict(message)['data']
+        _extras = {f: _data[f] for f in self._EXTRA_FIELDS if _data.get(f)}
+        _packed = msgpack.packb([message.type, message.content, _extras] if _extras else [message.type, message.content])
+        if len(_packed) > self.compress_threshold:
+            return self._ZLIB + zlib.compress(_packed)
+        return self._RAW + _packed
+
+    def _decode(self, items: List[bytes]) -> List[BaseMessage]:
+        _dicts = []
+        for item in items:
+            _packed = zlib.decompress(item[1:]) if item[:1] == self._ZLIB else item[1:]
+            _type, _content, *_extras = msgpack.unpackb(_packed)
+            _dicts.append({"type": _type, "data": {"content": _content, **(_extras[0] if _extras else {})}})
+        return messages_from_dict(_dicts)
+
+    def _read(self, pipe) -> None:
+        """
+        Queues the commands of a read: length of the session, its tail, its version and remaining
+        lifetime, and whether a legacy copy exists.
+        """
+        pipe.llen(self.key)
+        pipe.lrange(self.key, -self.tail_messages if self.tail_messages else 0, -1)
+        pipe.get(self.version_key)
+        pipe.pttl(self.key)
+        if self.legacy_key:
+            pipe.exists(self.legacy_key)
+
+    def _parse_read(self, results: list) -> List[BaseMessage]:
+        _length, _items, _version, _pttl = results[:4]
+        self.offset = _length - len(_items)
+        messages = self._decode(_items)
+        if self.cache is not None and _length:
+            self.cache.put(self.session_id, int(_version or 0), self.offset, messages, _pttl / 1000 if _pttl > 0 else None)
+        return messages
+
+    def _cached(self, version: Optional[bytes]) -> Optional[List[BaseMessage]]:
+        _hit = self.cache.get(self.session_id, int(version or 0))
+        if _hit is None:
+            return None
+        self.offset, messages = _hit
+        return messages
+
+    def _migration(self, pipe, legacy_items: List[bytes]) -> List[BaseMessage]:
+        """Queues the conversion of a legacy session, returns its messages."""
+        messages = _decode_legacy(legacy_items)
+        pipe.delete(self.legacy_key)
+        if messages:
+            self._append(pipe, messages)
+        return messages
+
+    def _migrate(self) -> Optional[List[BaseMessage]]:
+        """Converts the legacy session, returns its messages, or None if another reader converted it first."""
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key, self.legacy_key)
+                    if pipe.llen(self.key):
+                        return None
+                    _items = pipe.lrange(self.legacy_key, 0, -1)
+                    pipe.multi()
+                    messages = self._migration(pipe, _items)
+                    pipe.execute()
+                    return messages
+                except redis.WatchError:
+                    continue
+
+    async def _amigrate(self) -> Optional[List[BaseMessage]]:
+        """Converts the legacy session, returns its messages, or None if another reader converted it first."""
+        async with self.async_redis_client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self.key, self.legacy_key)
+                    if await pipe.llen(self.key):
+                        return None
+                    _items = await pipe.lrange(self.legacy_key, 0, -1)
+                    pipe.multi()
+                    messages = self._migration(pipe, _items)
+                    await pipe.execute()
+                    return messages
+                except redis.WatchError:
+                    continue
+
+    def _tail(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        _start = max(0, len(messages) - self.tail_messages) if self.tail_messages else 0
+        self.offset = _start
+        return messages[_start:]
+
+    def _append(self, pipe, messages: Sequence[BaseMessage]) -> None:
+        _items = [self._encode(m) for m in messages]
+        pipe.rpush(self.key, *_items)
+        pipe.incr(self.version_key)
+        if self.lifecycle is not None:
+            self.lifecycle.touch(pipe, self.session_id, len(_items), sum(len(i) for i in _items))
+        elif self.ttl:
+            pipe.expire(self.key, self.ttl)
+            pipe.expire(self.version_key, self.ttl)
+
+    def _appended(self, messages: Sequence[BaseMessage], results: list) -> None:
+        """Writes an append through to the cache, `results` are those of the pipeline of `_append`."""
+        if self.cache is not None:
+            self.cache.append(self.session_id, results[1], messages, self.tail_messages, self.ttl)
+
+    # ---------------------------------- blocking API ----------------------------------
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if self.cache is not None:
+            _messages = self._cached(self.redis_client.get(self.version_key))
+            if _messages is not None:
+                return _messages
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._read(pipe)
+        _results = pipe.execute()
+        if _results[0] or not (self.legacy_key and _results[4]):
+            return self._parse_read(_results)
+        messages = self._migrate()
+        if messages is None:
+            pipe = self.redis_client.pipeline(transaction=False)
+            self._read(pipe)
+            return self._parse_read(pipe.execute())
+        return self._tail(messages)
+
+    def get_range(self, start: int, end: int) -> List[BaseMessage]:
+        """Returns the messages of the session from index `start` to `end` (excluded)."""
+        if end <= start:
+            return []
+        return self._decode(self.redis_client.lrange(self.key, start, end - 1))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._append(pipe, messages)
+        self._appended(messages, pipe.execute())
+
+    def clear(self) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(self.session_id)
+        if self.lifecycle is not None:
+            self.lifecycle.forget(self.session_id)
+        else:
+            self.redis_client.delete(*[k for k in (self.key, self.version_key, self.legacy_key) if k])
+
+    # ---------------------------------- asyncio API -----------------------------------
+    async def aget_messages(self) -> List[BaseMessage]:
+        with stage_timer("history_load"):
+            if self.cache is not None:
+                _messages = self._cached(await self.async_redis_client.get(self.version_key))
+                if _messages is not None:
+                    return _messages
+            pipe = self.async_redis_client.pipeline(transaction=False)
+            self._read(pipe)
+            _results = await pipe.execute()
+            if _results[0] or not (self.legacy_key and _results[4]):
+                return self._parse_read(_results)
+            messages = await self._amigrate()
+            if messages is None:
+                pipe = self.async_redis_client.pipeline(transaction=False)
+                self._read(pipe)
+                return self._parse_read(await pipe.execute())
+            return self._tail(messages)
+
+    async def aget_range(self, start: int, end: int) -> List[BaseMessage]:
+        """Returns the messages of the session from index `start` to `end` (excluded)."""
+        if end <= start:
+            return []
+        return self._decode(await self.async_redis_client.lrange(self.key, start, end - 1))
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if not messages:
+            return
+        with stage_timer("history_write"):
+            pipe = self.async_redis_client.pipeline(transaction=False)
+            self._append(pipe, messages)
+            self._appended(messages, await pipe.execute())
+
+    async def alen(self) -> int:
+        """Returns the number of messages in the session, including a legacy copy not migrated yet."""
+        pipe = self.async_redis_client.pipeline(transaction=False)
+        pipe.llen(self.key)
+        if self.legacy_key:
+            pipe.llen(self.legacy_key)
+        return sum(await pipe.execute())
+
+    async def aclear(self) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(self.session_id)
+        if self.lifecycle is not None:
+            await self.lifecycle.aforget(self.session_id)
+        else:
+            await self.async_redis_client.delete(*[k for k in (self.key, self.version_key, self.legacy_key) if k])
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the single-flight coalescing of identical in-flight model calls
+"""
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional
+# project imports
+from src.utils.metrics import COALESCED_CALLS, COALESCE_FLIGHTS
+
+
+class _Flight():
+    """A shared upstream call, the chunks it produced so far and its outcome."""
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # replaced by a new event every time the flight progresses
+        self.progress = asyncio.Event()
+
+    def notify(self):
+        _progress, self.progress = self.progress, asyncio.Event()
+        _progress.set()
+
+
+class SingleFlight():
+    """
+    Shares one upstream call between the concurrent callers asking for the same key. The first caller
+    starts the call in a task of its own, the others subscribe to it: each subscriber receives every
+    chunk from the start, the ones joining late are replayed the chunks produced before they joined.
+    The call is cancelled once all of its subscribers left, and forgotten once it completed, so that
+    only concurrent callers are coalesced.
+    """
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def asubscribe(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Streams the chunks of the in-flight call of `key`, starting it with `factory` if there is none."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._arun(key, flight, factory))
+            COALESCE_FLIGHTS.inc()
+        else:
+            COALESCED_CALLS.inc()
+        flight.subscribers += 1
+        try:
+            _next = 0
+            while True:
+                while _next < len(flight.chunks):
+                    yield flight.chunks[_next]
+                    _next += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.progress.wait()
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    async def _arun(self, key: str, flight: _Flight, factory: Callable[[], AsyncIterator[str]]):
+        try:
+            async for _chunk in factory():
+                flight.chunks.append(_chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self._forget(key, flight)
+            flight.notify()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
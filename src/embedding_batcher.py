@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the micro-batching of the query embeddings requested by concurrent chat turns
+"""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Set
+from langchain_core.embeddings import Embeddings
+# project imports
+from src.utils.metrics import EMBEDDING_BATCH_SIZE, EMBEDDING_CALLS, EMBEDDING_REQUESTS
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embeddings shared by the retrieval and the semantic response cache, batching the queries of the
+    concurrent chat turns into one upstream call, which the Cohere embed API accepts up to 96 texts:
+    - a query waits at most `max_wait_ms` for the batch to fill, a full batch of `max_batch` texts
+      is sent at once,
+    - identical texts waiting or in flight share one slot of the batch,
+    - the vectors of the recent texts are kept in an LRU keyed by the hash of the text,
+    - a batch failing on the model is sent to the `fallback` model, which must embed into the same
+      vector space as the index (e.g. the same model in another region).
+    The batches are sent through `embed_documents` of the wrapped models, which therefore must embed
+    queries (e.g. Cohere models with `input_type: search_query`).
+
+    Attributes:
+        embeddings (Embeddings): Model of the batches
+        fallback (Embeddings): Model of the batches the first model failed, None to fail them
+        max_batch (int): Maximum number of texts per upstream call
+        max_wait (float): Seconds a query waits for its batch to fill
+        lru_size (int): Number of vectors kept for the recent texts
+    """
+    def __init__(self, batcher_config: dict, embeddings: Embeddings, logger: logging.Logger, fallback: Optional[Embeddings] = None):
+        self.embeddings = embeddings
+        self.fallback = fallback
+        self.logger = logger
+        self.max_batch = batcher_config.get('max_batch', 96)
+        self.max_wait = batcher_config.get('max_wait_ms', 5) / 1000
+        self.lru_size = batcher_config.get('lru_size', 4096)
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        # the blocking methods run on executor threads
+        self._lock = threading.Lock()
+        # texts of the next batch, and of the batches in flight, by key
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._texts: Dict[str, str] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    # ---------------------------------- Embeddings interface ----------------------------------
+    def embed_query(self, text: str) -> List[float]:
+        """Blocking version, looks up the LRU but calls the model alone."""
+        _key = self.key(text)
+        _vector = self._lookup(_key)
+        if _vector is None:
+            _vector = self._embed_batch([text])[0]
+            self._remember(_key, _vector)
+        return _vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        _key = self.key(text)
+        _vector = self._lookup(_key)
+        if _vector is not None:
+            return _vector
+        _future = self._pending.get(_key) or self._inflight.get(_key)
+        if _future is None:
+            _future = self._enqueue(_key, text)
+        else:
+            EMBEDDING_REQUESTS.labels("dedup").inc()
+        # a caller leaving must not fail the other callers of the text
+        return list(await asyncio.shield(_future))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*[self.aembed_query(t) for t in texts]))
+
+    # ---------------------------------- batching ----------------------------------
+    def _enqueue(self, key: str, text: str) -> asyncio.Future:
+        _loop = asyncio.get_running_loop()
+        _future = self._pending[key] = _loop.create_future()
+        # marks the error as retrieved when every caller left
+        _future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._texts[key] = text
+        EMBEDDING_REQUESTS.labels("batched").inc()
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = _loop.call_later(self.max_wait, self._flush)
+        return _future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        _batch, self._pending = self._pending, {}
+        _texts, self._texts = self._texts, {}
+        self._inflight.update(_batch)
+        _task = asyncio.create_task(self._arun(_batch, _texts))
+        self._tasks.add(_task)
+        _task.add_done_callback(self._tasks.discard)
+
+    async def _arun(self, batch: Dict[str, asyncio.Future], texts: Dict[str, str]):
+        EMBEDDING_BATCH_SIZE.observe(len(batch))
+        try:
+            _vectors = await asyncio.get_running_loop().run_in_executor(None, self._embed_batch, list(texts.values()))
+        except Exception as e:
+            for _future in batch.values():
+                if not _future.done():
+                    _future.set_exception(e)
+        else:
+            for (_key, _future), _vector in zip(batch.items(), _vectors):
+                self._remember(_key, _vector)
+                if not _future.done():
+                    _future.set_result(_vector)
+        finally:
+            for _key in batch:
+                self._inflight.pop(_key, None)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embeds the texts in one call of the model, on the fallback model if it fails."""
+        try:
+            _vectors = self.embeddings.embed_documents(texts)
+            EMBEDDING_CALLS.labels("primary", "success").inc()
+            return _vectors
+        except Exception as e:
+            EMBEDDING_CALLS.labels("primary", "failure").inc()
+            if self.fallback is None:
+                raise
+            self.logger.warning(f"Failed to embed {len(texts)} texts, retrying on the fallback model. Error: {e}.")
+        try:
+            _vectors = self.fallback.embed_documents(texts)
+            EMBEDDING_CALLS.labels("fallback", "success").inc()
+            return _vectors
+        except Exception:
+            EMBEDDING_CALLS.labels("fallback", "failure").inc()
+            raise
+
+    # ---------------------------------- LRU ----------------------------------
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            _vector = self._lru.get(key)
+            if _vector is None:
+                return None
+            self._lru.move_to_end(key)
+        EMBEDDING_REQUESTS.labels("hit").inc()
+        return list(_vector)
+
+    def _remember(self, key: str, vector: List[float]):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"cached": len(self._lru), "pending": len(self._pending), "inflight": len(self._inflight)}
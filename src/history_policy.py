@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the history policy that bounds the conversation history injected into prompts
+"""
+import asyncio
+import logging
+from typing import Awaitable, Dict, List, Optional, Tuple
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+import redis
+import redis.asyncio as aioredis
+
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", "You maintain a running summary of a conversation between a user and an AI assistant. "
+                   "Keep every fact, name and preference the user shared, drop greetings and filler. "
+                   "Reply with the updated summary only, in at most {max_words} words."),
+        ("user", "Current summary:\n{summary}\n\nNew conversation lines:\n{lines}\n\nUpdated summary:"),
+    ]
+)
+
+
+class HistoryPolicy():
+    """
+    Bounds the history injected into the prompt. The newest messages that fit a token budget are kept
+    verbatim, the older ones are folded into a running summary by a cheap model. The summary is
+    computed incrementally in the background and stored next to the session in Redis, so the chat
+    reply never waits for it.
+
+    Attributes:
+        max_history_tokens (int): Token budget of the verbatim history window
+        summary_batch_messages (int): Number of messages that must fall out of the window before
+            the summary is updated
+        summary_max_words (int): Length limit given to the summarizer
+        window_step (int): The window start only moves by this many messages at a time, so that the
+            history stays a stable prefix of the prompts between the moves, for the prompt cache
+    """
+    def __init__(
+        self,
+        policy_config: dict,
+        summary_llm: BaseChatModel,
+        redis_client: redis.Redis,
+        async_redis_client: aioredis.Redis,
+        logger: logging.Logger,
+        key_prefix: str = "message_store:",
+        ttl: Optional[int] = None,
+    ):
+        self.max_history_tokens = policy_config['max_history_tokens']
+        self.summary_batch_messages = policy_config.get('summary_batch_messages', 6)
+        self.summary_max_words = policy_config.get('summary_max_words', 200)
+        self.window_step = max(1, policy_config.get('window_step', 1))
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self.logger = logger
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self._summary_chain = SUMMARY_PROMPT | summary_llm | StrOutputParser()
+        # background summarization tasks, at most one per session
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def summary_key(self, session_id: str) -> str:
+        return f"{self.key_prefix}{session_id}:summary"
+
+    @staticmethod
+    def count_tokens(message: BaseMessage) -> int:
+        """Approximates the token count of a message (~4 characters per token plus overhead)."""
+        return len(message.text()) // 4 + 4
+
+    def window_start(self, messages: List[BaseMessage], offset: int = 0) -> int:
+        """
+        Returns the index of the oldest message of the newest window that fits the token budget.
+        The window always starts at a user message so that turns are never split, and at a multiple of
+        `window_step` in the session, `offset` being the index of `messages[0]` in the session.
+        """
+        _budget = self.max_history_tokens
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            _budget -= self.count_tokens(messages[i])
+            if _budget < 0:
+                break
+            start = i
+        if offset + start and self.window_step > 1:
+            start = min(len(messages), -(-(offset + start) // self.window_step) * self.window_step - offset)
+        while start < len(messages) and not isinstance(messages[start], HumanMessage):
+            start += 1
+        return start
+
+    def as_runnable(self) -> RunnableLambda:
+        """Runnable mapping the chain inputs to the bounded history, for use in RunnablePassthrough.assign."""
+        return RunnableLambda(self.build_history, afunc=self.abuild_history, name="HistoryPolicy")
+
+    # ---------------------------------- prompt history ----------------------------------
+    def build_history(self, inputs: dict, config: RunnableConfig) -> List[BaseMessage]:
+        """Blocking version of `abuild_history`, uses the stored summary without updating it."""
+        messages = inputs['history']
+        start = self.window_start(messages, self._offset(config))
+        if self._offset(config) + start == 0:
+            return messages
+        summary, _ = self._parse_summary(self.redis_client.hgetall(self.summary_key(self._session_id(config))))
+        return self._with_summary(summary, messages[start:])
+
+    async def abuild_history(self, inputs: dict, config: RunnableConfig) -> List[BaseMessage]:
+        messages = inputs['history']
+        # the history may hold only the tail of the session, the summary offsets count from its start
+        offset = self._offset(config)
+        start = self.window_start(messages, offset)
+        if offset + start == 0:
+            return messages
+        session_id = self._session_id(config)
+        summary, covered = self._parse_summary(await self.async_redis_client.hgetall(self.summary_key(session_id)))
+        # fold the messages that left the window into the summary once enough have accumulated
+        if offset + start - covered >= self.summary_batch_messages and session_id not in self._pending:
+            _task = asyncio.create_task(
+                self._aupdate_summary(session_id, summary, self._aleft_window(config, messages, offset, covered, start), offset + start)
+            )
+            self._pending[session_id] = _task
+            _task.add_done_callback(lambda t: self._pending.pop(session_id, None))
+        return self._with_summary(summary, messages[start:])
+
+    @staticmethod
+    async def _aleft_window(config: RunnableConfig, messages: List[BaseMessage], offset: int, covered: int, start: int) -> List[BaseMessage]:
+        """Messages not covered by the summary that left the window, read back from the session if they precede the tail."""
+        if covered >= offset:
+            return messages[covered - offset:start]
+        _older = await config['configurable']['message_history'].aget_range(covered, offset)
+        return _older + messages[:start]
+
+    @staticmethod
+    def _offset(config: RunnableConfig) -> int:
+        """Index in the session of the first message of the history, which is only the tail of the compact histories."""
+        return getattr(config['configurable'].get('message_history'), 'offset', 0)
+
+    @staticmethod
+    def _session_id(config: RunnableConfig) -> str:
+        return config['configurable']['session_id']
+
+    @staticmethod
+    def _parse_summary(record: dict) -> Tuple[str, int]:
+        if not record:
+            return "", 0
+        return record[b'summary'].decode(), int(record[b'covered'])
+
+    @staticmethod
+    def _with_summary(summary: str, window: List[BaseMessage]) -> List[BaseMessage]:
+        if not summary:
+            return window
+        return [SystemMessage(f"Summary of the earlier conversation:\n{summary}")] + window
+
+    # ---------------------------------- summarization -----------------------------------
+    async def _aupdate_summary(self, session_id: str, summary: str, messages: Awaitable[List[BaseMessage]], covered: int):
+        try:
+            messages = await messages
+            _summary = await self._summary_chain.ainvoke({
+                "summary": summary or "(empty)",
+                "lines": get_buffer_string(messages),
+                "max_words": self.summary_max_words,
+            })
+            pipe = self.async_redis_client.pipeline(transaction=False)
+            pipe.hset(self.summary_key(session_id), mapping={"summary": _summary.strip(), "covered": covered})
+            if self.ttl:
+                pipe.expire(self.summary_key(session_id), self.ttl)
+            await pipe.execute()
+            self.logger.debug(f"Updated history summary of session {session_id}, covering {covered} messages.")
+        except Exception as e:
+            self.logger.warning(f"Failed to update history summary of session {session_id}. Error: {e}.")
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the router assigning each chat turn to a model tier
+"""
+import re
+from typing import List, Tuple
+# project imports
+from src.utils.metrics import TIER_REQUESTS
+
+
+class RoutingRule():
+    """
+    Matches a query when all of its conditions hold.
+
+    Attributes:
+        name (str): Name of the rule, reported with the routing decision
+        tier (str): Tier of the matched queries
+        patterns (list): Regular expressions, any of which must match (case-insensitive)
+        max_words (int): Maximum number of words of the query
+    """
+    def __init__(self, rule_config: dict):
+        self.name = rule_config.get('name', rule_config['tier'])
+        self.tier = rule_config['tier']
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in rule_config.get('patterns', [])]
+        self.max_words = rule_config.get('max_words')
+
+    def matches(self, query: str, words: int) -> bool:
+        if self.max_words is not None and words > self.max_words:
+            return False
+        return not self.patterns or any(p.search(query) for p in self.patterns)
+
+
+class ModelRouter():
+    """
+    Routes each query to a model tier with the rules of the 'model_router' config, evaluated in order.
+    Greetings, short and FAQ-style queries go to a fast tier with a small output budget, while the
+    queries asking for explanations and the ones no rule matches escalate to the default tier.
+    A rule naming a tier missing from `tiers` routes to the default tier instead of failing the turn.
+
+    Attributes:
+        default_tier (str): Tier of the queries no rule matches
+        rules (list): RoutingRule evaluated in order, the first match wins
+        tiers (set): Tiers with a model, 'primary' and the ones of the 'tiers' config
+    """
+    def __init__(self, router_config: dict):
+        self.tiers = {"primary", *router_config.get('tiers', {})}
+        _default = router_config['default_tier']
+        self.default_tier = _default if _default in self.tiers else "primary"
+        self.rules: List[RoutingRule] = [RoutingRule(r) for r in router_config.get('rules', [])]
+
+    def route(self, query: str) -> Tuple[str, str]:
+        """Returns the tier of the query and the name of the rule that picked it."""
+        tier, rule = self.default_tier, "default"
+        _words = len(query.split())
+        for _rule in self.rules:
+            if _rule.matches(query, _words):
+                tier, rule = (_rule.tier if _rule.tier in self.tiers else self.default_tier), _rule.name
+                break
+        TIER_REQUESTS.labels(tier, rule).inc()
+        return tier, rule
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the prompt cache points marking the stable prefix of the prompts for the model
+"""
+from typing import Dict, List, Optional
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+# content block of the Converse API, passed through as is by ChatBedrockConverse
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def is_cache_point(block) -> bool:
+    return isinstance(block, dict) and "cachePoint" in block
+
+
+def with_cache_point(message: BaseMessage) -> BaseMessage:
+    """Copy of the message with a cache point after its content, the stored history is left untouched."""
+    _content = message.content
+    _blocks = [{"type": "text", "text": _content}] if isinstance(_content, str) else list(_content)
+    return message.model_copy(update={"content": _blocks + [CACHE_POINT]})
+
+
+class PromptCachePoints():
+    """
+    Adds the cache points of the Converse API to the rendered prompt, so that the model reuses the
+    prefix it processed on the previous calls instead of reading it again:
+    - after the system prompt, identical for every session,
+    - after the history, which is the prefix of the next turn of the session as long as the history
+      window does not slide (see `window_step` of the history policy).
+    The cache points are set per model config section in the 'prompt_cache' config, only for the models
+    supporting prompt caching, and skipped for the prefixes shorter than the model caches.
+
+    Attributes:
+        models (dict): Settings of each model config section with prompt caching
+        tier_models (dict): Model config section of each tier of the router, 'primary' is 'converse_engine'
+    """
+    def __init__(self, cache_config: dict, tier_models: Dict[str, str], count_tokens):
+        self.enabled = cache_config.get('enabled', False)
+        self.models: Dict[str, dict] = {
+            _section: _settings for _section, _settings in (cache_config.get('models') or {}).items()
+            if _settings.get('enabled', True)
+        }
+        self.tier_models = tier_models
+        self.count_tokens = count_tokens
+
+    def as_runnable(self, history: bool = True) -> RunnableLambda:
+        """
+        Runnable between the prompt and the model. `history` is False for the prompts whose system
+        part changes every turn (e.g. the retrieved documents), the history then never repeats.
+        """
+        return RunnableLambda(lambda prompt, config: self.mark(prompt, config, history), name="PromptCachePoints")
+
+    def settings(self, config: RunnableConfig) -> Optional[dict]:
+        """Prompt caching settings of the model the call is routed to, None if it has none."""
+        if not self.enabled:
+            return None
+        _tier = (config.get('configurable') or {}).get('model_tier', 'primary')
+        return self.models.get(self.tier_models.get(_tier, ''))
+
+    def mark(self, prompt: ChatPromptValue, config: RunnableConfig, history: bool = True) -> ChatPromptValue:
+        _settings = self.settings(config)
+        if _settings is None:
+            return prompt
+        messages: List[BaseMessage] = list(prompt.messages)
+        _min_tokens = _settings.get('min_tokens', 1024)
+        _prefix = 0
+        _marked = False
+        # the latest message is the user input, everything before it recurs in the next turn
+        for i, _message in enumerate(messages[:-1]):
+            _prefix += self.count_tokens(_message)
+            if i == 0 and isinstance(_message, SystemMessage) and _prefix >= _min_tokens:
+                messages[i] = with_cache_point(_message)
+                _marked = True
+        _last = len(messages) - 2
+        if (history and _settings.get('history', True) and _last > 0 and _prefix >= _min_tokens
+            and isinstance(messages[_last], AIMessage)):
+            messages[_last] = with_cache_point(messages[_last])
+            _marked = True
+        return ChatPromptValue(messages=messages) if _marked else prompt
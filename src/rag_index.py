@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the vector index of the RAG documents, stored as memory-mapped NumPy files
+"""
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+
+MANIFEST = "manifest.json"
+
+
+class VectorIndex():
+    """
+    Read side of the top-k similarity index over the document chunks. The vectors are unit-normalized
+    float32 rows of a .npy file opened with mmap, so every worker shares the page cache of one copy.
+    Large indexes are searched in two stages: the projection of the vectors on their principal
+    directions (a fraction of the bytes to scan) preselects candidates, which are then rescored
+    exactly against the full vectors.
+    Files are written under a new version and switched by replacing the manifest, open readers keep
+    the previous version until they reload.
+    An index that fails to load, or whose vectors were embedded by another model than `query_model_id`,
+    is not used: the searches return nothing until a good version is written.
+
+    Attributes:
+        index_dir (Path): Directory of the manifest and the versioned files
+        version (int): Version of the loaded index, 0 if there is none
+        model_id (str): Embedding model of the vectors
+        query_model_id (str): Embedding model of the queries, None to skip the check
+        documents (dict): Source path -> {"hash": content hash, "chunks": number of chunks}
+    """
+    def __init__(self, index_dir: Path, logger: logging.Logger, reload_interval: float = 30, query_model_id: Optional[str] = None):
+        self.index_dir = Path(index_dir)
+        self.logger = logger
+        self.reload_interval = reload_interval
+        self.query_model_id = query_model_id
+        self.version = 0
+        self.model_id: Optional[str] = None
+        self.documents: Dict[str, dict] = {}
+        self.chunks: List[dict] = []
+        self.vectors: Optional[np.ndarray] = None
+        self.reduced: Optional[np.ndarray] = None
+        self.projection: Optional[np.ndarray] = None
+        self._manifest_mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        try:
+            self.load()
+        except Exception as e:
+            self.logger.error(f"Failed to load RAG index from {self.index_dir}, answering without documents. Error: {e}.")
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def load(self) -> bool:
+        """Maps the version named by the manifest, returns False if there is no index yet."""
+        _path = self.index_dir/MANIFEST
+        try:
+            _mtime = _path.stat().st_mtime_ns
+            manifest = json.loads(_path.read_text())
+        except FileNotFoundError:
+            return False
+        if self.query_model_id and manifest['model_id'] != self.query_model_id:
+            # not retried until the manifest changes
+            self._manifest_mtime = _mtime
+            raise ValueError(
+                f"RAG index version {manifest['version']} was embedded by {manifest['model_id']}, "
+                f"the queries are embedded by {self.query_model_id}. Rebuild it with `python -m src.rag_ingest`."
+            )
+        files = manifest['files']
+        with open(self.index_dir/files['chunks'], 'r') as f:
+            chunks = [json.loads(line) for line in f]
+        vectors = np.load(self.index_dir/files['vectors'], mmap_mode='r')
+        reduced = np.load(self.index_dir/files['reduced'], mmap_mode='r') if files.get('reduced') else None
+        projection = np.load(self.index_dir/files['projection']) if files.get('projection') else None
+        with self._lock:
+            self.version = manifest['version']
+            self.model_id = manifest['model_id']
+            self.documents = manifest['documents']
+            self.chunks, self.vectors, self.reduced, self.projection = chunks, vectors, reduced, projection
+            self._manifest_mtime = _mtime
+        self.logger.info(f"Loaded RAG index version {self.version} with {len(chunks)} chunks from {self.index_dir}.")
+        return True
+
+    def maybe_reload(self):
+        """Picks up a new version written by the ingestion, checking at most every `reload_interval` seconds."""
+        _now = time.monotonic()
+        if _now - self._checked < self.reload_interval:
+            return
+        self._checked = _now
+        try:
+            _mtime = (self.index_dir/MANIFEST).stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if _mtime != self._manifest_mtime:
+            try:
+                self.load()
+            except Exception as e:
+                self.logger.warning(f"Failed to reload RAG index, keeping version {self.version}. Error: {e}.")
+
+    def warm(self):
+        """Faults the mapped pages in ahead of the first search."""
+        with self._lock:
+            for _array in (self.reduced, self.vectors):
+                if _array is not None and len(_array):
+                    float(np.asarray(_array[:, 0]).sum())
+
+    def search(self, query: np.ndarray, k: int, candidates: int = 64) -> List[Tuple[float, dict]]:
+        """Returns the k chunks most similar to the unit-normalized query, as (cosine, chunk) pairs."""
+        with self._lock:
+            vectors, reduced, projection, chunks = self.vectors, self.reduced, self.projection, self.chunks
+        if vectors is None or not len(chunks):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        if reduced is not None:
+            # preselect on the projection, rescore the candidates exactly
+            _approx = reduced @ (query @ projection)
+            # sorted rows read the mapped file sequentially
+            rows = np.sort(self._top(_approx, max(k, candidates)))
+            scores = vectors[rows] @ query
+        else:
+            scores = vectors @ query
+            rows = np.arange(len(scores))
+        _best = self._top(scores, k)
+        return [(float(scores[i]), chunks[int(rows[i])]) for i in _best]
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        """Indices of the k highest scores, in descending order."""
+        if k >= len(scores):
+            return np.argsort(-scores)
+        _top = np.argpartition(-scores, k)[:k]
+        return _top[np.argsort(-scores[_top])]
+
+
+def write_index(
+    index_dir: Path,
+    version: int,
+    model_id: str,
+    documents: Dict[str, dict],
+    chunks: List[dict],
+    vectors: np.ndarray,
+    search_dims: int,
+    exact_search_rows: int,
+):
+    """
+    Writes a new version of the index and switches the manifest to it, then deletes the files of the
+    versions older than the one replaced. The replaced version is kept for the readers that read its
+    manifest but did not map its files yet, it is deleted by the next write.
+    Indexes above `exact_search_rows` chunks also store the projection used by the two-stage search.
+    """
+    index_dir.mkdir(parents=True, exist_ok=True)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    files = {"vectors": f"vectors.{version}.npy", "chunks": f"chunks.{version}.jsonl"}
+    np.save(index_dir/files['vectors'], vectors)
+    with open(index_dir/files['chunks'], 'w') as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+    if len(vectors) > exact_search_rows and vectors.shape[1] > search_dims:
+        projection = _principal_directions(vectors, search_dims)
+        files['projection'] = f"projection.{version}.npy"
+        files['reduced'] = f"reduced.{version}.npy"
+        np.save(index_dir/files['projection'], projection)
+        np.save(index_dir/files['reduced'], np.ascontiguousarray(vectors @ projection))
+    manifest = {
+        "version": version,
+        "model_id": model_id,
+        "dim": int(vectors.shape[1]) if len(vectors) else 0,
+        "count": len(chunks),
+        "files": files,
+        "documents": documents,
+    }
+    try:
+        _previous = json.loads((index_dir/MANIFEST).read_text())['version']
+    except (FileNotFoundError, ValueError, KeyError):
+        _previous = None
+    _tmp = index_dir/f"{MANIFEST}.tmp"
+    _tmp.write_text(json.dumps(manifest, indent=2, ensure_ascii=False))
+    os.replace(_tmp, index_dir/MANIFEST)
+    for _file in index_dir.iterdir():
+        _parts = _file.name.split(".")
+        if len(_parts) == 3 and _parts[1].isdigit() and int(_parts[1]) not in (version, _previous):
+            _file.unlink()
+
+def _principal_directions(vectors: np.ndarray, dims: int, sample: int = 20000) -> np.ndarray:
+    """Top `dims` right singular vectors of (a sample of) the uncentered vectors, as a (dim, dims) matrix."""
+    if len(vectors) > sample:
+        vectors = vectors[np.random.default_rng(0).choice(len(vectors), sample, replace=False)]
+    _, _, vt = np.linalg.svd(vectors, full_matrices=False)
+    return np.ascontiguousarray(vt[:dims].T, dtype=np.float32)
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the ingestion pipeline of the RAG documents: chunking, batched embedding and
+incremental (re)building of the vector index.
+Run it from the project root whenever the documents change:
+    python -m src.rag_ingest [--docs data/documents] [--full]
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+from pathlib import Path
+import time
+from typing import Dict, List
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+import numpy as np
+# project imports
+from src.rag_index import VectorIndex, write_index
+from src.utils.proj_paths import *
+from src.utils.utils import get_service_config
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class DocumentIngestor():
+    """
+    Splits the documents into chunks, embeds them in batches and writes a new version of the index.
+    Ingestion is incremental: documents whose content hash did not change keep their chunks, and
+    any chunk whose hash is already in the index (e.g. an unchanged paragraph of an edited
+    document) reuses its vector instead of calling the embedding model.
+
+    Attributes:
+        chunk_size (int): Maximum length of a chunk in characters
+        chunk_overlap (int): Characters shared by consecutive chunks
+        embed_batch_size (int): Texts per embedding call
+        embed_concurrency (int): Embedding calls in flight
+    """
+    def __init__(self, rag_config: dict, embeddings: Embeddings, model_id: str, logger: logging.Logger, index_dir: Path = RAG_INDEX):
+        self.chunk_size = rag_config['chunk_size']
+        self.chunk_overlap = rag_config['chunk_overlap']
+        self.embed_batch_size = rag_config['embed_batch_size']
+        self.embed_concurrency = rag_config.get('embed_concurrency', 4)
+        self.file_types = tuple(rag_config.get('file_types', ['.md', '.txt']))
+        self.search_dims = rag_config.get('search_dims', 256)
+        self.exact_search_rows = rag_config.get('exact_search_rows', 8192)
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.logger = logger
+        self.index_dir = Path(index_dir)
+        self._splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+
+    def ingest(self, docs_dir: Path, full: bool = False) -> dict:
+        """Brings the index in line with the documents under `docs_dir`, returns the ingestion stats."""
+        _start = time.perf_counter()
+        docs_dir = Path(docs_dir)
+        if not docs_dir.is_dir():
+            raise FileNotFoundError(f"Document directory {docs_dir} does not exist.")
+        current = VectorIndex(self.index_dir, self.logger, reload_interval=0)
+        # vectors of the current index by chunk hash, unless the embedding model changed
+        reusable = not full and current.model_id == self.model_id
+        cache: Dict[str, int] = {}
+        _by_source: Dict[str, List[dict]] = {}
+        if reusable:
+            for row, chunk in enumerate(current.chunks):
+                cache.setdefault(chunk['hash'], row)
+                _by_source.setdefault(chunk['source'], []).append(chunk)
+        stats = {"documents": 0, "unchanged": 0, "updated": 0, "removed": 0, "chunks": 0, "embedded": 0, "reused": 0}
+        documents: Dict[str, dict] = {}
+        chunks: List[dict] = []
+        for path in sorted(p for p in docs_dir.rglob("*") if p.is_file() and p.suffix.lower() in self.file_types):
+            source = path.relative_to(docs_dir).as_posix()
+            text = path.read_text(encoding="utf-8", errors="replace")
+            _hash = content_hash(text)
+            documents[source] = {"hash": _hash}
+            stats["documents"] += 1
+            if reusable and current.documents.get(source, {}).get("hash") == _hash:
+                stats["unchanged"] += 1
+                _chunks = _by_source.get(source, [])
+            else:
+                stats["updated"] += 1
+                _chunks = [
+                    {"source": source, "position": i, "hash": content_hash(t), "text": t}
+                    for i, t in enumerate(self._splitter.split_text(text))
+                ]
+            documents[source]["chunks"] = len(_chunks)
+            chunks.extend(_chunks)
+        stats["removed"] = len(set(current.documents) - set(documents))
+        stats["chunks"] = len(chunks)
+        if reusable and stats["updated"] == 0 and stats["removed"] == 0:
+            stats["reused"] = stats["chunks"]
+            self.logger.info(f"RAG index is up to date ({stats['chunks']} chunks).")
+            return stats
+        # embed the chunks missing from the cache, once per distinct text
+        _missing = list({c['hash']: c['text'] for c in chunks if c['hash'] not in cache}.items())
+        _vectors = self._embed([t for _, t in _missing])
+        stats["embedded"] = len(_missing)
+        stats["reused"] = len(chunks) - sum(1 for c in chunks if c['hash'] not in cache)
+        _new = {h: v for (h, _), v in zip(_missing, _vectors)}
+        _dim = len(_vectors[0]) if len(_vectors) else (current.vectors.shape[1] if current.vectors is not None else 0)
+        vectors = np.empty((len(chunks), _dim), dtype=np.float32)
+        for i, chunk in enumerate(chunks):
+            vectors[i] = current.vectors[cache[chunk['hash']]] if chunk['hash'] in cache else _new[chunk['hash']]
+        write_index(
+            self.index_dir,
+            version=current.version + 1,
+            model_id=self.model_id,
+            documents=documents,
+            chunks=chunks,
+            vectors=vectors,
+            search_dims=self.search_dims,
+            exact_search_rows=self.exact_search_rows,
+        )
+        self.logger.info(f"Wrote RAG index version {current.version + 1} in {time.perf_counter() - _start:.1f}s: {stats}")
+        return stats
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embeds the texts in batches, `embed_concurrency` batches at a time."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        batches = [texts[i:i + self.embed_batch_size] for i in range(0, len(texts), self.embed_batch_size)]
+        with ThreadPoolExecutor(max_workers=self.embed_concurrency) as executor:
+            results = list(executor.map(self.embeddings.embed_documents, batches))
+        return np.asarray([v for batch in results for v in batch], dtype=np.float32)
+
+
+if __name__ == '__main__':
+    from src.bedrock_models import bedrock_embeddings
+    from src.utils.loggers import setup_logging
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=Path, default=RAG_DOCS, help='Directory of the documents to index')
+    parser.add_argument('--full', action='store_true', help='Re-embed every chunk instead of reusing the index')
+    args = parser.parse_args()
+    setup_logging(policy="block")
+    logger = logging.getLogger("app_logger")
+    _rag_config = get_service_config(BACKEND_CONFIG, 'rag')
+    _model_config = get_service_config(BACKEND_CONFIG, 'RAG_embedding_model')[_rag_config['embedding_model']]
+    # the same endpoint as the queries of the engine
+    _embeddings = bedrock_embeddings(_model_config, get_service_config(BACKEND_CONFIG, 'converse_engine')['region_name'])
+    DocumentIngestor(_rag_config, _embeddings, model_id=_model_config['modelId'], logger=logger).ingest(args.docs, full=args.full)
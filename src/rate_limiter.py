@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the rate limiter sharing the request and model token budgets between the clients
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import json
+import logging
+import math
+from typing import Dict, List, Optional, Tuple
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+# project imports
+from src.utils.metrics import RATE_LIMIT_DECISIONS, RATE_LIMIT_DELAY, count_request_tokens
+
+# Token buckets, refilled continuously up to their burst. A request takes from all of its buckets or
+# from none. A bucket may go into debt for up to `max_delay` ms of its refill: the request is then
+# admitted after waiting for the debt to be refilled, which queues the requests of a client over its
+# share behind its own earlier ones, while the clients within their share are never delayed.
+# KEYS: buckets, ARGV: max_delay (ms), then rate (tokens per ms), burst and cost of each bucket.
+# Returns {admitted, wait ms (delay if admitted, Retry-After otherwise), remaining level of each bucket}.
+ACQUIRE_SCRIPT = """
+local _time = redis.call('TIME')
+local now = tonumber(_time[1]) * 1000 + math.floor(tonumber(_time[2]) / 1000)
+local max_delay = tonumber(ARGV[1])
+local levels = {}
+local wait, retry = 0, 0
+for i = 1, #KEYS do
+    local rate, burst, cost = tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+    local state = redis.call('HMGET', KEYS[i], 'level', 'ts')
+    local level = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    level = math.min(burst, level + math.max(0, now - ts) * rate)
+    levels[i] = level
+    local delay = (cost - level) / rate
+    if delay > max_delay then
+        retry = math.max(retry, delay - max_delay)
+    elseif delay > 0 then
+        wait = math.max(wait, delay)
+    end
+end
+local result = {retry > 0 and 0 or 1, math.ceil(retry > 0 and retry or wait)}
+for i = 1, #KEYS do
+    local rate, burst, cost = tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+    if retry == 0 then
+        levels[i] = levels[i] - cost
+        redis.call('HSET', KEYS[i], 'level', tostring(levels[i]), 'ts', now)
+        -- forgotten once refilled
+        redis.call('PEXPIRE', KEYS[i], math.ceil((burst - levels[i]) / rate) + 1000)
+    end
+    result[i + 2] = math.floor(levels[i])
+end
+return result
+"""
+
+# Charges the difference between the tokens used and the ones estimated, refunded when negative.
+# KEYS: buckets, ARGV: rate (tokens per ms), burst and difference of each bucket.
+RECONCILE_SCRIPT = """
+local _time = redis.call('TIME')
+local now = tonumber(_time[1]) * 1000 + math.floor(tonumber(_time[2]) / 1000)
+for i = 1, #KEYS do
+    local rate, burst, delta = tonumber(ARGV[3 * i - 2]), tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+    local state = redis.call('HMGET', KEYS[i], 'level', 'ts')
+    local level = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    level = math.min(burst, level + math.max(0, now - ts) * rate - delta)
+    redis.call('HSET', KEYS[i], 'level', tostring(level), 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil((burst - level) / rate) + 1000)
+end
+return #KEYS
+"""
+
+
+@dataclass
+class Bucket():
+    key: str
+    rate: float # per second
+    burst: float
+    cost: float
+
+    @property
+    def limit(self) -> int:
+        """Requests or tokens per minute, for the X-RateLimit-Limit header."""
+        return round(self.rate * 60)
+
+
+@dataclass
+class Decision():
+    admitted: bool
+    wait: float # seconds to wait before serving, or Retry-After when rejected
+    buckets: List[Bucket]
+    remaining: List[int]
+
+
+class RateLimiter():
+    """
+    Shares the budgets of requests and model tokens between the clients of every worker, with token
+    buckets in Redis updated by one atomic script per request. Each request takes from the buckets of
+    its client and, when it carries one, of its session. The model tokens are estimated up front from
+    the query and a fixed output allowance, and reconciled with the usage reported by the model once
+    the reply is complete. Clients may be given a weight multiplying their limits.
+    Redis errors admit the requests, the limiter never takes the service down.
+
+    Attributes:
+        max_delay (float): Seconds a request over its share may wait instead of being rejected
+        estimated_output_tokens (int): Output tokens charged up front per query
+        key_prefix (str): Prefix of the bucket keys
+        weights (dict): Client id -> multiplier of the client limits
+    """
+    def __init__(self, limit_config: dict, async_redis_client: aioredis.Redis, logger: logging.Logger):
+        self.client_limits = limit_config['client']
+        self.session_limits = limit_config.get('session')
+        self.max_delay = limit_config.get('max_delay', 0)
+        self.estimated_output_tokens = limit_config.get('estimated_output_tokens', 300)
+        self.key_prefix = limit_config.get('key_prefix', "ratelimit:")
+        self.weights: Dict[str, float] = limit_config.get('weights') or {}
+        self.logger = logger
+        self._acquire = async_redis_client.register_script(ACQUIRE_SCRIPT)
+        self._reconcile = async_redis_client.register_script(RECONCILE_SCRIPT)
+
+    def estimate_tokens(self, queries: List[str]) -> int:
+        # about 4 characters per token, like the history policy
+        return sum(len(q) // 4 + self.estimated_output_tokens for q in queries)
+
+    def buckets(self, client: str, session_id: Optional[str], tokens: int) -> Tuple[List[Bucket], List[Bucket]]:
+        """
+        Request buckets and token buckets of a request. A token estimate beyond the burst could never be
+        admitted, it takes the whole burst and the rest is charged by the reconciliation.
+        """
+        _weight = self.weights.get(client, 1)
+        _scopes = [(f"client:{client}", self.client_limits, _weight)]
+        if session_id and self.session_limits:
+            _scopes.append((f"session:{session_id}", self.session_limits, 1))
+        _requests, _tokens = [], []
+        for _scope, _limits, _w in _scopes:
+            _requests.append(Bucket(
+                f"{self.key_prefix}{_scope}:requests", _w * _limits['requests_per_minute'] / 60, _w * _limits['request_burst'],
+                1
+            ))
+            _tokens.append(Bucket(
+                f"{self.key_prefix}{_scope}:tokens", _w * _limits['tokens_per_minute'] / 60, _w * _limits['token_burst'],
+                min(tokens, _w * _limits['token_burst'])
+            ))
+        return _requests, _tokens
+
+    async def aacquire(self, buckets: List[Bucket]) -> Optional[Decision]:
+        """Takes the cost of every bucket, or of none. None if Redis failed."""
+        _args = [self.max_delay * 1000]
+        for _b in buckets:
+            _args += [_b.rate / 1000, _b.burst, _b.cost]
+        try:
+            _result = await self._acquire(keys=[_b.key for _b in buckets], args=_args)
+        except RedisError as e:
+            RATE_LIMIT_DECISIONS.labels("error").inc()
+            self.logger.warning(f"Rate limiter unavailable, admitting the request. Error: {e}.")
+            return None
+        return Decision(bool(_result[0]), int(_result[1]) / 1000, buckets, [int(r) for r in _result[2:]])
+
+    async def aadmit(self, buckets: List[Bucket]) -> Optional[Decision]:
+        """Takes the costs of the buckets and counts the decision, the caller waits for `wait` once admitted."""
+        _decision = await self.aacquire(buckets)
+        if _decision is None:
+            return None
+        if not _decision.admitted:
+            RATE_LIMIT_DECISIONS.labels("rejected").inc()
+        else:
+            RATE_LIMIT_DECISIONS.labels("delayed" if _decision.wait else "admitted").inc()
+            RATE_LIMIT_DELAY.observe(_decision.wait)
+        return _decision
+
+    @asynccontextmanager
+    async def paced(self, client: str, session_id: Optional[str], query: str):
+        """
+        Waits until the query is admitted, coming back after each Retry-After instead of failing, and
+        reconciles the tokens used within the block, e.g. by an item of a batch.
+        """
+        _requests, _tokens = self.buckets(client, session_id, self.estimate_tokens([query]))
+        _decision = await self.aadmit(_requests + _tokens)
+        while _decision is not None and not _decision.admitted:
+            await asyncio.sleep(_decision.wait)
+            _decision = await self.aadmit(_requests + _tokens)
+        if _decision is not None and _decision.wait:
+            await asyncio.sleep(_decision.wait)
+        with count_request_tokens() as _used:
+            try:
+                yield
+            finally:
+                if _decision is not None:
+                    await self.areconcile(_tokens, _used["input"] + _used["output"])
+
+    async def areconcile(self, buckets: List[Bucket], used: int):
+        """Charges the tokens used beyond the estimate, or refunds the ones not used."""
+        _args = []
+        for _b in buckets:
+            _args += [_b.rate / 1000, _b.burst, used - _b.cost]
+        try:
+            await self._reconcile(keys=[_b.key for _b in buckets], args=_args)
+        except RedisError as e:
+            self.logger.warning(f"Failed to reconcile the token buckets. Error: {e}.")
+
+
+def client_id(scope, client_header: bytes) -> str:
+    """
+    Client of a request, the first address of the `client_header` (e.g. X-Forwarded-For behind a trusted
+    load balancer, lower case) or the peer address.
+    """
+    if client_header:
+        for k, v in scope["headers"]:
+            if k == client_header:
+                return v.decode().split(",")[0].strip()
+    return scope["client"][0] if scope.get("client") else "unknown"
+
+
+class RateLimitMiddleware():
+    """
+    ASGI middleware applying the RateLimiter of the app state (`app.state.rate_limiter`, set once Redis
+    is connected) to the chat endpoints of `paths`. A request over its share waits up to `max_delay`,
+    beyond which it is rejected with 429, Retry-After and the X-RateLimit headers of the exhausted bucket.
+    A batch is charged one request on arrival, the endpoint paces its items through the limiter (`paced`).
+    The client is identified by the `client_header` (e.g. X-Forwarded-For behind a trusted load
+    balancer, whose first address is used), by the peer address otherwise. The WebSocket endpoints
+    apply the limiter to each of their messages themselves.
+
+    Attributes:
+        paths (set): Paths of the rate limited endpoints
+        client_header (str): Header identifying the client, empty for the peer address
+    """
+    def __init__(self, app, paths: List[str], client_header: str = ""):
+        self.app = app
+        self.paths = set(paths)
+        self.client_header = client_header.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        _limiter: Optional[RateLimiter] = getattr(scope["app"].state, "rate_limiter", None) if "app" in scope else None
+        if scope["type"] != "http" or _limiter is None or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        # the body is read ahead for the session and the queries, then replayed to the endpoint
+        _body, _more, _messages = b"", True, []
+        while _more:
+            _message = await receive()
+            _messages.append(_message)
+            if _message["type"] != "http.request":
+                break
+            _body += _message.get("body", b"")
+            _more = _message.get("more_body", False)
+        session_id, queries, batch = self._parse(_body)
+        _requests, _tokens = _limiter.buckets(client_id(scope, self.client_header), session_id, _limiter.estimate_tokens(queries))
+        # the items of a batch are paced through the limiter by the endpoint, the batch itself takes a request
+        if batch:
+            _tokens = []
+        _decision = await _limiter.aadmit(_requests + _tokens)
+        if _decision is not None and not _decision.admitted:
+            return await self._reject(send, _decision)
+        if _decision is not None and _decision.wait:
+            await asyncio.sleep(_decision.wait)
+        async def _replay():
+            return _messages.pop(0) if _messages else await receive()
+        async def _send(message):
+            if message["type"] == "http.response.start" and _decision is not None:
+                message["headers"] = list(message.get("headers", [])) + self._headers(_decision)
+            await send(message)
+        with count_request_tokens() as _used:
+            await self.app(scope, _replay, _send)
+        if _decision is not None and _tokens:
+            await _limiter.areconcile(_tokens, _used["input"] + _used["output"])
+
+    @staticmethod
+    def _parse(body: bytes) -> Tuple[Optional[str], List[str], bool]:
+        """Session id, queries and whether it is a batch, the endpoint validates the payload itself."""
+        try:
+            _payload = json.loads(body)
+        except ValueError:
+            return None, [], False
+        if not isinstance(_payload, dict):
+            return None, [], False
+        if isinstance(_payload.get('items'), list):
+            return None, [str(i.get('query', '')) for i in _payload['items'] if isinstance(i, dict)], True
+        return _payload.get('session_id'), [str(_payload.get('query', ''))], False
+
+    @staticmethod
+    def _headers(decision: Decision) -> List[Tuple[bytes, bytes]]:
+        """X-RateLimit headers of the bucket closest to exhaustion."""
+        _i = min(range(len(decision.buckets)), key=lambda i: decision.remaining[i] / decision.buckets[i].burst)
+        _bucket, _remaining = decision.buckets[_i], max(0, decision.remaining[_i])
+        _reset = math.ceil((_bucket.burst - _remaining) / _bucket.rate)
+        return [
+            (b"x-ratelimit-limit", str(_bucket.limit).encode()),
+            (b"x-ratelimit-remaining", str(_remaining).encode()),
+            (b"x-ratelimit-reset", str(_reset).encode()),
+        ]
+
+    async def _reject(self, send, decision: Decision):
+        await self._send_error(send, 429, "Rate limit exceeded, please retry later.", [
+            (b"retry-after", str(max(1, math.ceil(decision.wait))).encode()),
+        ] + self._headers(decision))
+
+    @staticmethod
+    async def _send_error(send, status: int, detail: str, headers: List[Tuple[bytes, bytes]]):
+        _body = json.dumps({"detail": detail}).encode()
+        _headers = [(b"content-type", b"application/json"), (b"content-length", str(len(_body)).encode())] + headers
+        await send({"type": "http.response.start", "status": status, "headers": _headers})
+        await send({"type": "http.response.body", "body": _body})
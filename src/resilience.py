@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the resilient invocation layer of the chat model: failover across equivalent
+model endpoints, hedged requests, circuit breakers and jittered retries
+"""
+import asyncio
+from collections import deque
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+import numpy as np
+from pydantic import PrivateAttr
+# project imports
+from src.utils.exceptions import RETRYABLE_ERROR_CODES, TooManyRequestsError, UpstreamUnavailableError, is_throttled
+from src.utils.metrics import CIRCUIT_STATE, UPSTREAM_ATTEMPTS, UPSTREAM_HEDGES
+
+
+def is_retryable_error(e: BaseException) -> bool:
+    """Whether another attempt may succeed: throttling, server side failures and connection errors."""
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    return isinstance(e, (BotoConnectionError, HTTPClientError, asyncio.TimeoutError))
+
+class CircuitBreaker():
+    """
+    Stops sending calls to an endpoint after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds a single probe call is let through, which closes the circuit on success
+    and opens it again on failure.
+
+    Attributes:
+        name (str): Endpoint guarded by the breaker
+        state (str): 'closed', 'open' or 'half_open'
+    """
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        CIRCUIT_STATE.labels(name).set(0)
+
+    def available(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self._opened_at >= self.reset_timeout
+        return not self._probing
+
+    def on_start(self):
+        if self.state == "open":
+            self._set_state("half_open")
+        if self.state == "half_open":
+            self._probing = True
+
+    def on_success(self):
+        self._failures = 0
+        self._probing = False
+        if self.state != "closed":
+            self._set_state("closed")
+
+    def on_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set_state("open")
+
+    def on_abandoned(self):
+        """The call was cancelled before its outcome was known, e.g. it lost a hedge."""
+        self._probing = False
+
+    def _set_state(self, state: str):
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(self.STATES[state])
+
+
+class _Attempt():
+    """A streaming call to one endpoint, reading ahead until the first token arrives."""
+    def __init__(self, index: int, stream: AsyncIterator[ChatGenerationChunk]):
+        self.index = index
+        self.stream = stream
+        self.start = time.monotonic()
+        # seconds to the first token, None until it arrived
+        self.ttft: Optional[float] = None
+        self.first = asyncio.ensure_future(self._afirst())
+
+    async def _afirst(self) -> List[ChatGenerationChunk]:
+        """Chunks up to and including the first one with content."""
+        buffered = []
+        async for chunk in self.stream:
+            buffered.append(chunk)
+            if chunk.message.content:
+                self.ttft = time.monotonic() - self.start
+                break
+        return buffered
+
+    async def acancel(self):
+        self.first.cancel()
+        await asyncio.gather(self.first, return_exceptions=True)
+        await self.stream.aclose()
+
+
+class ResilientChatModel(BaseChatModel):
+    """
+    Chat model spreading the calls over equivalent endpoints (e.g. the same model in several regions),
+    which are tried in order of preference.
+    - Hedging: when the first token does not arrive within the deadline (the recent p95 time to first
+      token of the endpoint), a second request is sent to the next endpoint, the slower one is cancelled.
+    - Circuit breaking: endpoints failing repeatedly are skipped until a probe call succeeds.
+    - Retry: calls failing with a retryable error before their first token are retried on the next
+      endpoint after a jittered backoff. Other errors, and failures after the first token, are raised.
+
+    Attributes:
+        endpoints (list): Equivalent chat models
+        endpoint_names (list): Names of the endpoints in the metrics
+        model_id (str): Model id of the preferred endpoint
+        max_attempts (int): Rounds of attempts of a call, hedges are not counted
+        hedge_enabled (bool): Whether slow calls are hedged
+        hedge_percentile (float): Percentile of the recent times to first token used as deadline
+    """
+    endpoints: List[BaseChatModel]
+    endpoint_names: List[str]
+    model_id: str = ""
+    max_attempts: int = 3
+    backoff_base: float = 0.2
+    backoff_cap: float = 2.0
+    hedge_enabled: bool = True
+    hedge_percentile: float = 0.95
+    hedge_multiplier: float = 1.0
+    hedge_min_deadline: float = 0.5
+    hedge_max_deadline: float = 5.0
+    hedge_initial_deadline: float = 2.0
+    hedge_min_samples: int = 20
+    hedge_window: int = 200
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+    _breakers: List[CircuitBreaker] = PrivateAttr()
+    _ttfts: List[deque] = PrivateAttr()
+
+    def model_post_init(self, __context: Any):
+        self._breakers = [CircuitBreaker(n, self.failure_threshold, self.reset_timeout) for n in self.endpoint_names]
+        self._ttfts = [deque(maxlen=self.hedge_window) for _ in self.endpoints]
+
+    @classmethod
+    def from_config(cls, endpoints_config: dict, endpoints: List[BaseChatModel], endpoint_names: List[str]) -> "ResilientChatModel":
+        """Creates the model from the 'model_endpoints' section of backend.yaml."""
+        _hedge = endpoints_config.get('hedge', {})
+        _retry = endpoints_config.get('retry', {})
+        _breaker = endpoints_config.get('circuit_breaker', {})
+        return cls(
+            endpoints=endpoints,
+            endpoint_names=endpoint_names,
+            model_id=getattr(endpoints[0], "model_id", ""),
+            max_attempts=_retry.get('max_attempts', 3),
+            backoff_base=_retry.get('backoff_base', 0.2),
+            backoff_cap=_retry.get('backoff_cap', 2.0),
+            hedge_enabled=_hedge.get('enabled', True),
+            hedge_percentile=_hedge.get('percentile', 0.95),
+            hedge_multiplier=_hedge.get('multiplier', 1.0),
+            hedge_min_deadline=_hedge.get('min_deadline', 0.5),
+            hedge_max_deadline=_hedge.get('max_deadline', 5.0),
+            hedge_initial_deadline=_hedge.get('initial_deadline', 2.0),
+            hedge_min_samples=_hedge.get('min_samples', 20),
+            hedge_window=_hedge.get('window', 200),
+            failure_threshold=_breaker.get('failure_threshold', 5),
+            reset_timeout=_breaker.get('reset_timeout', 30.0),
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        return "resilient-chat-model"
+
+    def deadline(self, index: int) -> float:
+        """Seconds to wait for the first token of the endpoint before hedging."""
+        _samples = self._ttfts[index]
+        if len(_samples) < self.hedge_min_samples:
+            return self.hedge_initial_deadline
+        _deadline = float(np.quantile(_samples, self.hedge_percentile)) * self.hedge_multiplier
+        return min(self.hedge_max_deadline, max(self.hedge_min_deadline, _deadline))
+
+    def _candidates(self) -> List[int]:
+        return [i for i, b in enumerate(self._breakers) if b.available()]
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _exhausted(self, error: Optional[BaseException]) -> Exception:
+        """Error raised once every attempt failed, telling the client when to come back."""
+        if error is not None and is_throttled(error):
+            return TooManyRequestsError("The model is throttled, please retry later.", retry_after=max(1, round(self.backoff_cap)))
+        _retry_after = max(1, round(min(b._opened_at + b.reset_timeout - time.monotonic() for b in self._breakers)))
+        return UpstreamUnavailableError(f"No model endpoint available. Last error: {error}", retry_after=_retry_after)
+
+    # ---------------------------------- async path ----------------------------------
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        error: Optional[BaseException] = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt - 1))
+            candidates = self._candidates()
+            if not candidates:
+                break
+            winner, buffered, error = await self._arace(candidates, messages, stop, **kwargs)
+            if winner is None:
+                if error is not None and not is_retryable_error(error):
+                    raise error
+                continue
+            for chunk in buffered:
+                yield chunk
+            try:
+                async for chunk in winner.stream:
+                    yield chunk
+            except Exception:
+                # tokens were already sent, the call can't be retried
+                self._breakers[winner.index].on_failure()
+                UPSTREAM_ATTEMPTS.labels(self.endpoint_names[winner.index], "failure").inc()
+                raise
+            return
+        raise self._exhausted(error)
+
+    async def _arace(self, candidates: List[int], messages, stop, **kwargs) -> tuple:
+        """
+        Starts a call on the preferred endpoint, hedges it on the next one once its deadline passed, and
+        returns the first call to produce a token with its buffered chunks, or the last error.
+        """
+        racing: List[_Attempt] = [self._start(candidates[0], messages, stop, **kwargs)]
+        _deadline = self.deadline(candidates[0]) if self.hedge_enabled else None
+        hedged, winner, buffered, error = False, None, None, None
+        try:
+            while racing and winner is None:
+                done, _ = await asyncio.wait(
+                    [a.first for a in racing], timeout=None if hedged else _deadline, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # the first token is late, hedge on the next endpoint (or the same one if it is the only one)
+                    hedged = True
+                    _next = candidates[1] if len(candidates) > 1 else candidates[0]
+                    UPSTREAM_HEDGES.labels(self.endpoint_names[_next]).inc()
+                    racing.append(self._start(_next, messages, stop, **kwargs))
+                    continue
+                for attempt in [a for a in racing if a.first in done]:
+                    racing.remove(attempt)
+                    _name = self.endpoint_names[attempt.index]
+                    if attempt.first.exception() is not None:
+                        error = attempt.first.exception()
+                        if is_retryable_error(error):
+                            self._breakers[attempt.index].on_failure()
+                        else:
+                            self._breakers[attempt.index].on_abandoned()
+                        UPSTREAM_ATTEMPTS.labels(_name, "failure").inc()
+                        continue
+                    if winner is None:
+                        winner, buffered = attempt, attempt.first.result()
+                        self._ttfts[attempt.index].append(attempt.ttft if attempt.ttft is not None else time.monotonic() - attempt.start)
+                        self._breakers[attempt.index].on_success()
+                        UPSTREAM_ATTEMPTS.labels(_name, "success").inc()
+                    else:
+                        racing.append(attempt)
+                # a failed call is replaced by its hedge right away
+                if winner is None and not racing and not hedged and len(candidates) > 1 and error is not None and is_retryable_error(error):
+                    hedged = True
+                    racing.append(self._start(candidates[1], messages, stop, **kwargs))
+        finally:
+            for attempt in racing:
+                # the losers' times to first token, or their elapsed time when cancelled without one, keep
+                # the deadline from being computed on the fast calls only
+                self._ttfts[attempt.index].append(attempt.ttft if attempt.ttft is not None else time.monotonic() - attempt.start)
+                self._breakers[attempt.index].on_abandoned()
+                UPSTREAM_ATTEMPTS.labels(self.endpoint_names[attempt.index], "cancelled").inc()
+                await attempt.acancel()
+        return winner, buffered, error
+
+    def _start(self, index: int, messages, stop, **kwargs) -> _Attempt:
+        self._breakers[index].on_start()
+        return _Attempt(index, self.endpoints[index]._astream(messages, stop, None, **kwargs))
+
+    # ---------------------------------- blocking path ----------------------------------
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        """Blocking version of `_astream`, with failover and retries but without hedging."""
+        error: Optional[BaseException] = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self._backoff(attempt - 1))
+            candidates = self._candidates()
+            if not candidates:
+                break
+            # rotate through the endpoints across the attempts
+            index = candidates[attempt % len(candidates)]
+            self._breakers[index].on_start()
+            _start = time.monotonic()
+            stream = self.endpoints[index]._stream(messages, stop, None, **kwargs)
+            buffered = []
+            try:
+                for chunk in stream:
+                    buffered.append(chunk)
+                    if chunk.message.content:
+                        break
+            except Exception as e:
+                stream.close()
+                error = e
+                UPSTREAM_ATTEMPTS.labels(self.endpoint_names[index], "failure").inc()
+                if not is_retryable_error(e):
+                    self._breakers[index].on_abandoned()
+                    raise
+                self._breakers[index].on_failure()
+                continue
+            self._ttfts[index].append(time.monotonic() - _start)
+            self._breakers[index].on_success()
+            UPSTREAM_ATTEMPTS.labels(self.endpoint_names[index], "success").inc()
+            yield from buffered
+            yield from stream
+            return
+        raise self._exhausted(error)
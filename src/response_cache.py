@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the response cache placed in front of the conversation chain
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import re
+import time
+from typing import Dict, Optional, Tuple
+from langchain_core.embeddings import Embeddings
+import numpy as np
+import redis.asyncio as aioredis
+# project imports
+from src.utils.metrics import CACHE_LOOKUPS
+
+
+class ResponseCache():
+    """
+    Cache of replies to repeated questions, scoped by a fingerprint of the system prompt and model config.
+    - Exact tier: keyed on the normalized query, an in-process LRU (L1) backed by Redis (L2).
+    - Semantic tier (optional): a query whose embedding is close enough to a cached query reuses its reply.
+    Entries expire after `ttl` seconds in both tiers, the L1 tier also evicts the least recently used entry.
+
+    Attributes:
+        first_turn_only (bool): Only answer the first turn of a session from the cache, where the
+            reply does not depend on the conversation history
+        ttl (int): Expiry of cached replies in seconds
+        max_entries (int): Capacity of the in-process LRU
+        semantic_threshold (float): Minimum cosine similarity of a semantic hit
+    """
+    def __init__(
+        self,
+        cache_config: dict,
+        fingerprint: str,
+        async_redis_client: aioredis.Redis,
+        logger: logging.Logger,
+        embeddings: Optional[Embeddings] = None,
+    ):
+        self.first_turn_only = cache_config.get('first_turn_only', True)
+        self.ttl = cache_config['ttl']
+        self.max_entries = cache_config['max_entries']
+        self.semantic_threshold = cache_config.get('semantic', {}).get('threshold', 0.92)
+        self.fingerprint = fingerprint
+        self.async_redis_client = async_redis_client
+        self.logger = logger
+        self.embeddings = embeddings
+        # key -> (reply, expiry timestamp), ordered from least to most recently used
+        self._l1: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        # key -> normalized query embedding, for the entries of the L1 tier
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._stats = {"hits_l1": 0, "hits_l2": 0, "hits_semantic": 0, "misses": 0}
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Lower-cases the query, collapses whitespace and drops trailing punctuation."""
+        return re.sub(r"\s+", " ", query.lower()).strip().rstrip("?!. ")
+
+    def key(self, query: str) -> str:
+        _digest = hashlib.sha256(self.normalize(query).encode()).hexdigest()
+        return f"resp_cache:{self.fingerprint}:{_digest}"
+
+    async def aget(self, query: str) -> Optional[str]:
+        """Returns the cached reply to the query, or None on a miss."""
+        key = self.key(query)
+        # L1, exact match
+        reply = self._l1_get(key)
+        if reply is not None:
+            self._stats["hits_l1"] += 1
+            CACHE_LOOKUPS.labels("hits_l1").inc()
+            return reply
+        # L2, exact match
+        try:
+            _cached = await self.async_redis_client.get(key)
+        except Exception as e:
+            self.logger.warning(f"Failed to read response cache from Redis. Error: {e}.")
+            _cached = None
+        if _cached is not None:
+            reply = _cached.decode()
+            self._l1_put(key, reply)
+            self._stats["hits_l2"] += 1
+            CACHE_LOOKUPS.labels("hits_l2").inc()
+            return reply
+        # semantic match against the queries of the L1 tier
+        if self.embeddings is not None and self._vectors:
+            reply = await self._asemantic_get(query)
+            if reply is not None:
+                self._stats["hits_semantic"] += 1
+                CACHE_LOOKUPS.labels("hits_semantic").inc()
+                return reply
+        self._stats["misses"] += 1
+        CACHE_LOOKUPS.labels("misses").inc()
+        return None
+
+    async def aset(self, query: str, reply: str):
+        """Caches the reply in both tiers."""
+        key = self.key(query)
+        self._l1_put(key, reply)
+        if self.embeddings is not None:
+            try:
+                self._vectors[key] = self._unit(await self.embeddings.aembed_query(self.normalize(query)))
+            except Exception as e:
+                self.logger.warning(f"Failed to embed query for the semantic cache. Error: {e}.")
+        try:
+            await self.async_redis_client.set(key, reply, ex=self.ttl)
+        except Exception as e:
+            self.logger.warning(f"Failed to write response cache to Redis. Error: {e}.")
+
+    def stats(self) -> dict:
+        _lookups = sum(self._stats.values())
+        _hits = _lookups - self._stats["misses"]
+        return {**self._stats, "size": len(self._l1), "hit_ratio": _hits / _lookups if _lookups else 0.0}
+
+    # ---------------------------------- in-process tier ----------------------------------
+    def _l1_get(self, key: str) -> Optional[str]:
+        _entry = self._l1.get(key)
+        if _entry is None:
+            return None
+        if _entry[1] < time.monotonic():
+            self._l1_evict(key)
+            return None
+        self._l1.move_to_end(key)
+        return _entry[0]
+
+    def _l1_put(self, key: str, reply: str):
+        self._l1[key] = (reply, time.monotonic() + self.ttl)
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.max_entries:
+            self._l1_evict(next(iter(self._l1)))
+
+    def _l1_evict(self, key: str):
+        self._l1.pop(key, None)
+        self._vectors.pop(key, None)
+
+    async def _asemantic_get(self, query: str) -> Optional[str]:
+        try:
+            _query = self._unit(await self.embeddings.aembed_query(self.normalize(query)))
+        except Exception as e:
+            self.logger.warning(f"Failed to embed query for the semantic cache. Error: {e}.")
+            return None
+        keys = list(self._vectors)
+        scores = np.stack([self._vectors[k] for k in keys]) @ _query
+        best = int(np.argmax(scores))
+        if scores[best] < self.semantic_threshold:
+            return None
+        return self._l1_get(keys[best])
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the retrieval step injecting document excerpts into the RAG chat prompt
+"""
+import asyncio
+import logging
+from typing import List, Tuple
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+import numpy as np
+# project imports
+from src.rag_index import VectorIndex
+from src.utils.metrics import stage_timer
+
+
+class Retriever():
+    """
+    Embeds the user query and looks up the most similar chunks of the vector index. The search runs
+    in the executor, the index is reloaded there when the ingestion wrote a new version.
+
+    Attributes:
+        top_k (int): Chunks injected into the prompt
+        min_score (float): Minimum cosine similarity of an injected chunk
+        candidates (int): Chunks preselected on the projected vectors of a large index
+        max_context_chars (int): Length limit of the injected context
+    """
+    def __init__(self, rag_config: dict, index: VectorIndex, embeddings: Embeddings, logger: logging.Logger):
+        self.top_k = rag_config['top_k']
+        self.min_score = rag_config.get('min_score', 0.0)
+        self.candidates = rag_config.get('candidates', 64)
+        self.max_context_chars = rag_config.get('max_context_chars', 6000)
+        self.index = index
+        self.embeddings = embeddings
+        self.logger = logger
+
+    def as_runnable(self) -> RunnableLambda:
+        """Runnable mapping the chain inputs to the context string, for use in RunnablePassthrough.assign."""
+        return RunnableLambda(self._format_inputs, afunc=self._aformat_inputs, name="Retriever")
+
+    def retrieve(self, query: str) -> List[Tuple[float, dict]]:
+        with stage_timer("retrieval"):
+            return self._search(self.embeddings.embed_query(query))
+
+    async def aretrieve(self, query: str) -> List[Tuple[float, dict]]:
+        with stage_timer("retrieval"):
+            _vector = await self.embeddings.aembed_query(query)
+            return await asyncio.get_running_loop().run_in_executor(None, self._search, _vector)
+
+    def format_context(self, results: List[Tuple[float, dict]]) -> str:
+        """Numbered excerpts with their source, most similar first, cut at `max_context_chars`."""
+        if not results:
+            return "(no relevant documents)"
+        _parts, _length = [], 0
+        for i, (_, chunk) in enumerate(results, 1):
+            _part = f"[{i}] ({chunk['source']})\n{chunk['text']}"
+            if _parts and _length + len(_part) > self.max_context_chars:
+                break
+            _parts.append(_part)
+            _length += len(_part)
+        return "\n\n".join(_parts)
+
+    def _format_inputs(self, inputs: dict) -> str:
+        try:
+            return self.format_context(self.retrieve(inputs['input']))
+        except Exception as e:
+            self.logger.warning(f"Failed to retrieve documents. Error: {e}.")
+            return "(no relevant documents)"
+
+    async def _aformat_inputs(self, inputs: dict) -> str:
+        try:
+            return self.format_context(await self.aretrieve(inputs['input']))
+        except Exception as e:
+            # answer without documents rather than failing the turn
+            self.logger.warning(f"Failed to retrieve documents. Error: {e}.")
+            return "(no relevant documents)"
+
+    def _search(self, vector) -> List[Tuple[float, dict]]:
+        self.index.maybe_reload()
+        _query = np.asarray(vector, dtype=np.float32)
+        _query /= (np.linalg.norm(_query) or 1.0)
+        return [(s, c) for s, c in self.index.search(_query, self.top_k, self.candidates) if s >= self.min_score]
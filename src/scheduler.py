@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the scheduler admitting chat turns to the chat engine
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import math
+import time
+from typing import AsyncIterator, Dict, List
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+# project imports
+from src.utils.exceptions import TooManyRequestsError
+from src.utils.metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_REJECTED, SCHEDULER_WAIT
+
+
+class ChatScheduler():
+    """
+    Admission control in front of the chat engine.
+    - Turns of one session run one at a time, so that they neither interleave the history nor
+      waste a model call. The lock is held in-process, and in Redis when several workers serve:
+      `distributed_session_lock` 'auto' takes it with more than one worker of this instance, true
+      takes it anyway, e.g. for several instances behind a load balancer.
+    - At most `max_concurrency` turns run at once, up to `max_queue` more wait for a slot.
+    - Beyond that, turns are rejected right away with TooManyRequestsError (429 + Retry-After).
+
+    Attributes:
+        max_concurrency (int): Turns served at once by this worker
+        max_queue (int): Turns allowed to wait for a slot
+        queue_timeout (float): Seconds a turn may wait for its session and a slot
+        max_session_queue (int): Turns of one session allowed to wait behind the running one
+        distributed_session_lock (bool): Whether the sessions are also locked in Redis
+    """
+    def __init__(self, scheduler_config: dict, async_redis_client: aioredis.Redis, logger: logging.Logger, workers: int = 1):
+        self.max_concurrency = scheduler_config['max_concurrency']
+        self.max_queue = scheduler_config['max_queue']
+        self.queue_timeout = scheduler_config['queue_timeout']
+        self.max_session_queue = scheduler_config['max_session_queue']
+        _distributed = scheduler_config.get('distributed_session_lock', "auto")
+        self.distributed_session_lock = workers > 1 if _distributed == "auto" else bool(_distributed)
+        self.session_lock_timeout = scheduler_config.get('session_lock_timeout', 120)
+        self.async_redis_client = async_redis_client
+        self.logger = logger
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._waiting = 0
+        # session_id -> [lock, number of turns holding or waiting for it]
+        self._session_locks: Dict[str, List] = {}
+        # moving average of the time a turn holds its slot, to estimate Retry-After
+        self._service_time = 1.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    def admit(self):
+        """Rejects the turn right away if the wait queue is full, without taking a slot."""
+        if self._slots.locked() and self._waiting >= self.max_queue:
+            SCHEDULER_REJECTED.labels("queue_full").inc()
+            raise TooManyRequestsError("Server is busy, please retry later.", retry_after=self.retry_after)
+
+    @property
+    def retry_after(self) -> int:
+        """Seconds until the current queue is expected to have drained."""
+        return max(1, math.ceil(self._service_time * (self._waiting + 1) / self.max_concurrency))
+
+    @asynccontextmanager
+    async def slot(self, session_id: str) -> AsyncIterator[None]:
+        """Holds the session and one global slot for the duration of the block."""
+        self.admit()
+        _start = time.monotonic()
+        async with self._session(session_id):
+            # the queue may have filled up while waiting for the session
+            self.admit()
+            self._waiting += 1
+            SCHEDULER_QUEUE_DEPTH.labels("global").inc()
+            try:
+                _remaining = max(0.0, self.queue_timeout - (time.monotonic() - _start))
+                await asyncio.wait_for(self._slots.acquire(), _remaining)
+            except asyncio.TimeoutError:
+                SCHEDULER_REJECTED.labels("queue_timeout").inc()
+                raise TooManyRequestsError("Timed out waiting for the server, please retry later.", retry_after=self.retry_after)
+            finally:
+                self._waiting -= 1
+                SCHEDULER_QUEUE_DEPTH.labels("global").dec()
+            SCHEDULER_WAIT.observe(time.monotonic() - _start)
+            _served = time.monotonic()
+            try:
+                yield
+            finally:
+                self._slots.release()
+                self._service_time = 0.9 * self._service_time + 0.1 * (time.monotonic() - _served)
+
+    @asynccontextmanager
+    async def _session(self, session_id: str) -> AsyncIterator[None]:
+        _entry = self._session_locks.setdefault(session_id, [asyncio.Lock(), 0])
+        if _entry[1] > self.max_session_queue:
+            SCHEDULER_REJECTED.labels("session_queue_full").inc()
+            raise TooManyRequestsError("Too many pending messages in this session.", retry_after=self.retry_after)
+        _entry[1] += 1
+        SCHEDULER_QUEUE_DEPTH.labels("session").inc()
+        try:
+            _redis_lock = await self._aacquire_session(session_id, _entry[0])
+        except BaseException:
+            self._leave_session(session_id, _entry)
+            raise
+        finally:
+            SCHEDULER_QUEUE_DEPTH.labels("session").dec()
+        try:
+            yield
+        finally:
+            try:
+                await self._arelease_redis_lock(session_id, _redis_lock)
+            finally:
+                _entry[0].release()
+                self._leave_session(session_id, _entry)
+
+    async def _aacquire_session(self, session_id: str, lock: asyncio.Lock):
+        """
+        Takes the in-process lock of the session, then its Redis lock if `distributed_session_lock`.
+        The Redis lock expires on its own if the worker holding it crashed.
+        """
+        _start = time.monotonic()
+        try:
+            await asyncio.wait_for(lock.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            SCHEDULER_REJECTED.labels("session_timeout").inc()
+            raise TooManyRequestsError("Timed out waiting for the previous message of this session.", retry_after=self.retry_after)
+        if not self.distributed_session_lock:
+            return None
+        _redis_lock = self.async_redis_client.lock(
+            f"chat_lock:{session_id}", timeout=self.session_lock_timeout, sleep=0.05,
+            blocking_timeout=max(0.0, self.queue_timeout - (time.monotonic() - _start)),
+        )
+        try:
+            _acquired = await _redis_lock.acquire()
+        except BaseException:
+            lock.release()
+            raise
+        if not _acquired:
+            lock.release()
+            SCHEDULER_REJECTED.labels("session_timeout").inc()
+            raise TooManyRequestsError("Timed out waiting for the previous message of this session.", retry_after=self.retry_after)
+        return _redis_lock
+
+    async def _arelease_redis_lock(self, session_id: str, redis_lock):
+        if redis_lock is None:
+            return
+        try:
+            await redis_lock.release()
+        except LockError as e:
+            self.logger.warning(f"Session lock of {session_id} expired before release. Error: {e}.")
+        except Exception as e:
+            # the lock expires on its own after session_lock_timeout
+            self.logger.warning(f"Failed to release session lock of {session_id}. Error: {e}.")
+
+    def _leave_session(self, session_id: str, entry: List):
+        entry[1] -= 1
+        if entry[1] == 0:
+            self._session_locks.pop(session_id, None)
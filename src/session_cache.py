@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the in-process cache of the recent session histories and the session affinity hint
+"""
+from collections import OrderedDict
+import os
+import socket
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+# project imports
+from src.utils.metrics import SESSION_CACHE_BYTES, SESSION_CACHE_LOOKUPS
+# the affinity middleware is imported by the app, which does not load langchain
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+# overrides the instance_id of the 'affinity' config, e.g. set from the instance metadata by the deployment
+INSTANCE_ID_VAR = "RENKEBOT_INSTANCE_ID"
+# rough in-memory footprint of a message object besides its content
+MESSAGE_OVERHEAD = 600
+
+
+def message_bytes(messages: Sequence["BaseMessage"]) -> int:
+    """Approximates the memory held by decoded messages."""
+    return sum(sys.getsizeof(m.content) + MESSAGE_OVERHEAD for m in messages)
+
+
+class _Entry():
+    __slots__ = ("version", "offset", "messages", "size", "expires")
+
+    def __init__(self, version: int, offset: int, messages: List["BaseMessage"], expires: float):
+        self.version = version
+        self.offset = offset
+        self.messages = messages
+        self.size = message_bytes(messages)
+        self.expires = expires
+
+
+class SessionCache():
+    """
+    LRU cache of the tails of the recent session histories, bounded by their approximate size in bytes.
+    Each entry carries the version of the session, a Redis counter incremented by every append, and is
+    only served while that version is current. A session written by another worker is thus read again
+    from Redis, while the turns of a session staying on this worker only read the counter.
+    Entries expire with the session in Redis, so that a session id reused later is never served stale.
+
+    Attributes:
+        max_bytes (int): Bound of the total size of the cached messages
+        size (int): Current total size of the cached messages
+    """
+    def __init__(self, cache_config: dict):
+        self.max_bytes = cache_config['max_bytes']
+        self.size = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # the blocking history methods run on executor threads
+        self._lock = threading.Lock()
+        self._stats = {"hit": 0, "miss": 0, "stale": 0, "evictions": 0}
+
+    def get(self, session_id: str, version: int) -> Optional[Tuple[int, List["BaseMessage"]]]:
+        """Returns the offset and the tail of the session at `version`, None if not cached."""
+        with self._lock:
+            _entry = self._entries.get(session_id)
+            if _entry is None:
+                return self._count("miss", None)
+            if _entry.version != version or _entry.expires < time.monotonic():
+                self._remove(session_id)
+                return self._count("stale", None)
+            self._entries.move_to_end(session_id)
+            return self._count("hit", (_entry.offset, list(_entry.messages)))
+
+    def put(self, session_id: str, version: int, offset: int, messages: List["BaseMessage"], ttl: Optional[float]):
+        """Caches the tail read from Redis, `ttl` is the remaining lifetime of the session in seconds."""
+        with self._lock:
+            self._remove(session_id)
+            _expires = time.monotonic() + ttl if ttl else float("inf")
+            self._insert(session_id, _Entry(version, offset, list(messages), _expires))
+
+    def append(self, session_id: str, version: int, messages: Sequence["BaseMessage"], tail: Optional[int], ttl: Optional[float]):
+        """
+        Applies an append written through to Redis, which moved the session to `version`. The entry is
+        dropped when the session was written elsewhere since it was cached.
+        """
+        with self._lock:
+            _entry = self._remove(session_id)
+            if _entry is None or _entry.version != version - 1:
+                return
+            _messages = _entry.messages + list(messages)
+            _offset = _entry.offset
+            if tail and len(_messages) > tail:
+                _offset += len(_messages) - tail
+                _messages = _messages[-tail:]
+            _expires = time.monotonic() + ttl if ttl else float("inf")
+            self._insert(session_id, _Entry(version, _offset, _messages, _expires))
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._remove(session_id)
+
+    def stats(self) -> dict:
+        _lookups = self._stats["hit"] + self._stats["miss"] + self._stats["stale"]
+        return {
+            **self._stats,
+            "sessions": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hit_ratio": self._stats["hit"] / _lookups if _lookups else 0.0,
+        }
+
+    def _count(self, result: str, value):
+        self._stats[result] += 1
+        SESSION_CACHE_LOOKUPS.labels(result).inc()
+        return value
+
+    def _insert(self, session_id: str, entry: _Entry):
+        if entry.size > self.max_bytes:
+            return
+        self._entries[session_id] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+        SESSION_CACHE_BYTES.set(self.size)
+
+    def _remove(self, session_id: str) -> Optional[_Entry]:
+        _entry = self._entries.pop(session_id, None)
+        if _entry is not None:
+            self.size -= _entry.size
+            SESSION_CACHE_BYTES.set(self.size)
+        return _entry
+
+
+class SessionAffinityMiddleware():
+    """
+    ASGI middleware telling the load balancer which instance served a chat request, through a cookie and
+    a response header, so that it can route the next turns of the session to the same instance (e.g. the
+    application cookie stickiness of an AWS ALB, or a `cookie` directive of HAProxy). The session cache
+    then serves these turns from memory.
+    The cookie names the instance the load balancer routes to, not the worker process: the turns of a
+    session are spread over the workers of the instance, whose caches check the session version anyway.
+    Only the `paths` of the chat endpoints get the header, and the cookie when the request carries none
+    or the one of another instance.
+
+    Attributes:
+        cookie (str): Name of the affinity cookie
+        instance_id (str): Id of this instance, the value of the cookie
+        paths (set): Paths of the chat endpoints
+    """
+    def __init__(self, app, paths: List[str], cookie: str = "chat_affinity", max_age: int = 7200, instance_id: str = ""):
+        self.app = app
+        self.paths = set(paths)
+        self.cookie = cookie
+        self.max_age = max_age
+        self.instance_id = os.environ.get(INSTANCE_ID_VAR) or instance_id or socket.gethostname()
+        self._cookie_header = f"{self.cookie}={self.instance_id}; Max-Age={self.max_age}; Path=/; HttpOnly; SameSite=Lax".encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        _sticky = self._cookie_value(scope["headers"]) == self.instance_id
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                _headers = list(message.get("headers", [])) + [(b"x-served-by", self.instance_id.encode())]
+                if not _sticky:
+                    _headers.append((b"set-cookie", self._cookie_header))
+                message["headers"] = _headers
+            await send(message)
+        await self.app(scope, receive, _send)
+
+    def _cookie_value(self, headers) -> Optional[str]:
+        for k, v in headers:
+            if k != b"cookie":
+                continue
+            for _pair in v.decode("latin-1").split(";"):
+                _name, _, _value = _pair.strip().partition("=")
+                if _name == self.cookie:
+                    return _value
+        return None
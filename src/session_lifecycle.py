@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the lifecycle of the chat sessions stored in Redis: sliding expiry, size caps and memory budget
+"""
+import asyncio
+import logging
+import time
+from typing import List, Optional, Sequence, Tuple
+import redis
+import redis.asyncio as aioredis
+# project imports
+from src.utils.exceptions import SessionLimitError
+from src.utils.metrics import ACTIVE_SESSIONS, SESSION_EVICTIONS, SESSION_STORE_BYTES
+
+# bound of the sweep arguments that are not configured
+_NEVER = 2 ** 53
+
+# Removes a session from the index, shared by the scripts below. The keys of the session are not
+# declared in KEYS, they are deleted by the client once the script returned (Redis Cluster safe).
+# KEYS: index (zset of the last activity), sizes and lengths (hashes of the stored bytes and messages),
+# total (bytes of all sessions)
+_REMOVE = """
+local function remove(sid)
+    local size = tonumber(redis.call('HGET', KEYS[2], sid)) or 0
+    redis.call('ZREM', KEYS[1], sid)
+    redis.call('HDEL', KEYS[2], sid)
+    redis.call('HDEL', KEYS[3], sid)
+    if size ~= 0 then
+        redis.call('DECRBY', KEYS[4], size)
+    end
+    return size
+end
+"""
+
+# ARGV: session id
+FORGET_SCRIPT = _REMOVE + """
+return remove(ARGV[1])
+"""
+
+# Drops the sessions idle beyond the TTL, whose keys expired, then evicts the least recently active
+# sessions while the total exceeds the budget, down to `target` bytes.
+# ARGV: ttl (ms), budget (bytes), target (bytes), max evictions
+# Returns {expired, evicted, sessions, total bytes, ids of the removed sessions...}
+SWEEP_SCRIPT = _REMOVE + """
+local _time = redis.call('TIME')
+local now = tonumber(_time[1]) * 1000 + math.floor(tonumber(_time[2]) / 1000)
+local budget, target, max_evictions = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[1]), 'LIMIT', 0, max_evictions)
+local removed = {}
+for _, sid in ipairs(expired) do
+    remove(sid)
+    removed[#removed + 1] = sid
+end
+local total = tonumber(redis.call('GET', KEYS[4])) or 0
+local evicted = 0
+if total > budget then
+    while total > target and evicted < max_evictions do
+        local oldest = redis.call('ZRANGE', KEYS[1], 0, 0)
+        if #oldest == 0 then
+            -- nothing left to account for, resets a drifted total
+            redis.call('SET', KEYS[4], 0)
+            total = 0
+            break
+        end
+        total = total - remove(oldest[1])
+        removed[#removed + 1] = oldest[1]
+        evicted = evicted + 1
+    end
+end
+local result = {#expired, evicted, redis.call('ZCARD', KEYS[1]), total}
+for _, sid in ipairs(removed) do
+    result[#result + 1] = sid
+end
+return result
+"""
+
+
+class SessionLifecycle():
+    """
+    Bounds the memory the chat sessions take in Redis:
+    - every turn refreshes the expiry of all the keys of its session (history, version, summary), so
+      that a session expires `ttl` seconds after its last turn rather than piecemeal,
+    - every append records the last activity of the session in a sorted-set index, and adds its
+      messages and the size of their encoding to the counts of the session and to the total,
+    - a turn is rejected once its session holds `max_messages` messages or `max_bytes` bytes,
+    - a sweeper drops the index entries of the expired sessions and, once the total exceeds
+      `max_total_bytes`, evicts the least recently active sessions down to `evict_to` of the budget.
+    The sizes count the encoded messages only, the summaries are bounded by the history policy.
+    The accounting of the sweep is one atomic script, so the sweepers of several workers may run
+    concurrently. The script only touches the index keys. The keys of the removed sessions are deleted
+    in one pipeline after it returns, so a turn landing in between on an evicted session writes keys
+    that are no longer accounted for. Their expiry still bounds them.
+
+    Attributes:
+        ttl (int): Seconds a session is kept after its last turn
+        max_messages (int): Messages of a session beyond which its turns are rejected, None for no cap
+        max_bytes (int): Stored bytes of a session beyond which its turns are rejected, None for no cap
+        max_total_bytes (int): Budget of the stored bytes of all sessions, None for no budget
+        evict_to (float): Fraction of the budget the eviction frees the sessions down to
+        sweep_interval (float): Seconds between the sweeps
+        max_evictions (int): Sessions removed per sweep at most
+        key_patterns (list): Prefix and suffix of each key of a session, e.g. ("history:", ":v")
+    """
+    def __init__(
+        self,
+        lifecycle_config: dict,
+        redis_client: redis.Redis,
+        async_redis_client: aioredis.Redis,
+        logger: logging.Logger,
+        key_patterns: Sequence[Tuple[str, str]],
+        ttl: Optional[int] = None,
+    ):
+        self.ttl = ttl
+        self.max_messages = lifecycle_config.get('max_messages')
+        self.max_bytes = lifecycle_config.get('max_bytes')
+        self.max_total_bytes = lifecycle_config.get('max_total_bytes')
+        self.evict_to = lifecycle_config.get('evict_to', 0.9)
+        self.sweep_interval = lifecycle_config.get('sweep_interval', 10)
+        self.max_evictions = lifecycle_config.get('max_evictions', 500)
+        self.key_patterns = list(key_patterns)
+        self.logger = logger
+        _prefix = lifecycle_config.get('index_prefix', "sessions:")
+        self.index_key, self.total_key = f"{_prefix}active", f"{_prefix}total"
+        self.sizes_key, self.lengths_key = f"{_prefix}bytes", f"{_prefix}messages"
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self._forget = redis_client.register_script(FORGET_SCRIPT)
+        self._aforget = async_redis_client.register_script(FORGET_SCRIPT)
+        self._asweep = async_redis_client.register_script(SWEEP_SCRIPT)
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @property
+    def _keys(self) -> List[str]:
+        return [self.index_key, self.sizes_key, self.lengths_key, self.total_key]
+
+    def touch(self, pipe, session_id: str, messages: int, size: int) -> None:
+        """Queues the accounting of an append of `messages` of `size` bytes and the expiry refresh of the session keys."""
+        pipe.zadd(self.index_key, {session_id: self._now_ms()})
+        pipe.hincrby(self.sizes_key, session_id, size)
+        pipe.hincrby(self.lengths_key, session_id, messages)
+        pipe.incrby(self.total_key, size)
+        if self.ttl:
+            for _prefix, _suffix in self.key_patterns:
+                pipe.expire(_prefix + session_id + _suffix, self.ttl)
+
+    async def acheck(self, session_id: str):
+        """Raises SessionLimitError if the session reached its caps, before its turn calls the model."""
+        if not (self.max_messages or self.max_bytes):
+            return
+        pipe = self.async_redis_client.pipeline(transaction=False)
+        pipe.hget(self.lengths_key, session_id)
+        pipe.hget(self.sizes_key, session_id)
+        _length, _size = [int(r or 0) for r in await pipe.execute()]
+        if self.max_messages and _length >= self.max_messages:
+            raise SessionLimitError(f"The session reached its limit of {self.max_messages} messages, please start a new session.")
+        if self.max_bytes and _size >= self.max_bytes:
+            raise SessionLimitError("The session reached its size limit, please start a new session.")
+
+    def _delete(self, pipe, session_ids: Sequence[str]) -> None:
+        """Queues the deletion of the keys of the sessions, one key per command as they may hash to different slots."""
+        for _sid in session_ids:
+            for _prefix, _suffix in self.key_patterns:
+                pipe.delete(_prefix + _sid + _suffix)
+
+    def forget(self, session_id: str) -> None:
+        self._forget(keys=self._keys, args=[session_id])
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._delete(pipe, [session_id])
+        pipe.execute()
+
+    async def aforget(self, session_id: str) -> None:
+        """Removes the session from the index and deletes its keys."""
+        await self._aforget(keys=self._keys, args=[session_id])
+        pipe = self.async_redis_client.pipeline(transaction=False)
+        self._delete(pipe, [session_id])
+        await pipe.execute()
+
+    async def asweep(self) -> Tuple[int, int]:
+        """Runs one sweep, returns the numbers of expired and evicted sessions."""
+        _budget = self.max_total_bytes
+        _args = [
+            self.ttl * 1000 if self.ttl else _NEVER,
+            _budget or _NEVER,
+            int(_budget * self.evict_to) if _budget else _NEVER,
+            self.max_evictions,
+        ]
+        _expired, _evicted, _sessions, _total, *_removed = await self._asweep(keys=self._keys, args=_args)
+        if _removed:
+            pipe = self.async_redis_client.pipeline(transaction=False)
+            self._delete(pipe, [_sid.decode() if isinstance(_sid, bytes) else _sid for _sid in _removed])
+            await pipe.execute()
+        ACTIVE_SESSIONS.set(_sessions)
+        SESSION_STORE_BYTES.set(_total)
+        if _evicted:
+            SESSION_EVICTIONS.inc(_evicted)
+            self.logger.warning(f"Evicted {_evicted} least recently active sessions, over the budget of {_budget} bytes.")
+        return _expired, _evicted
+
+    async def astart(self):
+        self._sweeper = asyncio.create_task(self._asweep_forever())
+
+    async def aclose(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+
+    async def _asweep_forever(self):
+        while True:
+            try:
+                await self.asweep()
+            except redis.RedisError as e:
+                self.logger.warning(f"Failed to sweep the sessions. Error: {e}.")
+            await asyncio.sleep(self.sweep_interval)
+
+    @staticmethod
+    def _now_ms() -> int:
+        # the activity scores are compared to the clock of Redis by the sweep, the hosts are NTP synced
+        return int(time.time() * 1000)
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the callback handler instrumenting the chains of the chat engine, apart from
+src/utils/metrics.py so that the metrics do not import langchain
+"""
+import time
+from typing import Any, Dict
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+# project imports
+from src.utils.metrics import (
+    INFLIGHT_LLM_CALLS, TIER_LATENCY, TIER_TOKENS, TOKENS, add_request_tokens, observe_prompt_cache, observe_stage
+)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler timing the prompt rendering and the model call of the conversation chain,
+    and counting the tokens reported by the model.
+    """
+    # the handler is cheap, run it on the event loop instead of the executor
+    run_inline = True
+
+    def __init__(self):
+        self._prompt_starts: Dict[UUID, float] = {}
+        # run_id -> [start, first token timestamp, model tier]
+        self._llm_runs: Dict[UUID, list] = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, **kwargs: Any):
+        if kwargs.get("run_type") == "prompt":
+            self._prompt_starts[run_id] = time.perf_counter()
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any):
+        _start = self._prompt_starts.pop(run_id, None)
+        if _start is not None:
+            observe_stage("prompt_render", time.perf_counter() - _start)
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._prompt_starts.pop(run_id, None)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any):
+        self._llm_runs[run_id] = [time.perf_counter(), None, (kwargs.get("metadata") or {}).get("model_tier")]
+        INFLIGHT_LLM_CALLS.inc()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        _run = self._llm_runs.get(run_id)
+        if _run is not None and _run[1] is None:
+            _run[1] = time.perf_counter()
+            observe_stage("llm_ttft", _run[1] - _run[0])
+            if _run[2]:
+                TIER_LATENCY.labels(_run[2], "ttft").observe(_run[1] - _run[0])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        _run = self._llm_runs.pop(run_id, None)
+        if _run is None:
+            return
+        INFLIGHT_LLM_CALLS.dec()
+        _end = time.perf_counter()
+        # generation time after the first token when streaming, the whole call otherwise
+        observe_stage("llm_generation", _end - (_run[1] or _run[0]))
+        if _run[2]:
+            TIER_LATENCY.labels(_run[2], "total").observe(_end - _run[0])
+        for _generations in response.generations:
+            for _generation in _generations:
+                _usage = getattr(getattr(_generation, "message", None), "usage_metadata", None)
+                if _usage:
+                    TOKENS.labels("input").inc(_usage.get("input_tokens", 0))
+                    TOKENS.labels("output").inc(_usage.get("output_tokens", 0))
+                    if _run[2]:
+                        TIER_TOKENS.labels(_run[2], "input").inc(_usage.get("input_tokens", 0))
+                        TIER_TOKENS.labels(_run[2], "output").inc(_usage.get("output_tokens", 0))
+                    observe_prompt_cache(_usage, _run[2] or "primary")
+                    add_request_tokens(_usage)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any):
+        if self._llm_runs.pop(run_id, None) is not None:
+            INFLIGHT_LLM_CALLS.dec()
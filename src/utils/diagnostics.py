@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the runtime diagnostics of a server worker: event loop lag, executor utilization
+and the sampling profiler
+"""
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+# project imports
+from src.utils.metrics import EVENT_LOOP_LAG, EVENT_LOOP_STALLS, EXECUTOR_QUEUE_DEPTH, EXECUTOR_THREADS
+
+# overrides the profile_token of the 'diagnostics' config, to keep it out of the config file
+DEBUG_TOKEN_VAR = "RENKEBOT_DEBUG_TOKEN"
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor counting its busy threads, for the utilization gauges of the loop's default executor."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.busy = 0
+        self._busy_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        def _tracked():
+            with self._busy_lock:
+                self.busy += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._busy_lock:
+                    self.busy -= 1
+        return super().submit(_tracked)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._work_queue.qsize()
+
+
+class LoopMonitor():
+    """
+    Measures the lag of the event loop, the delay of a probe scheduled every `interval` seconds, and
+    updates the utilization gauges of the executor. A watchdog thread checks the heartbeat of the probe:
+    once the loop is blocked for more than `slow_threshold` seconds, the stack of the loop thread is
+    logged while the blocking code still runs, once per stall.
+
+    Attributes:
+        interval (float): Seconds between the probes
+        slow_threshold (float): Seconds of lag from which a stall is counted and its stack logged
+        executor (InstrumentedThreadPoolExecutor): Default executor of the loop, None if not instrumented
+    """
+    def __init__(self, diagnostics_config: dict, logger: logging.Logger, executor: Optional[InstrumentedThreadPoolExecutor] = None):
+        self.interval = diagnostics_config.get('lag_interval', 0.25)
+        self.slow_threshold = diagnostics_config.get('slow_threshold', 0.1)
+        self.logger = logger
+        self.executor = executor
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._probe: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts the probe and the watchdog, from the event loop."""
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._probe = asyncio.create_task(self._aprobe())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        if self.executor is not None:
+            EXECUTOR_THREADS.labels("max").set(self.executor._max_workers)
+
+    async def aclose(self):
+        self._stop.set()
+        if self._probe is not None:
+            self._probe.cancel()
+            await asyncio.gather(self._probe, return_exceptions=True)
+
+    async def _aprobe(self):
+        while True:
+            _expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            _now = time.monotonic()
+            self._heartbeat = _now
+            EVENT_LOOP_LAG.observe(max(0.0, _now - _expected))
+            if self.executor is not None:
+                EXECUTOR_THREADS.labels("busy").set(self.executor.busy)
+                EXECUTOR_QUEUE_DEPTH.set(self.executor.queue_depth)
+
+    def _watch(self):
+        _stalled = False
+        while not self._stop.wait(self.slow_threshold / 2):
+            _blocked = time.monotonic() - self._heartbeat - self.interval
+            if _blocked < self.slow_threshold:
+                _stalled = False
+                continue
+            if _stalled:
+                continue
+            _stalled = True
+            EVENT_LOOP_STALLS.inc()
+            _frame = sys._current_frames().get(self._loop_thread)
+            _stack = "".join(traceback.format_stack(_frame)) if _frame is not None else "(stack unavailable)\n"
+            self.logger.warning(f"Event loop blocked for {_blocked:.3f}s, stack of the loop thread:\n{_stack}")
+
+
+class SamplingProfiler():
+    """
+    Samples the stacks of every thread of the worker, except its own, every `interval` seconds and
+    aggregates them in the collapsed format of flamegraph.pl and speedscope: one line per distinct
+    stack, `thread;outermost frame;...;innermost frame count`. The served traffic keeps running.
+
+    Attributes:
+        interval (float): Seconds between the samples
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+
+    def run(self, seconds: float) -> str:
+        """Samples for `seconds` in the calling thread, returns the collapsed stacks."""
+        _me = threading.get_ident()
+        _stacks: Counter = Counter()
+        _deadline = time.monotonic() + seconds
+        while time.monotonic() < _deadline:
+            _names = {t.ident: t.name for t in threading.enumerate()}
+            for _thread, _frame in sys._current_frames().items():
+                if _thread != _me:
+                    _stacks[self._collapse(_names.get(_thread, str(_thread)), _frame)] += 1
+            time.sleep(self.interval)
+        return "".join(f"{_stack} {_count}\n" for _stack, _count in _stacks.most_common())
+
+    async def arun(self, seconds: float) -> str:
+        """Samples from a thread of its own, the executor being one of the profiled parts."""
+        _loop = asyncio.get_running_loop()
+        _done = _loop.create_future()
+        def _target():
+            try:
+                _result = self.run(seconds)
+                _loop.call_soon_threadsafe(_done.set_result, _result)
+            except Exception as e:
+                _loop.call_soon_threadsafe(_done.set_exception, e)
+        threading.Thread(target=_target, name="sampling-profiler", daemon=True).start()
+        return await _done
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        _frames = []
+        while frame is not None:
+            _code = frame.f_code
+            _frames.append(f"{_code.co_name} ({os.path.basename(_code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        # the separator of the frames can't appear in them, flamegraph.pl splits the count at the last space
+        return ";".join(f.replace(";", ":") for f in [thread_name] + _frames[::-1])
+
+
+def debug_token(diagnostics_config: dict) -> Optional[str]:
+    """Token of the debug endpoints, None if they are disabled."""
+    return os.environ.get(DEBUG_TOKEN_VAR) or diagnostics_config.get('profile_token') or None
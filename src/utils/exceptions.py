@@ -4,6 +4,24 @@
 This module contains customized exception classes
 """
 
+# errors of Bedrock asking the caller to slow down: throttling, and the lack of capacity of the model
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ModelNotReadyException",
+}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {"InternalServerException", "ModelTimeoutException"}
+
+
+def error_code(e: BaseException):
+    """Error code of a botocore ClientError, None for the other exceptions, read without importing botocore."""
+    _response = getattr(e, "response", None)
+    return _response.get("Error", {}).get("Code") if isinstance(_response, dict) else None
+
+
+def is_throttled(e: BaseException) -> bool:
+    """Whether Bedrock asks to slow down, shared by the model endpoints and the batch limiter."""
+    return error_code(e) in THROTTLING_ERROR_CODES
+
+
 
 class UserAuthenticationError(Exception):
     def __init__(self, message, status_code=403):
@@ -21,6 +39,29 @@ class InvalidRequestError(Exception):
     def __str__(self):
         return self.message
 
+class TooManyRequestsError(Exception):
+    """
+    Raised when the service is saturated, the client should retry after `retry_after` seconds
+    """
+    def __init__(self, message, status_code=429, retry_after=1):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+    def __str__(self):
+        return self.message
+
+class SessionLimitError(Exception):
+    """
+    Raised when a session reached its caps of messages or bytes, the client should start a new session
+    """
+    def __init__(self, message, status_code=413):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+    def __str__(self):
+        return self.message
+
 class IOError(Exception):
     def __init__(self, message, status_code=490):
         super().__init__(message)
@@ -49,6 +90,18 @@ class UndefinedInternalError(Exception):
     def __str__(self):
         return self.message
 
+class UpstreamUnavailableError(Exception):
+    """
+    Raised when no model endpoint can serve the call, the client should retry after `retry_after` seconds
+    """
+    def __init__(self, message, status_code=503, retry_after=5):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+    def __str__(self):
+        return self.message
+
 class UndefinedDatabaseError(Exception):
     def __init__(self, message, status_code=560):
         super().__init__(message)
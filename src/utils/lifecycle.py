@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the readiness state and the graceful drain of a server worker
+"""
+import asyncio
+from contextlib import contextmanager
+import logging
+import os
+import signal
+import threading
+import time
+
+# number of worker processes of the instance, set for the workers by the prod mode of main.py
+WORKERS_VAR = "RENKEBOT_WORKERS"
+
+
+def resolve_workers(workers) -> int:
+    """Number of worker processes, 'auto' uses the CPUs available to this process."""
+    if workers in (None, "auto"):
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
+    return int(workers)
+
+
+class ServiceLifecycle():
+    """
+    Readiness and in-flight request tracking of one server worker.
+    On SIGTERM the worker reports not ready (so that the load balancer stops routing to it), waits
+    for the in-flight and streaming requests to complete, and only then hands the signal over to
+    the server, which stops accepting connections and exits.
+
+    Attributes:
+        ready (bool): Set once the engine and its connection pools are warm
+        draining (bool): Set once a shutdown signal was received
+        inflight (int): Requests being served
+    """
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.ready = False
+        self.draining = False
+        self.inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.ready and not self.draining
+
+    @contextmanager
+    def track(self):
+        """Marks a request as in flight for the duration of the block."""
+        self.inflight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            if self.inflight == 0:
+                self._idle.set()
+
+    async def wait_drained(self, timeout: float) -> bool:
+        """Waits until no request is in flight, returns False if the timeout expired first."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def install_drain_handler(self, timeout: float, sig: int = signal.SIGTERM):
+        """
+        Delays the server's own handler of `sig` until the in-flight requests are drained.
+        Must be called from the event loop, after the server installed its signal handlers.
+        """
+        loop = asyncio.get_running_loop()
+        _server_handler = signal.getsignal(sig)
+        # signal handlers can only be set from the main thread (not the case under a test client)
+        if not callable(_server_handler) or threading.current_thread() is not threading.main_thread():
+            return
+        def _handler(signum, frame):
+            if self.draining:
+                # second signal, stop waiting
+                return _server_handler(signum, frame)
+            self.draining = True
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._adrain(_server_handler, signum, frame, timeout)))
+        signal.signal(sig, _handler)
+
+    async def _adrain(self, server_handler, signum, frame, timeout: float):
+        _start = time.monotonic()
+        self.logger.info(f"Received signal {signum}, draining {self.inflight} in-flight requests.")
+        if not await self.wait_drained(timeout):
+            self.logger.warning(f"Drain timed out after {timeout}s with {self.inflight} requests in flight.")
+        else:
+            self.logger.info(f"Drained in-flight requests in {time.monotonic() - _start:.1f}s, shutting down.")
+        server_handler(signum, frame)
@@ -2,20 +2,32 @@
 # Author: Liu Renke
 
 #standard imports
+import atexit
+import copy
 from datetime import datetime as dt
 import inspect
 import json
 import logging
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
 import os
 from pathlib import Path
-import shutil
+import queue
 import sys
 import time
+from typing import Dict, List, Optional
+# project imports
+from src.utils.metrics import LOG_RECORDS_DROPPED
 
 
 LOG_ROOT_DIR = Path.cwd()/'logs'
-LOG_DIR = LOG_ROOT_DIR/dt.now().strftime("%Y%m%d-%H%M%S")
+# set to 1 when several worker processes share LOG_ROOT_DIR, each then writes and rotates files of its own
+LOG_PER_PROCESS_VAR = "RENKEBOT_LOG_PER_PROCESS"
+# records waiting for the background writer, beyond which the overflow policy applies
+LOG_QUEUE_SIZE = 10000
+# 'drop' discards records when the queue is full, 'block' waits up to LOG_BLOCK_TIMEOUT seconds
+LOG_OVERFLOW_POLICY = "drop"
+LOG_BLOCK_TIMEOUT = 0.05
 LOG_CONFIG = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -26,31 +38,38 @@ LOG_CONFIG = {
         "brief": {
             "format": '%(asctime)s %(levelname)-7s >>> %(message)s',
         },
+        "json": {
+            "()": "src.utils.loggers.JsonFormatter",
+        },
     },
     "handlers": {
         "server_log_file": {
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.RotatingFileHandler",
             "formatter": "verbose",
-            "filename": LOG_DIR/"server.log",
-            "mode": "a",
+            "filename": LOG_ROOT_DIR/"server.log",
+            "maxBytes": 20 * 1024 * 1024,
+            "backupCount": 5,
         },
         "app_log_file": {
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.RotatingFileHandler",
             "formatter": "verbose",
-            "filename": LOG_DIR/"app.log",
-            "mode": "a",
+            "filename": LOG_ROOT_DIR/"app.log",
+            "maxBytes": 20 * 1024 * 1024,
+            "backupCount": 5,
         },
         "query_log_file": {
-            "class": "logging.FileHandler",
-            "formatter": "verbose",
-            "filename": LOG_DIR/f'query.log',
-            "mode": "a",
+            "class": "logging.handlers.TimedRotatingFileHandler",
+            "formatter": "json",
+            "filename": LOG_ROOT_DIR/f'query.log',
+            "when": "midnight",
+            "backupCount": 14,
         },
         "chat_engine_log_file": {
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.RotatingFileHandler",
             "formatter": "verbose",
-            "filename": LOG_DIR/f'chat_engine.log',
-            "mode": "a",
+            "filename": LOG_ROOT_DIR/f'chat_engine.log',
+            "maxBytes": 20 * 1024 * 1024,
+            "backupCount": 5,
         },
         "error_console": {
             "class": "logging.StreamHandler",
@@ -92,21 +111,109 @@ LOG_CONFIG = {
             "handlers": ["app_log_file", "app_console"],
             "level": "DEBUG",
             "propagate": False
+        },
+        "query_logger": {
+            "handlers": ["query_log_file"],
+            "level": "INFO",
+            "propagate": False
         }
     },
 }
+# background writer of the log records, started by setup_logging
+_LISTENER: Optional["RoutingQueueListener"] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, including the fields passed in `extra`."""
+    _RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "_route"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        _record = {
+            "ts": dt.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        _record.update({k: v for k, v in vars(record).items() if k not in self._RESERVED})
+        return json.dumps(_record, ensure_ascii=False, default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue instead of writing them, so that logging never performs I/O on
+    the calling thread. Records are tagged with the logger they belong to for the routing listener.
+    When the queue is full, records are dropped or the caller waits briefly, depending on the policy.
+    """
+    def __init__(self, log_queue: queue.Queue, route: str, policy: str = LOG_OVERFLOW_POLICY):
+        super().__init__(log_queue)
+        self.route = route
+        self.policy = policy
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # records are formatted by the destination handlers, only resolve the message and exception text
+        record = logging.makeLogRecord(vars(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.getMessage(), None, None
+        record._route = self.route
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.policy == "block":
+                self.queue.put(record, timeout=LOG_BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class RoutingQueueListener(QueueListener):
+    """Writes the queued records in a background thread, with the handlers of the logger they belong to."""
+    def __init__(self, log_queue: queue.Queue, routes: Dict[str, List[logging.Handler]]):
+        super().__init__(log_queue, respect_handler_level=True)
+        self.routes = routes
+
+    def handle(self, record: logging.LogRecord):
+        for handler in self.routes.get(record._route, []):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+def per_process_config(config: dict, pid: int) -> dict:
+    """Copy of the logging config whose files are named after the process, e.g. app-1234.log."""
+    config = copy.deepcopy(config)
+    for handler in config["handlers"].values():
+        if "filename" in handler:
+            _path = Path(handler["filename"])
+            handler["filename"] = _path.with_name(f"{_path.stem}-{pid}{_path.suffix}")
+    return config
 
-def setup_logging(keep:int=5):
+def setup_logging(queue_size:int=LOG_QUEUE_SIZE, policy:str=LOG_OVERFLOW_POLICY, per_process:Optional[bool]=None):
+    """
+    Configures the loggers, and moves the writing of their records to a background thread.
+    Log files are rotated by size (query.log daily) instead of being kept in per-run folders.
+    With `per_process` (RENKEBOT_LOG_PER_PROCESS=1 by default), the files are named after the pid of
+    the process, as the rotation of a file shared by several processes would clobber their records.
+    """
+    global _LISTENER
+    if per_process is None:
+        per_process = os.environ.get(LOG_PER_PROCESS_VAR) == "1"
     # verify log directories
-    LOG_DIR.mkdir(parents=True, exist_ok=True)
-    # prune obsolete log folders (sub-directories) from root directory
-    folders = [f.path for f in os.scandir(LOG_ROOT_DIR) if f.is_dir()]
-    folders.sort(key=lambda x: os.path.getmtime(LOG_ROOT_DIR / x), reverse=True)
-    # remove obsolete log files/folders
-    folders_to_keep = folders[:keep]
-    for folder in folders:
-        if folder not in folders_to_keep:
-            folder_path = LOG_ROOT_DIR / folder
-            shutil.rmtree(folder_path)
+    LOG_ROOT_DIR.mkdir(parents=True, exist_ok=True)
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        atexit.unregister(_LISTENER.stop)
     # reset all logger's config
-    dictConfig(LOG_CONFIG)
+    dictConfig(per_process_config(LOG_CONFIG, os.getpid()) if per_process else LOG_CONFIG)
+    # swap the configured handlers for queue handlers, the listener writes with the original ones
+    log_queue = queue.Queue(maxsize=queue_size)
+    routes = {}
+    for name in ["", *LOG_CONFIG["loggers"]]:
+        _logger = logging.getLogger(name)
+        routes[name] = list(_logger.handlers)
+        for handler in routes[name]:
+            _logger.removeHandler(handler)
+        _logger.addHandler(BoundedQueueHandler(log_queue, route=name, policy=policy))
+    _LISTENER = RoutingQueueListener(log_queue, routes)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the Prometheus metrics of the chat service and the hot path instrumentation
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+from pathlib import Path
+import tempfile
+import time
+from typing import Dict, Optional
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+STAGE_LATENCY = Histogram(
+    "chat_stage_latency_seconds",
+    "Latency of the stages of a chat turn "
+    "(history_load, retrieval, prompt_render, llm_ttft, llm_generation, history_write)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_LATENCY = Histogram(
+    "chat_request_latency_seconds", "End to end latency of the chat endpoints", ["endpoint"], buckets=LATENCY_BUCKETS,
+)
+TOKENS = Counter("chat_tokens_total", "Tokens processed by the chat model", ["direction"])
+INFLIGHT_REQUESTS = Gauge(
+    "chat_inflight_requests", "Requests being served by the chat endpoints", ["endpoint"], multiprocess_mode="livesum"
+)
+INFLIGHT_LLM_CALLS = Gauge("chat_inflight_llm_calls", "Calls to the chat model in flight", multiprocess_mode="livesum")
+ERRORS = Counter("chat_errors_total", "Failed chat requests by exception class", ["endpoint", "exception"])
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "chat_scheduler_queue_depth", "Chat turns waiting for a slot", ["queue"], multiprocess_mode="livesum"
+)
+SCHEDULER_WAIT = Histogram(
+    "chat_scheduler_wait_seconds", "Time chat turns waited for their session and a global slot", buckets=LATENCY_BUCKETS,
+)
+SCHEDULER_REJECTED = Counter("chat_scheduler_rejected_total", "Chat turns rejected with 429", ["reason"])
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+CACHE_LOOKUPS = Counter("chat_response_cache_lookups_total", "Response cache lookups by result", ["result"])
+TIER_REQUESTS = Counter("chat_model_tier_requests_total", "Chat turns routed to each model tier, by rule", ["tier", "rule"])
+TIER_LATENCY = Histogram(
+    "chat_model_tier_latency_seconds", "Time to first token (ttft) and whole call (total) by model tier", 
+    ["tier", "stage"], buckets=LATENCY_BUCKETS,
+)
+TIER_TOKENS = Counter("chat_model_tier_tokens_total", "Tokens processed by each model tier", ["tier", "direction"])
+PROMPT_CACHE_TOKENS = Counter(
+    "chat_prompt_cache_tokens_total", "Input tokens of the chat model by prompt cache status (read, write, uncached)", ["tier", "status"]
+)
+BATCH_ITEMS = Counter("chat_batch_items_total", "Batch items by outcome (ok, error, throttled, checkpoint)", ["status"])
+BATCH_CONCURRENCY = Gauge("chat_batch_concurrency_limit", "Adaptive concurrency limit of the latest batch", multiprocess_mode="max")
+SESSION_CACHE_LOOKUPS = Counter("chat_session_cache_lookups_total", "Session cache lookups by result (hit, miss, stale)", ["result"])
+SESSION_CACHE_BYTES = Gauge("chat_session_cache_bytes", "Approximate size of the session histories cached in memory", multiprocess_mode="livesum")
+COALESCE_FLIGHTS = Counter("chat_coalesce_flights_total", "Upstream calls started for first turns open to coalescing")
+COALESCED_CALLS = Counter("chat_coalesced_calls_total", "Upstream calls saved by joining an identical call in flight")
+ARCHIVE_RECORDS = Counter(
+    "chat_archive_records_total", "Archived turns by outcome (written, spilled, replayed, dropped)", ["outcome"]
+)
+ARCHIVE_QUEUE_DEPTH = Gauge("chat_archive_queue_depth", "Turns waiting to be archived to Postgres", multiprocess_mode="livesum")
+ARCHIVE_FLUSH_LATENCY = Histogram(
+    "chat_archive_flush_seconds", "Duration of the COPY of a batch of turns to Postgres",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+EMBEDDING_REQUESTS = Counter(
+    "chat_embedding_requests_total", "Query embeddings by result (hit of the LRU, dedup with a pending text, batched)", ["result"]
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    "chat_embedding_batch_size", "Texts per batched embedding call", buckets=(1, 2, 4, 8, 16, 32, 64, 96)
+)
+EMBEDDING_CALLS = Counter("chat_embedding_calls_total", "Embedding calls by model (primary, fallback) and outcome", ["model", "outcome"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Delay of the periodic event loop probe, the time the loop was busy or blocked",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EVENT_LOOP_STALLS = Counter("event_loop_stalls_total", "Event loop blocked beyond the slow threshold of the diagnostics")
+EXECUTOR_THREADS = Gauge(
+    "executor_threads", "Threads of the default executor of the event loop (busy, max)", ["state"], multiprocess_mode="livesum"
+)
+EXECUTOR_QUEUE_DEPTH = Gauge("executor_queue_depth", "Calls waiting for a thread of the default executor", multiprocess_mode="livesum")
+UPSTREAM_ATTEMPTS = Counter(
+    "chat_upstream_attempts_total", "Calls to each model endpoint by outcome (success, failure, cancelled)", ["endpoint", "outcome"]
+)
+UPSTREAM_HEDGES = Counter("chat_upstream_hedges_total", "Hedged calls sent to each model endpoint", ["endpoint"])
+CIRCUIT_STATE = Gauge(
+    "chat_upstream_circuit_state", "Circuit breaker of each model endpoint (0 closed, 1 half open, 2 open)", ["endpoint"],
+    multiprocess_mode="livemax"
+)
+ACTIVE_SESSIONS = Gauge(
+    "chat_active_sessions", "Sessions stored in Redis, as of the last sweep of the session index", multiprocess_mode="livemax"
+)
+SESSION_STORE_BYTES = Gauge(
+    "chat_session_store_bytes", "Encoded messages of the sessions stored in Redis, as of the last sweep", multiprocess_mode="livemax"
+)
+SESSION_EVICTIONS = Counter("chat_session_evictions_total", "Least recently active sessions evicted over the memory budget")
+RATE_LIMIT_DECISIONS = Counter(
+    "chat_rate_limit_decisions_total", "Rate limiter decisions (admitted, delayed, rejected, error)", ["outcome"]
+)
+RATE_LIMIT_DELAY = Histogram(
+    "chat_rate_limit_delay_seconds", "Delay of the admitted requests queued behind their client's earlier requests",
+    buckets=(0, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+
+# stage timings of the current request, only collected when the timing header is requested
+_REQUEST_TIMINGS: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+# model tokens used by the current request, only collected for the rate limited requests
+_REQUEST_TOKENS: ContextVar[Optional[Dict[str, int]]] = ContextVar("request_tokens", default=None)
+
+
+def setup_multiprocess_metrics(path: Path = Path(tempfile.gettempdir())/'renkebot_prometheus'):
+    """
+    Makes the worker processes spawned after this call share their metrics through `path`.
+    Must be called by the parent process before the workers are started.
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    for f in path.glob("*.db"):
+        f.unlink()
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = str(path)
+
+def render_metrics() -> bytes:
+    """Metrics in the Prometheus text format, aggregated over the workers in multi-process mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+def mark_worker_dead():
+    """Drops the live gauges of the current worker in multi-process mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def observe_stage(stage: str, seconds: float):
+    """Records the duration of a stage, and adds it to the timings of the current request."""
+    STAGE_LATENCY.labels(stage).observe(seconds)
+    _timings = _REQUEST_TIMINGS.get()
+    if _timings is not None:
+        _timings[stage] = _timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def stage_timer(stage: str):
+    _start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - _start)
+
+@contextmanager
+def count_request_tokens():
+    """Collects the model tokens used within the block, e.g. by the request, in the yielded dict."""
+    _tokens = {"input": 0, "output": 0}
+    _token = _REQUEST_TOKENS.set(_tokens)
+    try:
+        yield _tokens
+    finally:
+        _REQUEST_TOKENS.reset(_token)
+
+
+def add_request_tokens(usage: dict):
+    """Adds the tokens of a model call to the request collecting them, if any."""
+    _tokens = _REQUEST_TOKENS.get()
+    if _tokens is not None:
+        _tokens["input"] += usage.get("input_tokens", 0)
+        _tokens["output"] += usage.get("output_tokens", 0)
+
+
+def observe_prompt_cache(usage: dict, tier: str):
+    """Counts the input tokens read from and written to the prompt cache, Bedrock reports them apart from `input_tokens`."""
+    _details = usage.get("input_token_details") or {}
+    PROMPT_CACHE_TOKENS.labels(tier, "read").inc(_details.get("cache_read", 0))
+    PROMPT_CACHE_TOKENS.labels(tier, "write").inc(_details.get("cache_creation", 0))
+    PROMPT_CACHE_TOKENS.labels(tier, "uncached").inc(usage.get("input_tokens", 0))
+
+
+class TimingHeaderMiddleware():
+    """
+    ASGI middleware adding a Server-Timing header with the stage timings of the request, either for
+    every request or for the requests carrying the `X-Request-Timing` header.
+    Streaming responses send their headers before the stages complete and only report the stages
+    finished by then.
+    """
+    def __init__(self, app, always: bool = False):
+        self.app = app
+        self.always = always
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (self.always or (b"x-request-timing", b"1") in scope["headers"]):
+            return await self.app(scope, receive, send)
+        _timings: Dict[str, float] = {}
+        _token = _REQUEST_TIMINGS.set(_timings)
+        _start = time.perf_counter()
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                _timings["total"] = time.perf_counter() - _start
+                _value = ", ".join(f"{k};dur={v * 1000:.1f}" for k, v in _timings.items())
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", _value.encode())]
+            await send(message)
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _REQUEST_TIMINGS.reset(_token)
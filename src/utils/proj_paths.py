@@ -8,4 +8,11 @@ BACKEND_CONFIG = CONFIG/'backend.yaml'
 
 # ------- Prompts -------
 PROMPT = SRC/'prompt'
-CONVERSE_SYS_PROMPT = PROMPT/'converse_sys_prompt.txt'
\ No newline at end of file
+CONVERSE_SYS_PROMPT = PROMPT/'converse_sys_prompt.txt'
+RAG_SYS_PROMPT = PROMPT/'rag_sys_prompt.txt'
+
+# ------- RAG Documents -------
+DATA = ROOT/'data'
+RAG_DOCS = DATA/'documents'
+RAG_INDEX = DATA/'rag_index'
+ARCHIVE_SPILL = DATA/'archive_spill'
\ No newline at end of file
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the shared Redis connection pools of the application
+"""
+import redis
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+
+
+class RedisPool():
+    """
+    One blocking and one asyncio connection pool to the Redis server, sized from the 'redis' section
+    of backend.yaml. Every client handed out by the pool shares its connections, so a chat turn never
+    opens a new TCP connection. Idle connections are health checked before reuse, and dropped
+    connections are re-established with exponential backoff.
+
+    Attributes:
+        client (redis.Redis): Blocking client backed by the shared pool
+        async_client (redis.asyncio.Redis): Asyncio client backed by the shared pool
+    """
+    def __init__(self, redis_config: dict):
+        _retries = redis_config.get('retry_attempts', 3)
+        _conn_kwargs = dict(
+            host=redis_config['host'],
+            port=redis_config['port'],
+            db=redis_config['db'],
+            # wait for a free connection instead of failing once the pool is exhausted
+            max_connections=redis_config.get('max_connections', 64),
+            timeout=redis_config.get('pool_timeout', 5),
+            socket_timeout=redis_config.get('socket_timeout', 5),
+            socket_connect_timeout=redis_config.get('socket_connect_timeout', 1),
+            socket_keepalive=True,
+            health_check_interval=redis_config.get('health_check_interval', 30),
+            retry_on_error=[ConnectionError, TimeoutError],
+        )
+        self.pool = redis.BlockingConnectionPool(
+            **_conn_kwargs, retry=Retry(ExponentialBackoff(cap=1, base=0.05), _retries)
+        )
+        self.async_pool = aioredis.BlockingConnectionPool(
+            **_conn_kwargs, retry=AsyncRetry(ExponentialBackoff(cap=1, base=0.05), _retries)
+        )
+        self.client = redis.Redis(connection_pool=self.pool)
+        self.async_client = aioredis.Redis(connection_pool=self.async_pool)
+
+    def ping(self) -> bool:
+        return self.client.ping()
+
+    async def aping(self) -> bool:
+        return await self.async_client.ping()
+
+    async def aclose(self):
+        """Disconnects every connection of both pools."""
+        await self.async_pool.disconnect()
+        self.pool.disconnect()
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the profiler of the start-up phases of a server worker
+"""
+import cProfile
+from contextlib import contextmanager
+import io
+import logging
+import os
+import pstats
+import time
+from typing import Dict, Optional
+
+# set to 1 to profile the start-up of the workers, e.g. through `python main.py --profile-startup`
+PROFILE_STARTUP_VAR = "RENKEBOT_PROFILE_STARTUP"
+
+
+def process_uptime() -> Optional[float]:
+    """Seconds since the current process started, None where /proc is not available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, which may contain spaces
+            _fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            _uptime = float(f.read().split()[0])
+        return _uptime - int(_fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class StartupProfiler():
+    """
+    Records the wall time of the start-up phases of the worker: the imports, the creation of the engine
+    and each warm-up step. Phases may overlap, e.g. the warm-up steps run concurrently.
+    In profiling mode, the synchronous phases also run under cProfile and the report lists their most
+    expensive calls, which includes the modules imported lazily during the phase.
+
+    Attributes:
+        profile (bool): Whether the profiling mode is on
+        phases (dict): Seconds spent in each phase, in order of completion
+        top (int): Number of calls listed per profiled phase
+    """
+    def __init__(self, profile: Optional[bool] = None, top: int = 15):
+        self.profile = os.environ.get(PROFILE_STARTUP_VAR) == "1" if profile is None else profile
+        self.top = top
+        self.phases: Dict[str, float] = {}
+        self._profiles: Dict[str, pstats.Stats] = {}
+
+    def record(self, name: str, seconds: Optional[float]):
+        if seconds is not None:
+            self.phases[name] = seconds
+
+    @contextmanager
+    def phase(self, name: str, profile: bool = True):
+        """
+        Times the block. `profile` must be False for the blocks awaiting concurrently with other
+        phases, a single cProfile can be active at a time.
+        """
+        _profiler = cProfile.Profile() if self.profile and profile else None
+        _start = time.perf_counter()
+        if _profiler is not None:
+            _profiler.enable()
+        try:
+            yield
+        finally:
+            if _profiler is not None:
+                _profiler.disable()
+                self._profiles[name] = pstats.Stats(_profiler)
+            self.phases[name] = time.perf_counter() - _start
+
+    def stats(self) -> dict:
+        return {"profile": self.profile, "phases": {k: round(v, 4) for k, v in self.phases.items()}}
+
+    def report(self, logger: logging.Logger):
+        """Logs the phase timings, and the most expensive calls of each phase in profiling mode."""
+        _lines = [f"{name:<24} {seconds * 1000:>9.1f} ms" for name, seconds in self.phases.items()]
+        logger.info("Start-up phases (wall time, concurrent phases overlap):\n" + "\n".join(_lines))
+        for name, _stats in self._profiles.items():
+            _out = io.StringIO()
+            _stats.stream = _out
+            _stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+            logger.info(f"Start-up profile of {name}:\n{_out.getvalue()}")
+
+
+# shared by main.py and the engine
+STARTUP = StartupProfiler()
@@ -1,10 +1,10 @@
-import boto3
+import copy
+from functools import lru_cache
 import logging
 import os
 from pathlib import Path
-import requests
-from requests.exceptions import ConnectTimeout, RequestException
-from typing import Union, List, Dict
+import threading
+from typing import Optional, Union, List, Dict, Tuple
 import yaml
 
 # General purpose logger
@@ -24,6 +24,7 @@ def verify_aws_connection():
     """
     Verifies the AWS connection by calling the STS GetCallerIdentity API.
     """
+    import boto3 # imported on use, boto3 is slow to import
     try:
         # Create a low-level client for the STS service
         sts_client = boto3.client('sts')
@@ -39,6 +40,7 @@ def list_bedrock_foundation_models():
     """
     Lists all available foundation models in Amazon Bedrock using the default AWS configuration.
     """
+    import boto3
     try:
         # Create a Boto3 client for the Bedrock service
         # Boto3 will automatically use your default credentials and region
@@ -65,13 +67,22 @@ def list_bedrock_foundation_models():
     except Exception as e:
         logger.debug(f"An error occurred: {e}")
 
+# Environment variable overriding the detected environment, e.g. RENKEBOT_ENV=docker
+ENV_OVERRIDE_VAR = "RENKEBOT_ENV"
+
+@lru_cache(maxsize=None)
 def detect_environment() -> str:
     """
-    Detects the current running environment.
+    Detects the current running environment, once per process.
+    The detection can be skipped by setting the RENKEBOT_ENV environment variable.
 
     Returns:
         A string indicating the environment: 'ec2', 'docker', or 'local'.
     """
+    # 0. Explicit override
+    _env = os.environ.get(ENV_OVERRIDE_VAR)
+    if _env:
+        return _env
     # 1. Check for Docker Container Environment
     # The /.dockerenv file is a common indicator of running inside a Docker container.
     if os.path.exists("/.dockerenv"):
@@ -82,6 +93,8 @@ def detect_environment() -> str:
     # NOTE: Modern IMDS requires a token, but a simple connection attempt 
     # to the IP is often enough to detect the environment for this purpose.
     IMDS_ENDPOINT = "http://169.254.169.254/latest/meta-data/"
+    import requests
+    from requests.exceptions import ConnectTimeout, RequestException
     try:
         # A quick attempt to connect to the well-known IMDS IP
         requests.get(IMDS_ENDPOINT, timeout=0.1) 
@@ -96,23 +109,62 @@ def detect_environment() -> str:
     # 3. Default to Local Environment
     return "local"
 
+# parsed config files and resolved service configs, filled on first use and cleared by reload_config
+_CONFIG_CACHE: Dict[Path, dict] = {}
+_SERVICE_CONFIG_CACHE: Dict[Tuple[Path, str, str], dict] = {}
+_CONFIG_LOCK = threading.Lock()
+# bumped by reload_config, a service config resolved across a reload is not cached
+_CONFIG_GENERATION = 0
+
 def parse_config(config_path: Union[str,Path]) -> dict:
     """
-    Load and parse config file from specified path
+    Load and parse config file from specified path, the file is only parsed on first use.
+    Returns a copy, callers are free to modify it.
     """
     # validate path
     if isinstance(config_path, str) and len(config_path) == 0:
         raise ValueError("Must provide valid path to app configs")
     elif isinstance(config_path, Path) and not config_path.exists():
         raise ValueError("Must provide valid path to app configs")
-    # load config file(s)
-    config = yaml.safe_load(open(config_path))
-    return config
+    return copy.deepcopy(_load_config(Path(config_path)))
+
+def _load_config(config_path: Path) -> dict:
+    _key = config_path.resolve()
+    with _CONFIG_LOCK:
+        if _key not in _CONFIG_CACHE:
+            # load config file(s)
+            with open(_key) as f:
+                _CONFIG_CACHE[_key] = yaml.safe_load(f)
+        return _CONFIG_CACHE[_key]
+
+def reload_config(config_path: Optional[Union[str,Path]] = None, redetect_environment: bool = False):
+    """
+    Drops the cached config so that the next read parses the file again.
+
+    Args:
+        config_path (str|Path): Config file to reload, all files are reloaded if not specified.
+        redetect_environment (bool): Also detect the running environment again.
+    """
+    global _CONFIG_GENERATION
+    with _CONFIG_LOCK:
+        _CONFIG_GENERATION += 1
+        if config_path is None:
+            _CONFIG_CACHE.clear()
+            _SERVICE_CONFIG_CACHE.clear()
+        else:
+            _key = Path(config_path).resolve()
+            _CONFIG_CACHE.pop(_key, None)
+            for k in [k for k in _SERVICE_CONFIG_CACHE if k[0] == _key]:
+                _SERVICE_CONFIG_CACHE.pop(k)
+    if redetect_environment:
+        detect_environment.cache_clear()
+    logger.info(f"Config cache cleared for {config_path or 'all config files'}.")
 
 def get_service_config(config_path: Union[str,Path], service_name: str, default_env: str = 'local') -> dict:
     """
     Parses a YAML config file, selects the correct host/IP based on the 
     detected environment, and returns the simplified service configuration.
+    The resolved config is cached per service, each call returns a copy of it.
 
     Args:
         config_filepath (str): Path to the YAML configuration file.
@@ -127,6 +179,17 @@ def get_service_config(config_path: Union[str,Path], service_name: str, default_
         FileNotFoundError: If the config file is not found.
         KeyError: If the service or host key structure is not found in the config.
     """
+    _key = (Path(config_path).resolve(), service_name, default_env)
+    _cached = _SERVICE_CONFIG_CACHE.get(_key)
+    if _cached is None:
+        _generation = _CONFIG_GENERATION
+        _cached = _resolve_service_config(config_path, service_name, default_env)
+        with _CONFIG_LOCK:
+            if _generation == _CONFIG_GENERATION:
+                _SERVICE_CONFIG_CACHE[_key] = _cached
+    return copy.deepcopy(_cached)
+
+def _resolve_service_config(config_path: Union[str,Path], service_name: str, default_env: str) -> dict:
     # 1. Get the specific service config
     full_config = parse_config(config_path)
     service_config:dict = full_config.get(service_name)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the fixtures shared by the tests, run with `python -m pytest tests` from the project root.
+The Redis tests run on an in-process fakeredis, or on a local Redis set by RENKEBOT_TEST_REDIS, and the
+archive tests on the Postgres set by RENKEBOT_TEST_POSTGRES, skipped without it.
+"""
+import logging
+import os
+from urllib.parse import urlsplit
+import pytest
+# project imports
+from benchmarks.fakes import FakeRedisPool
+from src.utils.proj_paths import BACKEND_CONFIG
+from src.utils.redis_pool import RedisPool
+from src.utils.utils import get_service_config
+
+# host:port/db of a Redis whose db is flushed by every test, e.g. "localhost:6379/15"
+REDIS_VAR = "RENKEBOT_TEST_REDIS"
+# DSN of a Postgres database the archive tests create their tables in, e.g. "postgresql://user:pw@localhost:5432/test"
+POSTGRES_VAR = "RENKEBOT_TEST_POSTGRES"
+
+
+@pytest.fixture
+def anyio_backend():
+    # the service runs on asyncio only
+    return "asyncio"
+
+
+@pytest.fixture
+def logger() -> logging.Logger:
+    return logging.getLogger("test_logger")
+
+
+@pytest.fixture
+def redis_pool():
+    """Empty Redis with Lua scripting, the local one of RENKEBOT_TEST_REDIS or an in-process fake."""
+    _target = os.environ.get(REDIS_VAR)
+    if not _target:
+        yield FakeRedisPool()
+        return
+    _address, _, _db = _target.partition("/")
+    _host, _port = _address.rsplit(":", 1)
+    _pool = RedisPool({**get_service_config(BACKEND_CONFIG, 'redis'), 'host': _host, 'port': int(_port), 'db': int(_db or 15)})
+    _pool.client.flushdb()
+    yield _pool
+    _pool.client.flushdb()
+
+
+@pytest.fixture
+def postgres_config() -> dict:
+    """'backend_db' config of the Postgres of RENKEBOT_TEST_POSTGRES."""
+    _dsn = os.environ.get(POSTGRES_VAR)
+    if not _dsn:
+        pytest.skip(f"{POSTGRES_VAR} is not set")
+    _url = urlsplit(_dsn)
+    return {
+        "host": _url.hostname or "localhost",
+        "port": _url.port or 5432,
+        "database": _url.path.lstrip("/"),
+        "user": _url.username,
+        "password": _url.password,
+        "connect_timeout": 7,
+    }
+
+
+def _fast_bench(monkeypatch):
+    """Sets the offline model of the benchmarks to reply at once, on an in-process Redis."""
+    for _var, _value in {"BENCH_TTFT": "0.01", "BENCH_TOKENS_PER_SECOND": "100000", "BENCH_REDIS": "memory"}.items():
+        monkeypatch.setenv(_var, _value)
+
+
+@pytest.fixture
+def converse_engine(monkeypatch, logger):
+    """Chat engine of the backend with the offline model and Redis of the benchmarks, not warmed up."""
+    _fast_bench(monkeypatch)
+    from benchmarks.bench_app import initialize_converse_engine
+    return initialize_converse_engine(logger)
+
+
+@pytest.fixture
+def app_client(monkeypatch):
+    """Client of the backend of main.py with the offline model and Redis of the benchmarks, started up."""
+    from fastapi.testclient import TestClient
+    _fast_bench(monkeypatch)
+    from benchmarks.bench_app import app
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the conversation archiver, the Postgres ones need RENKEBOT_TEST_POSTGRES
+"""
+import asyncio
+from datetime import datetime, timezone
+import json
+import time
+import uuid
+import asyncpg
+import pytest
+# project imports
+from src.archive import COLUMNS, ConversationArchiver
+
+pytestmark = pytest.mark.anyio
+
+# refuses the connections at once, Postgres is down
+UNREACHABLE_DB = {"host": "127.0.0.1", "port": 1, "database": "x", "user": "x", "password": "x", "connect_timeout": 1}
+
+
+def _archive_config(**overrides) -> dict:
+    return {"table": f"test_turns_{uuid.uuid4().hex[:8]}", "batch_size": 50, "flush_interval": 0.05,
+            "queue_size": 100, "backoff_cap": 0.2, "drain_timeout": 1, **overrides}
+
+
+def _spilled(spill_dir) -> list:
+    return [json.loads(_line) for _path in spill_dir.glob("spill-*.jsonl") for _line in _path.read_text().splitlines()]
+
+
+async def _until(condition, timeout: float = 10):
+    _deadline = time.monotonic() + timeout
+    while not await condition():
+        assert time.monotonic() < _deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+async def test_overflow_is_spilled_by_the_background_writer(tmp_path, logger):
+    archiver = ConversationArchiver(_archive_config(queue_size=2, spill_buffer=3), UNREACHABLE_DB, logger, spill_dir=tmp_path)
+    for i in range(6):
+        archiver.submit(f"s{i}", f"query {i}", f"reply {i}")
+    # the chat path only queued, two turns in the queue, three in the overflow, one dropped
+    assert archiver.queue.qsize() == 2 and len(archiver.overflow) == 3
+    assert not list(tmp_path.glob("spill-*"))
+    await archiver.astart()
+    async def _written():
+        return len(_spilled(tmp_path)) == 3
+    await _until(_written)
+    await archiver.aclose()
+    # the queue is spilled on close as Postgres never came up
+    assert sorted(r["session_id"] for r in _spilled(tmp_path)) == ["s0", "s1", "s2", "s3", "s4"]
+
+
+async def test_flush_spill_and_replay(tmp_path, logger, postgres_config):
+    _config = _archive_config()
+    _table = _config["table"]
+    # turns spilled by a worker that is gone
+    _dead = ConversationArchiver(_config, UNREACHABLE_DB, logger, spill_dir=tmp_path)
+    _dead.spill_path = tmp_path / "spill-999999.jsonl"
+    await asyncio.to_thread(_dead._spill, [(f"old{i}", datetime.now(timezone.utc), "q", "r", None, False, "model") for i in range(120)])
+    archiver = ConversationArchiver(_config, postgres_config, logger, spill_dir=tmp_path)
+    _conn = await asyncpg.connect(**{k: v for k, v in postgres_config.items() if k != "connect_timeout"})
+    try:
+        await archiver.astart()
+        for i in range(10):
+            archiver.submit(f"new{i}", f"query {i}", f"reply {i}", "fast", True)
+        async def _archived():
+            try:
+                return await _conn.fetchval(f"SELECT count(*) FROM {_table}") == 130
+            except asyncpg.UndefinedTableError:
+                return False
+        await _until(_archived)
+        # the replayed file is deleted, in batches of batch_size
+        assert not list(tmp_path.glob("spill-*"))
+        _row = await _conn.fetchrow(f"SELECT {', '.join(COLUMNS)} FROM {_table} WHERE session_id = 'new3'")
+        assert (_row["query"], _row["reply"], _row["model_tier"], _row["rag"]) == ("query 3", "reply 3", "fast", True)
+        await archiver.aclose()
+    finally:
+        await _conn.execute(f"DROP TABLE IF EXISTS {_table}")
+        await _conn.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the batch runner: bounded concurrency, retries of the throttled
+items, session order, resumption from the checkpoints and the /batch_chat endpoint
+"""
+import asyncio
+import json
+from typing import Dict, List
+from botocore.exceptions import ClientError
+import pytest
+# project imports
+from src.batch import AdaptiveLimiter, BatchRunner, FileCheckpoint, RedisCheckpoint
+
+pytestmark = pytest.mark.anyio
+
+BATCH_CONFIG = {"concurrency": 3, "min_concurrency": 1, "max_retries": 2, "backoff_base": 0.01, "backoff_cap": 0.05}
+
+
+class StubEngine():
+    """Chat engine answering after `delay`, throttling the first `throttles[query]` calls of a query."""
+    def __init__(self, delay: float = 0.02, throttles: Dict[str, int] = None):
+        self.delay = delay
+        self.throttles = dict(throttles or {})
+        self.calls: List[tuple] = []
+        self.running, self.peak = 0, 0
+
+    async def achat(self, input: str, session_id: str, rag: bool = False) -> str:
+        self.calls.append((input, session_id))
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.throttles.get(input, 0) > 0:
+                self.throttles[input] -= 1
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, "Converse")
+            return f"reply to {input}"
+        finally:
+            self.running -= 1
+
+
+async def _run(runner: BatchRunner, items: List[dict], checkpoint=None) -> List[dict]:
+    return [_result async for _result in runner.arun(items, checkpoint=checkpoint)]
+
+
+async def test_items_in_flight_are_bounded_by_the_concurrency(logger):
+    engine = StubEngine()
+    _results = await _run(BatchRunner(BATCH_CONFIG, engine, logger), [{"query": f"q{i}"} for i in range(10)])
+    assert sorted(r["id"] for r in _results) == sorted(str(i) for i in range(10))
+    assert all(r["status"] == "ok" and r["message"] == f"reply to q{r['id']}" for r in _results)
+    assert engine.peak == 3
+    # items without a session_id start sessions of their own
+    assert len({r["session_id"] for r in _results}) == 10
+
+
+async def test_throttled_item_is_retried_then_succeeds(logger):
+    engine = StubEngine(throttles={"q1": 1})
+    _results = {r["id"]: r for r in await _run(BatchRunner(BATCH_CONFIG, engine, logger), [{"query": f"q{i}"} for i in range(3)])}
+    assert _results["1"]["status"] == "ok" and _results["1"]["attempts"] == 2
+    assert [_results[i]["attempts"] for i in ("0", "2")] == [1, 1]
+    # beyond max_retries the item fails, the others are answered
+    engine = StubEngine(throttles={"q1": 3})
+    _results = {r["id"]: r for r in await _run(BatchRunner(BATCH_CONFIG, engine, logger), [{"query": f"q{i}"} for i in range(3)])}
+    assert _results["1"]["status"] == "error" and _results["1"]["attempts"] == 3
+    assert "ThrottlingException" in _results["1"]["error"] and _results["0"]["status"] == "ok"
+
+
+async def test_throttling_halves_the_limit_once_per_window():
+    limiter = AdaptiveLimiter(8, min_limit=1)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    # a window of successes grows the limit by one
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.limit == 5
+
+
+async def test_items_of_a_session_run_in_input_order(logger):
+    engine = StubEngine(delay=0.01)
+    _items = [{"query": f"q{i}", "session_id": "s1" if i % 2 else None} for i in range(8)]
+    _results = await _run(BatchRunner(BATCH_CONFIG, engine, logger), _items)
+    assert [q for q, s in engine.calls if s == "s1"] == ["q1", "q3", "q5", "q7"]
+    assert [r["id"] for r in _results if r["session_id"] == "s1"] == ["1", "3", "5", "7"]
+
+
+async def test_file_checkpoint_resumes_the_missing_items(logger, tmp_path):
+    _path = tmp_path / "results.jsonl"
+    _items = [{"id": f"i{i}", "query": f"q{i}"} for i in range(4)]
+    await _run(BatchRunner(BATCH_CONFIG, StubEngine(), logger), _items[:2], checkpoint=FileCheckpoint(_path))
+    # an interrupted run leaves a partial line behind
+    with open(_path, "a") as f:
+        f.write('{"id": "i2", "sta')
+    engine = StubEngine()
+    _results = await _run(BatchRunner(BATCH_CONFIG, engine, logger), _items, checkpoint=FileCheckpoint(_path))
+    assert sorted(q for q, _ in engine.calls) == ["q2", "q3"]
+    assert sorted(r["id"] for r in _results if r.get("resumed")) == ["i0", "i1"]
+    assert set(await FileCheckpoint(_path).aload()) == {"i0", "i1", "i2", "i3"}
+    # a restart discards the previous results
+    assert await FileCheckpoint(_path, restart=True).aload() == {}
+
+
+async def test_redis_checkpoint_resumes_the_missing_items(logger, redis_pool):
+    _items = [{"id": f"i{i}", "query": f"q{i}"} for i in range(4)]
+    _checkpoint = RedisCheckpoint(redis_pool.async_client, "b1", ttl=60)
+    await _run(BatchRunner(BATCH_CONFIG, StubEngine(throttles={"q1": 5}), logger), _items[:2], checkpoint=_checkpoint)
+    # only the answered items are kept, the failed one is retried by the next run
+    assert set(await _checkpoint.aload()) == {"i0"} and 0 < redis_pool.client.ttl("batch:b1") <= 60
+    engine = StubEngine()
+    _results = await _run(BatchRunner(BATCH_CONFIG, engine, logger), _items, checkpoint=_checkpoint)
+    assert sorted(q for q, _ in engine.calls) == ["q1", "q2", "q3"]
+    assert [r["id"] for r in _results if r.get("resumed")] == ["i0"]
+    assert set(await _checkpoint.aload()) == {"i0", "i1", "i2", "i3"}
+
+
+def test_batch_chat_streams_one_line_per_item(app_client):
+    _payload = {"items": [{"id": f"i{i}", "query": f"question {i}"} for i in range(5)], "batch_id": "stream"}
+    with app_client.stream("POST", "/batch_chat", json=_payload) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        _results = [json.loads(line) for line in response.iter_lines() if line]
+    assert sorted(r["id"] for r in _results) == [f"i{i}" for i in range(5)]
+    assert all(r["status"] == "ok" and r["message"] and not r["resumed"] for r in _results)
+    # resubmitting the batch answers from its checkpoint
+    _results = [json.loads(line) for line in app_client.post("/batch_chat", json=_payload).text.splitlines()]
+    assert len(_results) == 5 and all(r["resumed"] for r in _results)
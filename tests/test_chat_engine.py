@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the asynchronous chat of the engine with the async Redis history
+"""
+import pytest
+# project imports
+from benchmarks.fakes import FakeBedrockChatModel
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def prompts(monkeypatch) -> list:
+    """Texts of the messages sent to the offline model, for each call."""
+    _prompts = []
+    _input_usage = FakeBedrockChatModel._input_usage
+    def _recorded(self, messages):
+        _prompts.append([m.text() for m in messages])
+        return _input_usage(self, messages)
+    monkeypatch.setattr(FakeBedrockChatModel, "_input_usage", _recorded)
+    return _prompts
+
+
+async def _contents(converse_engine, session_id: str) -> list:
+    return [m.content for m in await converse_engine.get_session_history(session_id).aget_messages()]
+
+
+async def test_turns_are_recorded_and_sent_with_the_next_turn(converse_engine, prompts):
+    _first = await converse_engine.achat("What does Renke work on?", "achat")
+    _second = await converse_engine.achat("Where does he work?", "achat")
+    assert _first and _second
+    # each turn is written once to the history
+    assert await _contents(converse_engine, "achat") == ["What does Renke work on?", _first, "Where does he work?", _second]
+    assert len(prompts) == 2
+    assert prompts[0][-1] == "What does Renke work on?"
+    assert prompts[1][-3:] == ["What does Renke work on?", _first, "Where does he work?"]
+
+
+async def test_streamed_turn_is_recorded_once_complete(converse_engine, prompts):
+    _reply = "".join([_t async for _t in converse_engine.astream_chat("What does Renke work on?", "astream")])
+    assert _reply and await _contents(converse_engine, "astream") == ["What does Renke work on?", _reply]
+    _next = "".join([_t async for _t in converse_engine.astream_chat("Where does he work?", "astream")])
+    assert prompts[-1][-3:] == ["What does Renke work on?", _reply, "Where does he work?"]
+    assert (await _contents(converse_engine, "astream"))[2:] == ["Where does he work?", _next]
+
+
+async def test_stream_closed_before_the_end_is_not_recorded(converse_engine, prompts):
+    _stream = converse_engine.astream_chat("Tell me everything about Renke.", "closed")
+    assert await _stream.__anext__()
+    await _stream.aclose()
+    assert await _contents(converse_engine, "closed") == []
+
+
+async def test_empty_input_is_not_sent(converse_engine, prompts):
+    assert await converse_engine.achat("  ", "empty") is None
+    assert [_t async for _t in converse_engine.astream_chat("", "empty")] == []
+    assert prompts == [] and await _contents(converse_engine, "empty") == []
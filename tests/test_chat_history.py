@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the compact Redis chat message history and of its legacy migration
+"""
+import asyncio
+import json
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+import pytest
+# project imports
+from src.chat_history import CompactRedisChatMessageHistory
+
+pytestmark = pytest.mark.anyio
+
+TURNS = [HumanMessage(content="hi"), AIMessage(content="hello"), HumanMessage(content="how are you?"), AIMessage(content="fine")]
+
+
+def _history(redis_pool, session_id: str = "s1", **kwargs) -> CompactRedisChatMessageHistory:
+    return CompactRedisChatMessageHistory(session_id, redis_pool.client, redis_pool.async_client, **kwargs)
+
+
+def _store_legacy(redis_pool, session_id: str = "s1"):
+    # the legacy layout pushes the JSON messages to the head of the list
+    for _message in TURNS:
+        redis_pool.client.lpush(f"message_store:{session_id}", json.dumps(message_to_dict(_message)))
+
+
+async def test_append_and_read_the_tail(redis_pool):
+    history = _history(redis_pool, tail_messages=2, compress_threshold=8)
+    await history.aadd_messages(TURNS[:2])
+    history.add_messages(TURNS[2:])
+    assert [m.content for m in await history.aget_messages()] == ["how are you?", "fine"]
+    assert history.offset == 2
+    assert [m.content for m in await history.aget_range(0, 2)] == ["hi", "hello"]
+    assert await history.alen() == 4
+
+
+async def test_legacy_session_is_converted_on_its_first_read(redis_pool):
+    _store_legacy(redis_pool)
+    history = _history(redis_pool)
+    assert await history.alen() == 4
+    assert [m.content for m in await history.aget_messages()] == [m.content for m in TURNS]
+    assert not redis_pool.client.exists("message_store:s1")
+    assert redis_pool.client.llen("history:s1") == 4
+    assert [m.content for m in _history(redis_pool).messages] == [m.content for m in TURNS]
+
+
+async def test_concurrent_first_reads_convert_a_session_once(redis_pool):
+    _store_legacy(redis_pool)
+    _reads = await asyncio.gather(*[_history(redis_pool).aget_messages() for _ in range(5)])
+    assert all([m.content for m in _read] == [m.content for m in TURNS] for _read in _reads)
+    assert redis_pool.client.llen("history:s1") == 4
+
+
+def test_blocking_read_converts_a_legacy_session(redis_pool):
+    _store_legacy(redis_pool, "s2")
+    history = _history(redis_pool, "s2", tail_messages=3)
+    assert [m.content for m in history.messages] == [m.content for m in TURNS[1:]]
+    assert history.offset == 1
+    assert redis_pool.client.llen("history:s2") == 4
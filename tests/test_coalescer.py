@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the single-flight coalescing of the identical first turns in flight
+"""
+import asyncio
+from botocore.exceptions import ClientError
+from prometheus_client import REGISTRY
+import pytest
+# project imports
+from benchmarks.fakes import FakeBedrockChatModel
+from src.chat_history import CompactRedisChatMessageHistory
+from src.coalescer import SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+def _factory(model: FakeBedrockChatModel):
+    async def _astream():
+        async for _chunk in model.astream("hi"):
+            if _chunk.content:
+                yield _chunk.content
+    return _astream
+
+
+async def _collect(stream) -> str:
+    return "".join([_t async for _t in stream])
+
+
+async def test_concurrent_callers_share_one_call():
+    model = FakeBedrockChatModel(ttft=0.05, tokens_per_second=1000, reply_tokens=20)
+    flights = SingleFlight()
+    _replies = await asyncio.gather(*[_collect(flights.asubscribe("k", _factory(model))) for _ in range(5)])
+    assert len(set(_replies)) == 1 and _replies[0]
+    assert len(model.cache_points) == 1
+    # a completed call is forgotten, the next caller starts a new one
+    assert len(flights) == 0
+    await _collect(flights.asubscribe("k", _factory(model)))
+    assert len(model.cache_points) == 2
+
+
+async def test_late_subscriber_is_replayed_the_chunks_from_the_start():
+    model = FakeBedrockChatModel(ttft=0.01, tokens_per_second=200, reply_tokens=20)
+    flights = SingleFlight()
+    first = flights.asubscribe("k", _factory(model))
+    _head = [await first.__anext__() for _ in range(3)]
+    _late = await _collect(flights.asubscribe("k", _factory(model)))
+    _reply = "".join(_head) + await _collect(first)
+    assert _late == _reply
+    assert len(model.cache_points) == 1
+
+
+async def test_call_is_cancelled_once_all_subscribers_left():
+    model = FakeBedrockChatModel(ttft=0.01, tokens_per_second=50, reply_tokens=100)
+    flights = SingleFlight()
+    first, second = flights.asubscribe("k", _factory(model)), flights.asubscribe("k", _factory(model))
+    await first.__anext__()
+    await second.__anext__()
+    _flight = flights._flights["k"]
+    # one subscriber leaving keeps the call for the other
+    await first.aclose()
+    await asyncio.sleep(0.05)
+    assert not _flight.task.done() and len(flights) == 1
+    await second.aclose()
+    await asyncio.gather(_flight.task, return_exceptions=True)
+    assert _flight.task.cancelled() or isinstance(_flight.error, asyncio.CancelledError)
+    assert len(flights) == 0
+
+
+async def test_upstream_error_reaches_every_subscriber():
+    model = FakeBedrockChatModel(ttft=0.01, error_rate=1.0)
+    flights = SingleFlight()
+    _results = await asyncio.gather(*[_collect(flights.asubscribe("k", _factory(model))) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(r, ClientError) for r in _results)
+    assert len(model.cache_points) == 0 and len(flights) == 0
+
+
+async def test_identical_first_turns_share_the_model_call(converse_engine, monkeypatch):
+    _lengths = []
+    _alen = CompactRedisChatMessageHistory.alen
+    async def _counted_alen(self):
+        _lengths.append(self.session_id)
+        return await _alen(self)
+    monkeypatch.setattr(CompactRedisChatMessageHistory, "alen", _counted_alen)
+    _coalesced = REGISTRY.get_sample_value("chat_coalesced_calls_total") or 0
+    _replies = await asyncio.gather(*[converse_engine.achat("What does Renke work on?", f"s{i}") for i in range(3)])
+    assert len(set(_replies)) == 1
+    assert REGISTRY.get_sample_value("chat_coalesced_calls_total") - _coalesced == 2
+    # the length of each session is read once per turn, for both the cache and the coalescing
+    assert sorted(_lengths) == ["s0", "s1", "s2"]
+    # the turn is recorded in every session
+    for i in range(3):
+        assert [m.content for m in await converse_engine.get_session_history(f"s{i}").aget_messages()] == ["What does Renke work on?", _replies[0]]
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the config cache: parsed once, copied to the callers and reloaded on demand
+"""
+import pytest
+# project imports
+from src.utils import utils
+from src.utils.utils import ENV_OVERRIDE_VAR, detect_environment, get_service_config, parse_config, reload_config
+
+CONFIG = """
+redis:
+  host:
+    local: "localhost"
+    docker: "redis"
+  port: {port}
+"""
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    monkeypatch.setenv(ENV_OVERRIDE_VAR, "docker")
+    detect_environment.cache_clear()
+    _path = tmp_path / "backend.yaml"
+    _path.write_text(CONFIG.format(port=6379))
+    yield _path
+    reload_config(_path, redetect_environment=True)
+
+
+def test_config_is_parsed_once_and_copied(config_file, monkeypatch):
+    assert get_service_config(config_file, "redis") == {"host": "redis", "port": 6379}
+    _loads = []
+    monkeypatch.setattr(utils.yaml, "safe_load", lambda f: _loads.append(f))
+    # callers modify their own copy
+    get_service_config(config_file, "redis")["port"] = 1
+    parse_config(config_file)["redis"]["port"] = 1
+    assert get_service_config(config_file, "redis")["port"] == 6379 and parse_config(config_file)["redis"]["port"] == 6379
+    assert _loads == []
+
+
+def test_reload_picks_up_the_changed_file(config_file):
+    assert get_service_config(config_file, "redis")["port"] == 6379
+    config_file.write_text(CONFIG.format(port=6380))
+    # the cached config is served until reloaded
+    assert get_service_config(config_file, "redis")["port"] == 6379
+    reload_config(config_file)
+    assert get_service_config(config_file, "redis")["port"] == 6380
+    assert parse_config(config_file)["redis"]["port"] == 6380
+
+
+def test_reload_redetects_the_environment(config_file, monkeypatch):
+    assert get_service_config(config_file, "redis")["host"] == "redis"
+    monkeypatch.setenv(ENV_OVERRIDE_VAR, "local")
+    reload_config(config_file)
+    assert get_service_config(config_file, "redis")["host"] == "redis"
+    reload_config(config_file, redetect_environment=True)
+    assert get_service_config(config_file, "redis")["host"] == "localhost"
+
+
+def test_config_resolved_across_a_reload_is_not_cached(config_file, monkeypatch):
+    _resolve = utils._resolve_service_config
+    def _resolve_then_change(*args):
+        # the file changes and is reloaded while the old content is being resolved
+        _resolved = _resolve(*args)
+        config_file.write_text(CONFIG.format(port=6380))
+        reload_config(config_file)
+        return _resolved
+    monkeypatch.setattr(utils, "_resolve_service_config", _resolve_then_change)
+    assert get_service_config(config_file, "redis")["port"] == 6379
+    monkeypatch.setattr(utils, "_resolve_service_config", _resolve)
+    assert get_service_config(config_file, "redis")["port"] == 6380
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the sampling profiler and of the /debug/profile endpoint
+"""
+import threading
+import time
+from collections import Counter
+import pytest
+# project imports
+import main
+from src.utils.diagnostics import DEBUG_TOKEN_VAR, SamplingProfiler, debug_token
+
+
+def _busy_wait(stop: threading.Event):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+def _parse(collapsed: str) -> Counter:
+    """Collapsed stacks by stack, the count follows the last space of each line."""
+    _stacks = Counter()
+    for _line in collapsed.splitlines():
+        _stack, _count = _line.rsplit(" ", 1)
+        _stacks[_stack] += int(_count)
+    return _stacks
+
+
+def test_profile_is_in_the_collapsed_format():
+    _stop = threading.Event()
+    _worker = threading.Thread(target=_busy_wait, args=(_stop,), name="busy-worker")
+    _worker.start()
+    try:
+        _stacks = _parse(SamplingProfiler(interval=0.005).run(0.2))
+    finally:
+        _stop.set()
+        _worker.join()
+    _busy = [_stack for _stack in _stacks if _stack.startswith("busy-worker;")]
+    assert _busy and sum(_stacks[_stack] for _stack in _busy) >= 10
+    # the thread comes first, then the frames from the outermost to the innermost
+    _frames = _busy[0].split(";")
+    assert _frames[1].startswith("_bootstrap (threading.py:")
+    assert any(_frame.startswith("_busy_wait (test_diagnostics.py:") for _frame in _frames[2:])
+    # the thread of the profiler is not sampled
+    assert not any("run (diagnostics.py:" in _stack for _stack in _stacks)
+
+
+def test_debug_token_prefers_the_environment(monkeypatch):
+    monkeypatch.delenv(DEBUG_TOKEN_VAR, raising=False)
+    assert debug_token({"profile_token": ""}) is None
+    assert debug_token({"profile_token": "from-config"}) == "from-config"
+    monkeypatch.setenv(DEBUG_TOKEN_VAR, "from-env")
+    assert debug_token({"profile_token": "from-config"}) == "from-env"
+
+
+def test_profile_endpoint_is_disabled_without_a_token(app_client, monkeypatch):
+    monkeypatch.delenv(DEBUG_TOKEN_VAR, raising=False)
+    assert app_client.get("/debug/profile", headers={"X-Debug-Token": ""}).status_code == 404
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Debug-Token": "wrong"}, {"X-Debug-Token": "secret-but-longer"}])
+def test_profile_endpoint_requires_the_token(app_client, monkeypatch, headers):
+    monkeypatch.setenv(DEBUG_TOKEN_VAR, "secret")
+    _response = app_client.get("/debug/profile", params={"seconds": 0.1}, headers=headers)
+    assert _response.status_code == 403
+
+
+def test_profile_endpoint_runs_one_profile_at_a_time(app_client, monkeypatch):
+    monkeypatch.setenv(DEBUG_TOKEN_VAR, "secret")
+    _responses = {}
+    def _profile():
+        _responses["first"] = app_client.get("/debug/profile", params={"seconds": 0.5}, headers={"X-Debug-Token": "secret"})
+    _first = threading.Thread(target=_profile)
+    _first.start()
+    _deadline = time.monotonic() + 2
+    while not main.PROFILE_LOCK.locked() and time.monotonic() < _deadline:
+        time.sleep(0.01)
+    _second = app_client.get("/debug/profile", params={"seconds": 0.5}, headers={"X-Debug-Token": "secret"})
+    _first.join()
+    assert _second.status_code == 409 and _second.headers["retry-after"] == "1"
+    _response = _responses["first"]
+    assert _response.status_code == 200
+    assert _response.headers["content-disposition"].endswith('.collapsed"')
+    # the test thread waiting for the response is one of the sampled threads
+    assert any(_stack.startswith("MainThread;") for _stack in _parse(_response.text))
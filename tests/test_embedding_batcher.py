@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the micro-batching of the query embeddings
+"""
+import asyncio
+from typing import List
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from pydantic import Field
+import pytest
+# project imports
+from src.embedding_batcher import BatchingEmbeddings
+
+pytestmark = pytest.mark.anyio
+
+
+class RecordedEmbeddings(DeterministicFakeEmbedding):
+    """Fake embedding model recording the texts of each call, failing every call with `fail`."""
+    size: int = 8
+    fail: bool = False
+    calls: List[List[str]] = Field(default_factory=list)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls.append(list(texts))
+        if self.fail:
+            raise RuntimeError("embedding model unavailable")
+        return super().embed_documents(texts)
+
+
+def _batcher(logger, model, fallback=None, **config) -> BatchingEmbeddings:
+    return BatchingEmbeddings({"max_batch": 96, "max_wait_ms": 20, "lru_size": 100, **config}, model, logger=logger, fallback=fallback)
+
+
+async def test_concurrent_queries_share_one_call(logger):
+    model = RecordedEmbeddings()
+    batcher = _batcher(logger, model)
+    _texts = [f"query {i}" for i in range(10)]
+    _vectors = await asyncio.gather(*[batcher.aembed_query(t) for t in _texts])
+    assert [sorted(c) for c in model.calls] == [sorted(_texts)]
+    assert _vectors == [model.embed_query(t) for t in _texts]
+
+
+async def test_full_batch_is_sent_at_once(logger):
+    model = RecordedEmbeddings()
+    batcher = _batcher(logger, model, max_batch=4, max_wait_ms=10000)
+    _vectors = await asyncio.wait_for(batcher.aembed_documents([f"query {i}" for i in range(8)]), timeout=5)
+    assert len(_vectors) == 8 and [len(c) for c in model.calls] == [4, 4]
+    # the rest of a batch waits for max_wait
+    short_wait = _batcher(logger, model, max_batch=4, max_wait_ms=10)
+    await short_wait.aembed_documents([f"other {i}" for i in range(6)])
+    assert [len(c) for c in model.calls[2:]] == [4, 2]
+
+
+async def test_identical_queries_share_a_slot_then_hit_the_lru(logger):
+    model = RecordedEmbeddings()
+    batcher = _batcher(logger, model, lru_size=2)
+    _vectors = await asyncio.gather(*[batcher.aembed_query("same") for _ in range(5)])
+    assert model.calls == [["same"]] and all(v == _vectors[0] for v in _vectors)
+    assert await batcher.aembed_query("same") == _vectors[0]
+    assert batcher.embed_query("same") == _vectors[0]
+    assert len(model.calls) == 1
+    # the LRU keeps the most recent texts only
+    await batcher.aembed_documents(["a", "b"])
+    await batcher.aembed_query("same")
+    assert model.calls[-1] == ["same"] and batcher.stats()["cached"] == 2
+
+
+async def test_failed_batch_is_sent_to_the_fallback(logger):
+    model, fallback = RecordedEmbeddings(fail=True), RecordedEmbeddings()
+    batcher = _batcher(logger, model, fallback=fallback)
+    _vectors = await asyncio.gather(*[batcher.aembed_query(f"query {i}") for i in range(3)])
+    assert len(model.calls) == 1 and [sorted(c) for c in fallback.calls] == [sorted(f"query {i}" for i in range(3))]
+    assert _vectors == [fallback.embed_query(f"query {i}") for i in range(3)]
+
+
+async def test_failed_batch_fails_every_caller(logger):
+    batcher = _batcher(logger, RecordedEmbeddings(fail=True), fallback=RecordedEmbeddings(fail=True))
+    _results = await asyncio.gather(*[batcher.aembed_query(t) for t in ["a", "a", "b"]], return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in _results)
+    # nothing failed is remembered, the next query calls the model again
+    assert batcher.stats() == {"cached": 0, "pending": 0, "inflight": 0}
+    with pytest.raises(RuntimeError):
+        await _batcher(logger, RecordedEmbeddings(fail=True)).aembed_query("a")
+
+
+async def test_caller_leaving_does_not_fail_the_others(logger):
+    model = RecordedEmbeddings()
+    batcher = _batcher(logger, model, max_wait_ms=50)
+    _leaving = asyncio.create_task(batcher.aembed_query("shared"))
+    _staying = asyncio.create_task(batcher.aembed_query("shared"))
+    await asyncio.sleep(0.01)
+    _leaving.cancel()
+    assert await _staying == model.embed_query("shared")
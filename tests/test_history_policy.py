@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the history policy: the window of the verbatim history and the
+summary of the messages that left it
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import List
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+import pytest
+# project imports
+from src.chat_history import CompactRedisChatMessageHistory
+from src.history_policy import HistoryPolicy
+
+pytestmark = pytest.mark.anyio
+
+# 13 tokens per message, a budget of 60 keeps the 4 newest ones
+MESSAGES = [(HumanMessage if i % 2 == 0 else AIMessage)(content=f"m{i:02d} " + "x" * 32) for i in range(16)]
+
+
+class Summarizer():
+    """Summary model recording the conversation lines it is given, replying after `delay`."""
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.lines: List[str] = []
+
+    async def __call__(self, prompt) -> AIMessage:
+        self.lines.append(prompt.to_messages()[-1].content.split("New conversation lines:")[1])
+        await asyncio.sleep(self.delay)
+        return AIMessage(content=f"summary {len(self.lines)}")
+
+    def summarized(self, i: int) -> List[str]:
+        return [m.content[:3] for m in MESSAGES if m.content[:3] in self.lines[i]]
+
+
+def _policy(redis_pool, logger, summarizer: Summarizer = None, **config) -> HistoryPolicy:
+    _config = {"max_history_tokens": 60, "summary_batch_messages": 4, "window_step": 1, **config}
+    return HistoryPolicy(_config, RunnableLambda(summarizer or Summarizer()), redis_pool.client, redis_pool.async_client, logger)
+
+
+def _config(message_history=None) -> dict:
+    return {"configurable": {"session_id": "s1", "message_history": message_history or SimpleNamespace(offset=0)}}
+
+
+async def _build(policy: HistoryPolicy, messages: List[BaseMessage], message_history=None) -> List[str]:
+    _history = await policy.abuild_history({"history": messages}, _config(message_history))
+    return [m.content if isinstance(m, SystemMessage) else m.content[:3] for m in _history]
+
+
+def test_window_keeps_the_newest_turns_within_the_budget(redis_pool, logger):
+    policy = _policy(redis_pool, logger)
+    assert policy.window_start(MESSAGES[:4]) == 0
+    assert policy.window_start(MESSAGES[:10]) == 6
+    # 3 messages fit 50 tokens, the window starts at the next user message rather than split a turn
+    assert _policy(redis_pool, logger, max_history_tokens=50).window_start(MESSAGES[:10]) == 8
+    assert policy.window_start([MESSAGES[0], AIMessage(content="x" * 400)]) == 2
+
+
+def test_window_moves_by_window_step(redis_pool, logger):
+    policy = _policy(redis_pool, logger, window_step=4)
+    # the budget would start at 6, 8 and 10, the window starts at multiples of 4
+    assert [policy.window_start(MESSAGES[:n]) for n in (10, 12, 14)] == [8, 8, 12]
+    # the step counts from the start of the session, not of the tail held in memory
+    assert policy.window_start(MESSAGES[2:12], offset=2) == 6
+    assert policy.window_start(MESSAGES[6:14], offset=6) == 6
+
+
+async def test_summary_covers_the_messages_that_left_the_window(redis_pool, logger):
+    summarizer = Summarizer()
+    policy = _policy(redis_pool, logger, summarizer)
+    # 2 messages left the window, fewer than a batch
+    assert await _build(policy, MESSAGES[:6]) == ["m02", "m03", "m04", "m05"]
+    assert not policy._pending and summarizer.lines == []
+    # 4 messages left the window: they are summarized in the background
+    assert await _build(policy, MESSAGES[:8]) == ["m04", "m05", "m06", "m07"]
+    await asyncio.gather(*policy._pending.values())
+    assert summarizer.summarized(0) == ["m00", "m01", "m02", "m03"]
+    assert redis_pool.client.hgetall(policy.summary_key("s1")) == {b"summary": b"summary 1", b"covered": b"4"}
+    # the summary replaces them, and is only updated once the next batch left the window
+    _summary = "Summary of the earlier conversation:\nsummary 1"
+    assert await _build(policy, MESSAGES[:8]) == [_summary, "m04", "m05", "m06", "m07"]
+    assert await _build(policy, MESSAGES[:10]) == [_summary, "m06", "m07", "m08", "m09"]
+    assert not policy._pending and len(summarizer.lines) == 1
+    await _build(policy, MESSAGES[:12])
+    await asyncio.gather(*policy._pending.values())
+    # the next batch starts where the summary ended, nothing is dropped or repeated
+    assert summarizer.summarized(1) == ["m04", "m05", "m06", "m07"]
+    assert redis_pool.client.hget(policy.summary_key("s1"), "covered") == b"8"
+
+
+async def test_summary_reads_back_the_messages_older_than_the_tail(redis_pool, logger):
+    summarizer = Summarizer()
+    policy = _policy(redis_pool, logger, summarizer)
+    history = CompactRedisChatMessageHistory("s1", redis_pool.client, redis_pool.async_client, tail_messages=6, legacy_prefix=None)
+    await history.aadd_messages(MESSAGES[:12])
+    _tail = await history.aget_messages()
+    assert history.offset == 6
+    assert await _build(policy, _tail, message_history=history) == ["m08", "m09", "m10", "m11"]
+    await asyncio.gather(*policy._pending.values())
+    assert summarizer.summarized(0) == [f"m{i:02d}" for i in range(8)]
+    assert redis_pool.client.hget(policy.summary_key("s1"), "covered") == b"8"
+
+
+async def test_summarization_never_blocks_the_reply(redis_pool, logger):
+    summarizer = Summarizer(delay=0.5)
+    policy = _policy(redis_pool, logger, summarizer)
+    _start = time.perf_counter()
+    # concurrent turns of the session share one summarization
+    await asyncio.gather(*[_build(policy, MESSAGES[:8]) for _ in range(3)])
+    assert time.perf_counter() - _start < 0.25
+    assert len(policy._pending) == 1
+    await asyncio.gather(*policy._pending.values())
+    assert len(summarizer.lines) == 1 and not policy._pending
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the readiness and the graceful drain of a server worker
+"""
+import asyncio
+import os
+import signal
+import pytest
+# project imports
+import main
+from src.utils.lifecycle import ServiceLifecycle, resolve_workers
+
+pytestmark = pytest.mark.anyio
+
+
+def test_ready_flips_to_503_on_drain(app_client):
+    assert app_client.get("/ready").json()["status"] == "ready"
+    main.LIFECYCLE.draining = True
+    try:
+        _response = app_client.get("/ready")
+        assert _response.status_code == 503
+        assert _response.json()["status"] == "draining"
+        # liveness is not affected
+        assert app_client.get("/health").status_code == 200
+    finally:
+        main.LIFECYCLE.draining = False
+
+
+async def test_signal_is_handed_over_once_drained(logger):
+    lifecycle = ServiceLifecycle(logger)
+    lifecycle.ready = True
+    _handed_over = []
+    _previous = signal.signal(signal.SIGUSR1, lambda signum, frame: _handed_over.append(signum))
+    try:
+        lifecycle.install_drain_handler(timeout=5, sig=signal.SIGUSR1)
+        with lifecycle.track():
+            os.kill(os.getpid(), signal.SIGUSR1)
+            await asyncio.sleep(0.05)
+            assert lifecycle.draining and not lifecycle.is_ready
+            # the server keeps running while a request is in flight
+            assert _handed_over == []
+        await asyncio.sleep(0.05)
+        assert _handed_over == [signal.SIGUSR1]
+    finally:
+        signal.signal(signal.SIGUSR1, _previous)
+
+
+async def test_drain_times_out(logger):
+    lifecycle = ServiceLifecycle(logger)
+    with lifecycle.track():
+        assert not await lifecycle.wait_drained(timeout=0.05)
+    assert await lifecycle.wait_drained(timeout=0.05)
+
+
+def test_resolve_workers():
+    assert resolve_workers(3) == 3
+    assert resolve_workers("2") == 2
+    assert resolve_workers("auto") >= 1
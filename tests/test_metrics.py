@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the metrics: the Server-Timing header and the aggregation of the workers
+"""
+import os
+from pathlib import Path
+import subprocess
+import sys
+from prometheus_client.parser import text_string_to_metric_families
+
+# a worker process counting tokens and holding requests in flight, its metrics written to the multi-process directory
+WORKER = """
+import sys
+from src.utils.metrics import INFLIGHT_REQUESTS, TOKENS, mark_worker_dead
+TOKENS.labels("input").inc(int(sys.argv[1]))
+INFLIGHT_REQUESTS.labels("chat").inc(int(sys.argv[2]))
+if sys.argv[3] == "dead":
+    mark_worker_dead()
+"""
+RENDER = "import sys; from src.utils.metrics import render_metrics; sys.stdout.write(render_metrics().decode())"
+
+
+def _run(code: str, *args: str, env: dict) -> str:
+    _result = subprocess.run(
+        [sys.executable, "-c", code, *args], cwd=Path(__file__).parents[1], env=env, capture_output=True, text=True, timeout=60
+    )
+    assert _result.returncode == 0, _result.stderr
+    return _result.stdout
+
+
+def _samples(text: str) -> dict:
+    return {
+        (s.name, tuple(sorted(s.labels.items()))): s.value
+        for family in text_string_to_metric_families(text) for s in family.samples
+    }
+
+
+def test_server_timing_header_on_request(app_client):
+    _query = {"query": "What does Renke work on?", "session_id": "timing"}
+    assert "server-timing" not in app_client.post("/simple_chat", json=_query).headers
+    _response = app_client.post("/simple_chat", json=_query, headers={"X-Request-Timing": "1"})
+    assert _response.status_code == 200
+    _timings = dict(_entry.split(";dur=") for _entry in _response.headers["server-timing"].split(", "))
+    assert {"prompt_render", "llm_generation", "history_write", "total"} <= set(_timings)
+    assert all(float(_ms) >= 0 for _ms in _timings.values())
+    assert float(_timings["total"]) >= float(_timings["llm_generation"])
+
+
+def test_metrics_are_aggregated_over_the_workers(tmp_path):
+    _env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    _run(WORKER, "100", "2", "alive", env=_env)
+    _run(WORKER, "20", "3", "alive", env=_env)
+    _run(WORKER, "5", "7", "dead", env=_env)
+    _values = _samples(_run(RENDER, env=_env))
+    # the counters of every worker are summed, including the workers gone since
+    assert _values[("chat_tokens_total", (("direction", "input"),))] == 125
+    # the live gauges only sum the workers still running
+    assert _values[("chat_inflight_requests", (("endpoint", "chat"),))] == 5
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the routing of the chat turns to the model tiers
+"""
+import pytest
+# project imports
+from src.model_router import ModelRouter
+from src.utils.proj_paths import BACKEND_CONFIG
+from src.utils.utils import get_service_config
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("query, tier, rule", [
+    ("Can you explain how the RAG pipeline of Renke works?", "primary", "escalate"),
+    ("Hello there!", "fast", "greeting"),
+    ("What is the email address of Renke?", "fast", "faq"),
+    ("Tell me about Renke", "fast", "short"),
+    ("I would like to know more about the machine learning systems Renke built at his last job", "primary", "default"),
+    # the first matching rule wins, an explanation is escalated even after a greeting
+    ("Hi, why did Renke choose Bedrock?", "primary", "escalate"),
+    # beyond max_words the FAQ rule no longer applies
+    ("What is the " + "very " * 20 + "best way to contact Renke", "primary", "default"),
+])
+def test_each_rule_picks_its_tier(query, tier, rule):
+    router = ModelRouter(get_service_config(BACKEND_CONFIG, 'model_router'))
+    assert router.route(query) == (tier, rule)
+
+
+def test_unknown_tier_falls_back_to_the_default():
+    router = ModelRouter({
+        "default_tier": "fast", "tiers": {"fast": {"model": "content_generation_model"}},
+        "rules": [{"name": "cheap", "tier": "cheapest", "max_words": 3}, {"tier": "primary", "patterns": ["explain"]}],
+    })
+    assert router.route("hi") == ("fast", "cheap")
+    assert router.route("please explain the projects") == ("primary", "primary")
+    assert router.route("tell me about the projects") == ("fast", "default")
+    # a default tier without a model routes to the primary model
+    assert ModelRouter({"default_tier": "cheapest"}).route("hi") == ("primary", "default")
+
+
+def test_tier_overrides_win_over_the_model_config(converse_engine, monkeypatch):
+    _built = []
+    monkeypatch.setattr(converse_engine, "_bedrock_chat_model", lambda **config: _built.append(config))
+    converse_engine._build_tier_llm({"model": "content_generation_model", "max_tokens": 256})
+    converse_engine._build_tier_llm({"model": "content_generation_model", "temperature": 0.1})
+    assert [(c["max_tokens"], c["temperature"]) for c in _built] == [(256, 0.5), (512, 0.1)]
+    assert _built[0]["model_id"] == "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+async def test_turn_is_answered_by_the_model_of_its_tier(converse_engine):
+    _fast, _primary = converse_engine.tier_llms["fast"], converse_engine.llm
+    await converse_engine.achat("Hello there!", "s1")
+    assert (len(_fast.cache_points), len(_primary.cache_points)) == (1, 0)
+    await converse_engine.achat("Can you explain how the RAG pipeline of Renke works?", "s1")
+    assert (len(_fast.cache_points), len(_primary.cache_points)) == (1, 1)
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the placement of the prompt cache points
+"""
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+# project imports
+from benchmarks.fakes import FakeBedrockChatModel
+from src.prompt_cache import PromptCachePoints, is_cache_point
+
+SYSTEM = SystemMessage(content="You are the assistant of Renke. " * 40)
+HISTORY = [HumanMessage(content="What does Renke work on? " * 10), AIMessage(content="Machine learning systems. " * 10)]
+
+
+def _count_tokens(message) -> int:
+    return len(message.text()) // 4
+
+
+def _points(cache_config: dict = None, **settings) -> PromptCachePoints:
+    _config = cache_config or {"enabled": True, "models": {"converse_engine": {"min_tokens": 100, **settings}}}
+    return PromptCachePoints(_config, tier_models={"primary": "converse_engine", "fast": "fast_model"}, count_tokens=_count_tokens)
+
+
+def _marked(prompt: ChatPromptValue) -> list:
+    return [i for i, m in enumerate(prompt.messages) if isinstance(m.content, list) and any(is_cache_point(b) for b in m.content)]
+
+
+def _prompt(*messages) -> ChatPromptValue:
+    return ChatPromptValue(messages=list(messages))
+
+
+def test_cache_points_after_the_system_prompt_and_the_history():
+    prompt = _prompt(SYSTEM, *HISTORY, HumanMessage(content="And what else?"))
+    marked = _points().mark(prompt, {})
+    assert _marked(marked) == [0, 2]
+    # the content is kept before the cache point, the stored messages are untouched
+    assert marked.messages[0].content[0]["text"] == SYSTEM.content
+    assert isinstance(HISTORY[1].content, str)
+
+
+def test_no_cache_point_on_a_short_prefix():
+    prompt = _prompt(SystemMessage(content="Be brief."), HumanMessage(content="hi"))
+    assert _points().mark(prompt, {}) is prompt
+    # the short system prompt alone is not marked, the history makes the prefix long enough
+    prompt = _prompt(SystemMessage(content="Be brief."), *HISTORY, HumanMessage(content="hi"))
+    assert _marked(_points().mark(prompt, {})) == [2]
+
+
+def test_history_point_is_skipped_for_the_prompts_changing_every_turn():
+    prompt = _prompt(SYSTEM, *HISTORY, HumanMessage(content="And what else?"))
+    assert _marked(_points().mark(prompt, {}, history=False)) == [0]
+    assert _marked(_points(history=False).mark(prompt, {})) == [0]
+
+
+def test_no_cache_point_for_the_models_without_prompt_caching():
+    prompt = _prompt(SYSTEM, *HISTORY, HumanMessage(content="And what else?"))
+    # the fast tier has no settings, the disabled model and the disabled feature send none
+    assert _points().mark(prompt, {"configurable": {"model_tier": "fast"}}) is prompt
+    assert _points(enabled=False).mark(prompt, {}) is prompt
+    assert _points({"enabled": False, "models": {"converse_engine": {"min_tokens": 1}}}).mark(prompt, {}) is prompt
+
+
+def test_next_turn_reads_the_cached_prefix():
+    model = FakeBedrockChatModel(ttft=0, tokens_per_second=100000, reply_tokens=5)
+    points = _points()
+    _first = points.mark(_prompt(SYSTEM, *HISTORY, HumanMessage(content="And what else?")), {})
+    _reply = model.invoke(_first.messages)
+    _usage = _reply.usage_metadata["input_token_details"]
+    assert _usage["cache_read"] == 0 and _usage["cache_creation"] > 0
+    # the next turn repeats the marked prefix, followed by the previous turn
+    _second = points.mark(_prompt(SYSTEM, *HISTORY, HumanMessage(content="And what else?"), _reply, HumanMessage(content="Thanks")), {})
+    _usage = model.invoke(_second.messages).usage_metadata["input_token_details"]
+    assert model.cache_points == [[0, 2], [0, 4]]
+    assert _usage["cache_read"] == sum(_count_tokens(m) for m in [SYSTEM, *HISTORY])
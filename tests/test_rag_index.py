@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the versioned vector index of the RAG documents
+"""
+import numpy as np
+# project imports
+from src.rag_index import MANIFEST, VectorIndex, write_index
+
+MODEL_ID = "cohere.embed-multilingual-v3"
+
+
+def _write(index_dir, version: int, model_id: str = MODEL_ID, rows: int = 4):
+    _vectors = np.random.default_rng(version).normal(size=(rows, 8)).astype(np.float32)
+    _chunks = [{"source": "doc.md", "hash": f"{version}-{i}", "text": f"chunk {i} of version {version}"} for i in range(rows)]
+    write_index(index_dir, version, model_id, {"doc.md": {"hash": str(version), "chunks": rows}}, _chunks, _vectors,
+                search_dims=4, exact_search_rows=1000)
+    return _vectors
+
+
+def _versions(index_dir) -> set:
+    return {int(_path.name.split(".")[1]) for _path in index_dir.glob("*.*.*")}
+
+
+def test_write_keeps_the_replaced_version(tmp_path, logger):
+    for _version in (1, 2, 3):
+        _write(tmp_path, _version)
+    # version 2 may still be mapped by the readers that read its manifest, version 1 is gone
+    assert _versions(tmp_path) == {2, 3}
+    index = VectorIndex(tmp_path, logger, query_model_id=MODEL_ID)
+    assert (index.version, len(index)) == (3, 4)
+
+
+def test_search_returns_the_closest_chunks(tmp_path, logger):
+    _vectors = _write(tmp_path, 1)
+    index = VectorIndex(tmp_path, logger)
+    _query = _vectors[2] / np.linalg.norm(_vectors[2])
+    _results = index.search(_query, k=2)
+    assert len(_results) == 2
+    assert _results[0][1]["hash"] == "1-2" and abs(_results[0][0] - 1) < 1e-5
+
+
+def test_broken_index_is_not_loaded(tmp_path, logger):
+    _write(tmp_path, 1)
+    (tmp_path/"vectors.1.npy").unlink()
+    # the start-up goes on without documents
+    index = VectorIndex(tmp_path, logger)
+    assert (index.version, len(index), index.search(np.ones(8, dtype=np.float32), k=2)) == (0, 0, [])
+    # the next version is picked up by the reload
+    _write(tmp_path, 2)
+    index.reload_interval = 0
+    index.maybe_reload()
+    assert (index.version, len(index)) == (2, 4)
+
+
+def test_index_of_another_embedding_model_is_not_loaded(tmp_path, logger, caplog):
+    _write(tmp_path, 1, model_id="amazon.titan-embed-text-v2:0")
+    index = VectorIndex(tmp_path, logger, reload_interval=0, query_model_id=MODEL_ID)
+    assert (index.version, len(index)) == (0, 0)
+    assert "embedded by amazon.titan-embed-text-v2:0" in caplog.text
+    # not retried until the manifest changes
+    caplog.clear()
+    index.maybe_reload()
+    assert not caplog.text
+    _write(tmp_path, 2)
+    index.maybe_reload()
+    assert (index.version, index.model_id) == (2, MODEL_ID)
+
+
+def test_manifest_names_the_model_and_files(tmp_path, logger):
+    _write(tmp_path, 1)
+    index = VectorIndex(tmp_path, logger)
+    assert index.model_id == MODEL_ID
+    assert (tmp_path/MANIFEST).exists() and not (tmp_path/f"{MANIFEST}.tmp").exists()
+
+
+def test_index_and_queries_are_embedded_by_the_same_endpoint(converse_engine):
+    from src.bedrock_models import bedrock_embeddings
+    _entry = {"provider": "Cohere", "modelId": MODEL_ID, "region_name": "eu-west-1"}
+    converse_engine._embedding_model_config = {"regional": _entry, "default": {"provider": "Cohere", "modelId": MODEL_ID}}
+    _engine_region = converse_engine._engine_config['region_name']
+    # the ingestion is given the region of converse_engine as default, like the engine
+    _documents = bedrock_embeddings(_entry, _engine_region)
+    _queries = converse_engine._query_embeddings("regional")
+    assert _documents.region_name == _queries.region_name == "eu-west-1"
+    assert _documents.model_kwargs is None and _queries.model_kwargs == {"input_type": "search_query"}
+    assert converse_engine._query_embeddings("default").region_name == _engine_region
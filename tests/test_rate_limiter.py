@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the rate limiter: the acquire and reconcile scripts, the delays and
+rejections, the client weights, the pacing of the batches and the limits of the WebSocket messages
+"""
+import asyncio
+import json
+import time
+import pytest
+# project imports
+from src.rate_limiter import RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+def _limiter(redis_pool, logger, **overrides) -> RateLimiter:
+    _config = {
+        "client": {"requests_per_minute": 60, "request_burst": 3, "tokens_per_minute": 60, "token_burst": 1000},
+        "session": {"requests_per_minute": 60, "request_burst": 2, "tokens_per_minute": 60, "token_burst": 1000},
+        "max_delay": 0, "estimated_output_tokens": 100, **overrides,
+    }
+    return RateLimiter(_config, async_redis_client=redis_pool.async_client, logger=logger)
+
+
+async def test_requests_within_the_burst_are_admitted_then_rejected(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger)
+    _requests, _ = limiter.buckets("c1", None, 0)
+    _decisions = [await limiter.aacquire(_requests) for _ in range(4)]
+    assert [d.admitted for d in _decisions] == [True, True, True, False]
+    assert [d.remaining[0] for d in _decisions[:3]] == [2, 1, 0]
+    assert _decisions[0].wait == 0
+    # one request per second refills the bucket, the rejected request is told when to come back
+    assert 0 < _decisions[3].wait <= 1
+
+
+async def test_request_takes_from_all_of_its_buckets_or_from_none(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger)
+    _requests, _ = limiter.buckets("c1", "s1", 0)
+    assert [b.key for b in _requests] == ["ratelimit:client:c1:requests", "ratelimit:session:s1:requests"]
+    assert [(await limiter.aacquire(_requests)).admitted for _ in range(3)] == [True, True, False]
+    # the session bucket rejected the third request, which took nothing from the client bucket
+    _other, _ = limiter.buckets("c1", "s2", 0)
+    _decision = await limiter.aacquire(_other)
+    assert _decision.admitted and _decision.remaining == [0, 1]
+
+
+async def test_request_over_its_share_is_delayed_up_to_max_delay(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger, max_delay=2)
+    _requests, _ = limiter.buckets("c1", None, 0)
+    _decisions = [await limiter.aacquire(_requests) for _ in range(6)]
+    assert [d.admitted for d in _decisions] == [True, True, True, True, True, False]
+    # the debt of each request waits for its refill, one more second per request
+    assert [round(d.wait) for d in _decisions[:5]] == [0, 0, 0, 1, 2]
+    assert 0 < _decisions[5].wait <= 1
+
+
+async def test_weight_multiplies_the_limits_of_a_client(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger, weights={"vip": 2})
+    _requests, _tokens = limiter.buckets("vip", None, 10)
+    assert (_requests[0].burst, _requests[0].limit, _tokens[0].burst) == (6, 120, 2000)
+    assert sum([(await limiter.aacquire(_requests)).admitted for _ in range(7)]) == 6
+
+
+async def test_reconcile_charges_and_refunds_the_estimate(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger)
+    _, _tokens = limiter.buckets("c1", None, limiter.estimate_tokens(["x" * 400]))
+    assert _tokens[0].cost == 200
+    assert (await limiter.aacquire(_tokens)).remaining == [800]
+    # the reply used 700 tokens, 500 more than estimated
+    await limiter.areconcile(_tokens, 700)
+    assert (await limiter.aacquire(_tokens)).remaining == [100]
+    # the reply used 50 tokens, 150 are refunded
+    await limiter.areconcile(_tokens, 50)
+    assert (await limiter.aacquire(_tokens)).remaining == [50]
+
+
+async def test_query_beyond_the_token_burst_takes_the_whole_burst(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger)
+    _requests, _tokens = limiter.buckets("c1", None, 5000)
+    assert _tokens[0].cost == 1000
+    assert (await limiter.aacquire(_requests + _tokens)).admitted
+
+
+async def test_paced_queries_wait_for_their_turn(redis_pool, logger):
+    limiter = _limiter(redis_pool, logger, client={"requests_per_minute": 600, "request_burst": 3, "tokens_per_minute": 60, "token_burst": 1000})
+    _start = time.monotonic()
+    _entered = []
+    async def _query(i):
+        async with limiter.paced("c1", None, "hi"):
+            _entered.append(time.monotonic() - _start)
+    await asyncio.gather(*[_query(i) for i in range(6)])
+    # the burst goes at once, the rest at 10 per second instead of being rejected
+    assert len(_entered) == 6 and sorted(_entered)[2] < 0.1 and 0.25 < max(_entered) < 1
+    # no tokens were used, the estimates were refunded
+    _, _tokens = limiter.buckets("c1", None, 0)
+    assert (await limiter.aacquire(_tokens)).remaining == [1000]
+
+
+def test_batch_beyond_the_request_burst_is_paced(app_client):
+    # the client allows a burst of 20 requests, refilled by one per second
+    _response = app_client.post("/batch_chat", json={"items": [{"id": str(i), "query": "hi"} for i in range(22)]})
+    assert _response.status_code == 200
+    _results = [json.loads(line) for line in _response.text.splitlines()]
+    assert sorted(r["id"] for r in _results) == sorted(str(i) for i in range(22))
+    assert all(r["status"] == "ok" for r in _results)
+
+
+def test_websocket_messages_are_rate_limited(app_client):
+    # the session allows a burst of 5 queries, the sixth would wait for 3 seconds, beyond max_delay
+    _events = []
+    with app_client.websocket_connect("/ws/chat") as ws:
+        for _ in range(6):
+            ws.send_json({"query": "hi", "session_id": "ws-limited"})
+            while True:
+                _event = ws.receive_json()
+                if _event["event"] in ("end", "error"):
+                    _events.append(_event)
+                    break
+    assert [e["event"] for e in _events] == ["end"] * 5 + ["error"]
+    assert "Rate limit exceeded" in _events[-1]["content"]
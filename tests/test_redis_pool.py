@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the Redis connection pools: the connections reused by every client and
+closed at the shutdown of the app
+"""
+import asyncio
+import threading
+import fakeredis
+from fastapi.testclient import TestClient
+import pytest
+# project imports
+import main
+from src.utils.proj_paths import BACKEND_CONFIG
+from src.utils.redis_pool import RedisPool
+from src.utils.utils import get_service_config
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def redis_address():
+    """host:port of a fakeredis served over TCP, for the connections of a real RedisPool."""
+    _server = fakeredis.TcpFakeServer(("127.0.0.1", 0))
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    yield _server.server_address
+    _server.shutdown()
+    _server.server_close()
+
+
+def _pool(redis_address, **config) -> RedisPool:
+    _host, _port = redis_address
+    return RedisPool({**get_service_config(BACKEND_CONFIG, 'redis'), 'host': _host, 'port': _port, 'db': 0, **config})
+
+
+def _async_connections(pool: RedisPool) -> list:
+    return [*pool.async_pool._available_connections, *pool.async_pool._in_use_connections]
+
+
+async def test_clients_reuse_the_connections_of_the_pool(redis_address):
+    pool = _pool(redis_address, max_connections=4)
+    for i in range(50):
+        pool.client.set(f"k{i}", i)
+        await pool.async_client.get(f"k{i}")
+    assert len(pool.pool._connections) == 1 and len(_async_connections(pool)) == 1
+    # concurrent commands wait for a free connection beyond max_connections, rather than failing
+    assert all(await asyncio.gather(*[pool.aping() for _ in range(40)]))
+    assert len(_async_connections(pool)) == 4
+    await pool.aclose()
+    assert not any(c.is_connected for c in _async_connections(pool))
+    assert all(c._sock is None for c in pool.pool._connections)
+
+
+def test_app_shares_one_pool_and_closes_it_on_shutdown(redis_address, monkeypatch):
+    for _var, _value in {"BENCH_TTFT": "0.01", "BENCH_TOKENS_PER_SECOND": "100000", "BENCH_REDIS": "{}:{}".format(*redis_address)}.items():
+        monkeypatch.setenv(_var, _value)
+    from benchmarks.bench_app import app
+    with TestClient(app) as client:
+        for i in range(5):
+            assert client.post("/simple_chat", json={"query": f"Question {i} about Renke", "session_id": "pool"}).status_code == 200
+        pool: RedisPool = main.CONVERSE_ENGINE._redis_pool
+        # the engine, the scheduler and the rate limiter use the clients of one pool
+        assert main.SCHEDULER.async_redis_client is pool.async_client
+        assert app.state.rate_limiter._acquire.registered_client is pool.async_client
+        assert main.CONVERSE_ENGINE.async_redis_client is pool.async_client
+        _connections = _async_connections(pool)
+        assert 0 < len(_connections) <= pool.async_pool.max_connections
+        assert any(c.is_connected for c in _connections)
+    # the lifespan disconnected both pools
+    assert not any(c.is_connected for c in _async_connections(pool))
+    assert all(c._sock is None for c in pool.pool._connections)
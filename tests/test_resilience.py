@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the resilient invocation layer of the chat model
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, List, Optional
+from botocore.exceptions import ClientError
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from prometheus_client import REGISTRY
+import pytest
+# project imports
+from src.resilience import CircuitBreaker, ResilientChatModel
+from src.utils.exceptions import TooManyRequestsError, UpstreamUnavailableError
+
+pytestmark = pytest.mark.anyio
+
+
+class StubEndpoint(BaseChatModel):
+    """Endpoint replying "Hello world" after `delay` seconds, or failing with the Bedrock `error_code`."""
+    delay: float = 0.0
+    error_code: Optional[str] = None
+    started: int = 0
+    cancelled: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="Hello world"))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        self.started += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error_code:
+            raise ClientError({"Error": {"Code": self.error_code, "Message": "stub"}}, "ConverseStream")
+        for _token in ["Hello", " world"]:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=_token))
+
+
+def _model(name: str, *endpoints: StubEndpoint, **overrides) -> ResilientChatModel:
+    _settings = {"max_attempts": 2, "backoff_base": 0, "backoff_cap": 0, "hedge_initial_deadline": 1.0,
+                 "failure_threshold": 2, "reset_timeout": 30, **overrides}
+    return ResilientChatModel(endpoints=list(endpoints), endpoint_names=[f"{name}-{i}" for i in range(len(endpoints))], **_settings)
+
+
+def test_breaker_opens_then_lets_one_probe_through():
+    breaker = CircuitBreaker("test-breaker", failure_threshold=2, reset_timeout=0.05)
+    breaker.on_failure()
+    assert breaker.state == "closed" and breaker.available()
+    breaker.on_failure()
+    assert breaker.state == "open" and not breaker.available()
+    time.sleep(0.06)
+    # a single probe once the reset timeout passed
+    assert breaker.available()
+    breaker.on_start()
+    assert breaker.state == "half_open" and not breaker.available()
+    # a failed probe opens the circuit again
+    breaker.on_failure()
+    assert breaker.state == "open" and not breaker.available()
+    time.sleep(0.06)
+    breaker.on_start()
+    breaker.on_success()
+    assert breaker.state == "closed" and breaker.available()
+
+
+def test_abandoned_probe_lets_another_one_through():
+    breaker = CircuitBreaker("test-abandoned", failure_threshold=1, reset_timeout=0)
+    breaker.on_failure()
+    breaker.on_start()
+    assert not breaker.available()
+    breaker.on_abandoned()
+    assert breaker.state == "half_open" and breaker.available()
+
+
+async def test_slow_call_is_hedged_and_the_loser_cancelled():
+    slow, fast = StubEndpoint(delay=5), StubEndpoint()
+    model = _model("hedge", slow, fast, hedge_initial_deadline=0.05)
+    _start = time.monotonic()
+    reply = await model.ainvoke("hi")
+    assert reply.content == "Hello world"
+    assert time.monotonic() - _start < 1
+    assert (slow.started, slow.cancelled, fast.started) == (1, 1, 1)
+    assert REGISTRY.get_sample_value("chat_upstream_hedges_total", {"endpoint": "hedge-1"}) == 1
+    assert REGISTRY.get_sample_value("chat_upstream_attempts_total", {"endpoint": "hedge-0", "outcome": "cancelled"}) == 1
+    # the loser's elapsed time is a sample of its endpoint, the deadline is not computed on the winners only
+    assert len(model._ttfts[0]) == 1 and model._ttfts[0][0] >= 0.05
+    assert len(model._ttfts[1]) == 1
+    assert model._breakers[0].state == "closed"
+
+
+async def test_fast_call_is_not_hedged():
+    primary, secondary = StubEndpoint(), StubEndpoint()
+    model = _model("nohedge", primary, secondary)
+    assert (await model.ainvoke("hi")).content == "Hello world"
+    assert (primary.started, secondary.started) == (1, 0)
+
+
+async def test_failed_call_fails_over_to_the_next_endpoint():
+    broken, healthy = StubEndpoint(error_code="InternalServerException"), StubEndpoint()
+    model = _model("failover", broken, healthy)
+    assert (await model.ainvoke("hi")).content == "Hello world"
+    assert (broken.started, healthy.started) == (1, 1)
+
+
+async def test_throttled_endpoints_raise_429():
+    model = _model("throttled", StubEndpoint(error_code="ThrottlingException"), StubEndpoint(error_code="ThrottlingException"))
+    with pytest.raises(TooManyRequestsError) as e:
+        await model.ainvoke("hi")
+    assert e.value.status_code == 429
+
+
+async def test_failing_endpoints_raise_503_and_open_their_circuits():
+    endpoints = [StubEndpoint(error_code="InternalServerException"), StubEndpoint(error_code="ModelTimeoutException")]
+    model = _model("failing", *endpoints)
+    with pytest.raises(UpstreamUnavailableError) as e:
+        await model.ainvoke("hi")
+    assert e.value.status_code == 503
+    assert [b.state for b in model._breakers] == ["open", "open"]
+    # the open circuits are not called until their reset timeout
+    _started = [_e.started for _e in endpoints]
+    with pytest.raises(UpstreamUnavailableError) as e:
+        await model.ainvoke("hi")
+    assert [_e.started for _e in endpoints] == _started
+    assert 1 <= e.value.retry_after <= 30
+
+
+async def test_non_retryable_error_is_raised_as_is():
+    invalid, healthy = StubEndpoint(error_code="ValidationException"), StubEndpoint()
+    model = _model("invalid", invalid, healthy)
+    with pytest.raises(ClientError):
+        await model.ainvoke("hi")
+    assert healthy.started == 0
+    assert model._breakers[0].state == "closed"
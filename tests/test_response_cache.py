@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the response cache: the in-process, Redis and semantic tiers,
+expiry and eviction, and the history of the turns answered from the cache
+"""
+import asyncio
+from typing import List
+from langchain_core.embeddings import Embeddings
+import pytest
+# project imports
+from src.response_cache import ResponseCache
+
+pytestmark = pytest.mark.anyio
+
+
+class TableEmbeddings(Embeddings):
+    """Embeds the normalized queries of a table, any other query is orthogonal to them."""
+    TABLE = {
+        "what does renke work on": [1.0, 0.0, 0.0],
+        "what is renke working on": [0.95, 0.3, 0.0],
+        "what does renke eat": [0.7, 0.7, 0.0],
+    }
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.TABLE.get(t, [0.0, 0.0, 1.0]) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _cache(redis_pool, logger, embeddings=None, **config) -> ResponseCache:
+    _config = {"ttl": 60, "max_entries": 8, "semantic": {"threshold": 0.92}, **config}
+    return ResponseCache(_config, "fp", async_redis_client=redis_pool.async_client, logger=logger, embeddings=embeddings)
+
+
+async def test_repeated_query_is_answered_from_the_process(redis_pool, logger):
+    cache = _cache(redis_pool, logger)
+    assert await cache.aget("What does Renke work on?") is None
+    await cache.aset("What does Renke work on?", "Machine learning systems.")
+    # the query is normalized: case, whitespace and trailing punctuation
+    assert await cache.aget("what does  renke work on") == "Machine learning systems."
+    assert cache.stats()["hits_l1"] == 1 and cache.stats()["misses"] == 1
+
+
+async def test_query_cached_by_another_worker_is_read_from_redis_then_from_the_process(redis_pool, logger):
+    await _cache(redis_pool, logger).aset("What does Renke work on?", "Machine learning systems.")
+    cache = _cache(redis_pool, logger)
+    assert await cache.aget("What does Renke work on?") == "Machine learning systems."
+    assert await cache.aget("What does Renke work on?") == "Machine learning systems."
+    assert (cache.stats()["hits_l2"], cache.stats()["hits_l1"], cache.stats()["size"]) == (1, 1, 1)
+    # another system prompt or model config does not share the replies
+    _other = ResponseCache({"ttl": 60, "max_entries": 8}, "other", async_redis_client=redis_pool.async_client, logger=logger)
+    assert await _other.aget("What does Renke work on?") is None
+
+
+async def test_similar_query_is_answered_above_the_threshold_only(redis_pool, logger):
+    cache = _cache(redis_pool, logger, embeddings=TableEmbeddings())
+    await cache.aset("What does Renke work on?", "Machine learning systems.")
+    # cosine similarity of 0.95 and 0.71 to the cached query
+    assert await cache.aget("What is Renke working on?") == "Machine learning systems."
+    assert await cache.aget("What does Renke eat?") is None
+    assert (cache.stats()["hits_semantic"], cache.stats()["misses"]) == (1, 1)
+    # a lower threshold lets it through
+    _loose = _cache(redis_pool, logger, embeddings=TableEmbeddings(), semantic={"threshold": 0.7})
+    await _loose.aset("What does Renke work on?", "Machine learning systems.")
+    assert await _loose.aget("What does Renke eat?") == "Machine learning systems."
+
+
+async def test_replies_expire_in_both_tiers(redis_pool, logger):
+    cache = _cache(redis_pool, logger, embeddings=TableEmbeddings(), ttl=1)
+    await cache.aset("What does Renke work on?", "Machine learning systems.")
+    assert 0 < redis_pool.client.ttl(cache.key("What does Renke work on?")) <= 1
+    await asyncio.sleep(1.1)
+    assert await cache.aget("What does Renke work on?") is None
+    assert await cache.aget("What is Renke working on?") is None
+    assert cache.stats()["size"] == 0
+
+
+async def test_least_recently_used_reply_is_evicted_from_the_process(redis_pool, logger):
+    cache = _cache(redis_pool, logger, embeddings=TableEmbeddings(), max_entries=2)
+    for _query in ("What does Renke work on?", "q2", "q3"):
+        await cache.aset(_query, f"reply to {_query}")
+    assert cache.stats()["size"] == 2 and cache.key("What does Renke work on?") not in cache._vectors
+    # the evicted reply is no longer found by similarity, Redis still has it
+    assert await cache.aget("What is Renke working on?") is None
+    assert await cache.aget("What does Renke work on?") == "reply to What does Renke work on?"
+    assert cache.stats()["hits_l2"] == 1 and cache.key("q2") not in cache._l1
+
+
+async def test_turn_answered_from_the_cache_is_recorded(converse_engine):
+    _reply = await converse_engine.achat("What does Renke work on?", "first")
+    _hits = converse_engine.response_cache.stats()["hits_l1"]
+    assert await converse_engine.achat("What does Renke work on?", "cached") == _reply
+    _streamed = [_t async for _t in converse_engine.astream_chat("what does renke work on", "streamed")]
+    assert _streamed == [_reply]
+    assert converse_engine.response_cache.stats()["hits_l1"] == _hits + 2
+    for _session_id, _query in (("cached", "What does Renke work on?"), ("streamed", "what does renke work on")):
+        _messages = await converse_engine.get_session_history(_session_id).aget_messages()
+        assert [m.content for m in _messages] == [_query, _reply]
+    # the next turn of the session has a history, it is not answered from the cache
+    assert await converse_engine.achat("What does Renke work on?", "cached") is not None
+    assert converse_engine.response_cache.stats()["hits_l1"] == _hits + 2
+    assert len(await converse_engine.get_session_history("cached").aget_messages()) == 4
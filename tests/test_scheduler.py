@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the admission of the chat turns: per-session serialization and backpressure
+"""
+import asyncio
+import pytest
+# project imports
+from src.scheduler import ChatScheduler
+from src.utils.exceptions import TooManyRequestsError
+
+pytestmark = pytest.mark.anyio
+
+
+def _scheduler(redis_pool, logger, workers: int = 1, **overrides) -> ChatScheduler:
+    _config = {"max_concurrency": 4, "max_queue": 4, "queue_timeout": 2, "max_session_queue": 2,
+               "distributed_session_lock": "auto", "session_lock_timeout": 10, **overrides}
+    return ChatScheduler(_config, async_redis_client=redis_pool.async_client, logger=logger, workers=workers)
+
+
+class Timeline():
+    """Records the turns running at once."""
+    def __init__(self):
+        self.running, self.peak, self.order = 0, 0, []
+
+    async def turn(self, scheduler: ChatScheduler, session_id: str, name: str, seconds: float = 0.05):
+        async with scheduler.slot(session_id):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.order.append(name)
+            await asyncio.sleep(seconds)
+            self.running -= 1
+
+
+async def test_turns_of_a_session_run_one_at_a_time(redis_pool, logger):
+    scheduler, timeline = _scheduler(redis_pool, logger), Timeline()
+    await asyncio.gather(*[timeline.turn(scheduler, "s1", f"t{i}") for i in range(3)])
+    assert timeline.peak == 1 and timeline.order == ["t0", "t1", "t2"]
+    assert not scheduler._session_locks
+
+
+async def test_sessions_run_concurrently(redis_pool, logger):
+    scheduler, timeline = _scheduler(redis_pool, logger), Timeline()
+    await asyncio.gather(*[timeline.turn(scheduler, f"s{i}", f"t{i}") for i in range(4)])
+    assert timeline.peak == 4
+
+
+async def test_sessions_are_serialized_across_workers(redis_pool, logger):
+    # two workers sharing Redis, each with its in-process locks
+    workers, timeline = [_scheduler(redis_pool, logger, workers=2), _scheduler(redis_pool, logger, workers=2)], Timeline()
+    await asyncio.gather(*[timeline.turn(workers[i % 2], "s1", f"t{i}") for i in range(4)])
+    assert timeline.peak == 1 and len(timeline.order) == 4
+
+
+@pytest.mark.parametrize("workers, distributed, locked", [(1, "auto", False), (2, "auto", True), (1, True, True), (2, False, False)])
+async def test_session_is_locked_in_redis_with_several_workers(redis_pool, logger, workers, distributed, locked):
+    scheduler = _scheduler(redis_pool, logger, workers=workers, distributed_session_lock=distributed)
+    assert scheduler.distributed_session_lock is locked
+    async with scheduler.slot("s1"):
+        assert redis_pool.client.exists("chat_lock:s1") == int(locked)
+    assert not redis_pool.client.exists("chat_lock:s1")
+
+
+async def test_turns_beyond_the_session_queue_are_rejected(redis_pool, logger):
+    scheduler, timeline = _scheduler(redis_pool, logger, max_session_queue=1), Timeline()
+    _results = await asyncio.gather(*[timeline.turn(scheduler, "s1", f"t{i}", 0.1) for i in range(4)], return_exceptions=True)
+    # the running turn and one waiting behind it are served
+    assert timeline.order == ["t0", "t1"]
+    assert all(isinstance(r, TooManyRequestsError) and r.status_code == 429 for r in _results[2:])
+
+
+async def test_turns_beyond_the_queue_are_rejected_at_once(redis_pool, logger):
+    scheduler, timeline = _scheduler(redis_pool, logger, max_concurrency=1, max_queue=1), Timeline()
+    _running = asyncio.create_task(timeline.turn(scheduler, "s1", "running", 0.2))
+    _waiting = asyncio.create_task(timeline.turn(scheduler, "s2", "waiting", 0.01))
+    await asyncio.sleep(0.05)
+    assert scheduler.queue_depth == 1
+    with pytest.raises(TooManyRequestsError) as e:
+        await asyncio.wait_for(timeline.turn(scheduler, "s3", "rejected"), timeout=0.05)
+    assert e.value.status_code == 429 and e.value.retry_after >= 1
+    await asyncio.gather(_running, _waiting)
+    assert timeline.order == ["running", "waiting"] and timeline.peak == 1
+
+
+async def test_turn_waiting_beyond_the_queue_timeout_is_rejected(redis_pool, logger):
+    scheduler, timeline = _scheduler(redis_pool, logger, max_concurrency=1, queue_timeout=0.1), Timeline()
+    _running = asyncio.create_task(timeline.turn(scheduler, "s1", "running", 0.5))
+    await asyncio.sleep(0.01)
+    with pytest.raises(TooManyRequestsError):
+        await timeline.turn(scheduler, "s2", "late")
+    await _running
+    # the slot and the session of the rejected turn were given back
+    assert scheduler.queue_depth == 0 and not scheduler._session_locks
+    await timeline.turn(scheduler, "s2", "next")
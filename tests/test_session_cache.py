@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the session cache and the session affinity middleware
+"""
+from langchain_core.messages import AIMessage, HumanMessage
+import pytest
+# project imports
+from src.session_cache import INSTANCE_ID_VAR, SessionAffinityMiddleware, SessionCache
+
+pytestmark = pytest.mark.anyio
+
+CHAT_PATHS = ["/simple_chat", "/stream_chat"]
+
+
+async def _call(middleware, path: str, cookie: str = None) -> dict:
+    """Headers of the response of the middleware to a request of `path`."""
+    _headers = [(b"cookie", cookie.encode())] if cookie else []
+    _scope = {"type": "http", "path": path, "headers": _headers}
+    _sent = []
+    async def _app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+    async def _send(message):
+        _sent.append(message)
+    await SessionAffinityMiddleware(_app, **middleware)(_scope, None, _send)
+    return {k.decode(): v.decode() for k, v in _sent[0]["headers"]}
+
+
+async def test_affinity_names_the_instance(monkeypatch):
+    monkeypatch.delenv(INSTANCE_ID_VAR, raising=False)
+    _headers = await _call({"paths": CHAT_PATHS, "instance_id": "10.0.0.5:8000"}, "/simple_chat")
+    assert _headers["x-served-by"] == "10.0.0.5:8000"
+    assert _headers["set-cookie"].startswith("chat_affinity=10.0.0.5:8000;")
+    monkeypatch.setenv(INSTANCE_ID_VAR, "i-0abc")
+    assert (await _call({"paths": CHAT_PATHS, "instance_id": "ignored"}, "/simple_chat"))["x-served-by"] == "i-0abc"
+
+
+async def test_affinity_cookie_only_set_when_it_differs(monkeypatch):
+    monkeypatch.delenv(INSTANCE_ID_VAR, raising=False)
+    _config = {"paths": CHAT_PATHS, "instance_id": "a"}
+    assert "set-cookie" not in await _call(_config, "/simple_chat", cookie="other=1; chat_affinity=a")
+    assert "set-cookie" in await _call(_config, "/simple_chat", cookie="chat_affinity=b")
+    # a cookie whose value merely contains the id is another instance's
+    assert "set-cookie" in await _call(_config, "/simple_chat", cookie="chat_affinity=ab")
+
+
+async def test_affinity_skips_other_paths():
+    for _path in ("/metrics", "/health", "/ready", "/stats/cache"):
+        assert await _call({"paths": CHAT_PATHS, "instance_id": "a"}, _path) == {}
+
+
+def test_cache_serves_current_version_only():
+    cache = SessionCache({"max_bytes": 1 << 20})
+    cache.put("s", 2, 0, [HumanMessage("hi"), AIMessage("hello")], ttl=60)
+    assert cache.get("s", 2)[1][1].content == "hello"
+    # appended on this worker: the entry follows the version
+    cache.append("s", 3, [HumanMessage("again")], tail=None, ttl=60)
+    assert len(cache.get("s", 3)[1]) == 3
+    # written by another worker: stale
+    assert cache.get("s", 5) is None
+    assert cache.get("s", 3) is None
+
+
+def test_cache_keeps_the_tail_and_its_offset():
+    cache = SessionCache({"max_bytes": 1 << 20})
+    cache.put("s", 1, 0, [HumanMessage(f"m{i}") for i in range(4)], ttl=60)
+    cache.append("s", 2, [AIMessage("m4"), HumanMessage("m5")], tail=4, ttl=60)
+    _offset, _messages = cache.get("s", 2)
+    assert _offset == 2 and [m.content for m in _messages] == ["m2", "m3", "m4", "m5"]
+
+
+def test_cache_is_bounded():
+    cache = SessionCache({"max_bytes": 5000})
+    for i in range(20):
+        cache.put(f"s{i}", 1, 0, [HumanMessage("x" * 100)], ttl=60)
+    assert cache.size <= 5000
+    assert cache.get("s19", 1) is not None and cache.get("s0", 1) is None
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the lifecycle of the chat sessions in Redis: caps, sweep and budget eviction
+"""
+import time
+from langchain_core.messages import AIMessage, HumanMessage
+import pytest
+# project imports
+from src.chat_history import CompactRedisChatMessageHistory
+from src.session_lifecycle import SessionLifecycle
+from src.utils.exceptions import SessionLimitError
+
+pytestmark = pytest.mark.anyio
+
+KEY_PATTERNS = [("history:", ""), ("history:", ":v")]
+
+
+def _lifecycle(redis_pool, logger, ttl=None, **config) -> SessionLifecycle:
+    return SessionLifecycle(config, redis_pool.client, redis_pool.async_client, logger, key_patterns=KEY_PATTERNS, ttl=ttl)
+
+
+async def _turn(redis_pool, lifecycle: SessionLifecycle, session_id: str, content: str = "x" * 100):
+    history = CompactRedisChatMessageHistory(
+        session_id, redis_pool.client, redis_pool.async_client, ttl=lifecycle.ttl, legacy_prefix=None, lifecycle=lifecycle
+    )
+    await history.aadd_messages([HumanMessage(content=content), AIMessage(content=content)])
+
+
+def _session_keys(redis_pool, session_id: str) -> int:
+    return redis_pool.client.exists(*[p + session_id + s for p, s in KEY_PATTERNS])
+
+
+async def test_appends_are_accounted_and_capped(redis_pool, logger):
+    lifecycle = _lifecycle(redis_pool, logger, max_messages=4, max_bytes=10000)
+    await _turn(redis_pool, lifecycle, "s1")
+    await lifecycle.acheck("s1")
+    await _turn(redis_pool, lifecycle, "s1")
+    _size = int(redis_pool.client.hget("sessions:bytes", "s1"))
+    assert _size > 400 and int(redis_pool.client.get("sessions:total")) == _size
+    assert int(redis_pool.client.hget("sessions:messages", "s1")) == 4
+    with pytest.raises(SessionLimitError):
+        await lifecycle.acheck("s1")
+
+
+async def test_sweep_drops_the_idle_sessions(redis_pool, logger):
+    lifecycle = _lifecycle(redis_pool, logger, ttl=60)
+    for _sid in ("idle", "active"):
+        await _turn(redis_pool, lifecycle, _sid)
+    # last turn of the idle session beyond the TTL, its keys would have expired
+    redis_pool.client.zadd("sessions:active", {"idle": int(time.time() * 1000) - 61000})
+    assert await lifecycle.asweep() == (1, 0)
+    assert redis_pool.client.zrange("sessions:active", 0, -1) == [b"active"]
+    assert not _session_keys(redis_pool, "idle") and _session_keys(redis_pool, "active") == 2
+    assert int(redis_pool.client.get("sessions:total")) == int(redis_pool.client.hget("sessions:bytes", "active"))
+
+
+async def test_sweep_evicts_the_least_recently_active_sessions_over_the_budget(redis_pool, logger):
+    lifecycle = _lifecycle(redis_pool, logger, max_total_bytes=10 ** 9, evict_to=0.5)
+    _now = int(time.time() * 1000)
+    for i in range(4):
+        await _turn(redis_pool, lifecycle, f"s{i}")
+        redis_pool.client.zadd("sessions:active", {f"s{i}": _now - 1000 * (4 - i)})
+    # within the budget, nothing is evicted
+    assert await lifecycle.asweep() == (0, 0)
+    _total = int(redis_pool.client.get("sessions:total"))
+    # down to half of a budget of 3 sessions, the 3 least recently active go
+    lifecycle.max_total_bytes = _total * 3 // 4
+    assert await lifecycle.asweep() == (0, 3)
+    assert redis_pool.client.zrange("sessions:active", 0, -1) == [b"s3"]
+    assert [_session_keys(redis_pool, f"s{i}") for i in range(4)] == [0, 0, 0, 2]
+    assert int(redis_pool.client.get("sessions:total")) == int(redis_pool.client.hget("sessions:bytes", "s3"))
+
+
+async def test_sweep_evicts_at_most_max_evictions(redis_pool, logger):
+    lifecycle = _lifecycle(redis_pool, logger, max_total_bytes=1, max_evictions=2)
+    for i in range(3):
+        await _turn(redis_pool, lifecycle, f"s{i}")
+    assert await lifecycle.asweep() == (0, 2)
+    assert await lifecycle.asweep() == (0, 1)
+    assert redis_pool.client.zcard("sessions:active") == 0 and int(redis_pool.client.get("sessions:total")) == 0
+
+
+async def test_forget_deletes_the_session(redis_pool, logger):
+    lifecycle = _lifecycle(redis_pool, logger)
+    for _sid in ("s1", "s2"):
+        await _turn(redis_pool, lifecycle, _sid)
+    await lifecycle.aforget("s1")
+    lifecycle.forget("s2")
+    assert not _session_keys(redis_pool, "s1") and not _session_keys(redis_pool, "s2")
+    assert redis_pool.client.zcard("sessions:active") == 0 and int(redis_pool.client.get("sessions:total")) == 0
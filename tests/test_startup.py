@@ -0,0 +1,21 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the start-up of the workers
+"""
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+HEAVY_MODULES = ["langchain_core", "botocore", "numpy"]
+
+
+def test_app_import_does_not_load_the_model_stack():
+    # in a fresh interpreter, the modules of the tests are loaded already
+    _code = f"import json, sys; import main; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    _result = subprocess.run(
+        [sys.executable, "-c", _code], cwd=Path(__file__).parents[1], capture_output=True, text=True, timeout=60
+    )
+    assert _result.returncode == 0, _result.stderr
+    assert json.loads(_result.stdout.strip().splitlines()[-1]) == []
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# Author: Liu Renke
+"""
+This module contains the tests of the streaming chat endpoints (SSE and WebSocket): the stream of
+the tokens, the cancellation on disconnect and the messages received while a reply is streaming
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from typing import List
+from langchain_core.messages import HumanMessage
+import pytest
+# project imports
+import main
+from src.bedrock_models import CancellableChatBedrockConverse
+
+
+def _slow_replies(tokens_per_second: float = 20):
+    """Replies of the offline models of the app take a few seconds."""
+    for _model in [main.CONVERSE_ENGINE.llm, *main.CONVERSE_ENGINE.tier_llms.values()]:
+        _model.tokens_per_second = tokens_per_second
+        _model.reply_tokens = 100
+
+
+def _history(app_client, session_id: str) -> List[str]:
+    async def _messages():
+        return [m.content for m in await main.CONVERSE_ENGINE.get_session_history(session_id).aget_messages()]
+    return app_client.portal.call(_messages)
+
+
+def _sse_events(body: str) -> List[dict]:
+    return [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+
+
+def _ws_events(ws, until=("end", "error", "cancelled")) -> List[dict]:
+    _events = []
+    while not _events or _events[-1]["event"] not in until:
+        _events.append(ws.receive_json())
+    return _events
+
+
+def test_sse_streams_the_tokens_then_records_the_turn(app_client):
+    _response = app_client.post("/stream_chat", json={"query": "What does Renke work on?", "session_id": "sse"})
+    assert _response.status_code == 200 and _response.headers["content-type"].startswith("text/event-stream")
+    _events = _sse_events(_response.text)
+    assert len(_events) > 2 and {e["event"] for e in _events[:-1]} == {"token"} and _events[-1]["event"] == "end"
+    _reply = "".join(e["content"] for e in _events[:-1])
+    assert _history(app_client, "sse") == ["What does Renke work on?", _reply]
+
+
+def test_sse_disconnect_cancels_the_reply(app_client):
+    _slow_replies()
+    async def _disconnect_after_the_first_token() -> List[bytes]:
+        _sent, _first_token = [], asyncio.Event()
+        _body = json.dumps({"query": "Tell me everything about Renke.", "session_id": "sse-gone"}).encode()
+        _requests = [{"type": "http.request", "body": _body, "more_body": False}]
+        async def _receive():
+            if _requests:
+                return _requests.pop()
+            await _first_token.wait()
+            return {"type": "http.disconnect"}
+        async def _send(message):
+            _sent.append(message.get("body", b""))
+            if b"event: token" in message.get("body", b""):
+                _first_token.set()
+        _scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+            "path": "/stream_chat", "raw_path": b"/stream_chat", "query_string": b"", "root_path": "",
+            "headers": [(b"content-type", b"application/json")], "client": ("127.0.0.1", 5000), "server": ("test", 80),
+            "app": main.app,
+        }
+        _start = time.monotonic()
+        await main.app(_scope, _receive, _send)
+        assert time.monotonic() - _start < 2
+        return _sent
+    _sent = app_client.portal.call(_disconnect_after_the_first_token)
+    assert not any(b"event: end" in _body for _body in _sent)
+    # the unfinished turn is not recorded
+    assert _history(app_client, "sse-gone") == []
+
+
+def test_ws_streams_the_tokens_of_each_query(app_client):
+    with app_client.websocket_connect("/ws/chat") as ws:
+        for _query in ("What does Renke work on?", "Where does he work?"):
+            ws.send_json({"query": _query, "session_id": "ws"})
+            _events = _ws_events(ws)
+            assert {e["event"] for e in _events[:-1]} == {"token"} and _events[-1]["event"] == "end"
+    assert _history(app_client, "ws")[::2] == ["What does Renke work on?", "Where does he work?"]
+
+
+def test_ws_disconnect_cancels_the_reply(app_client):
+    _slow_replies()
+    with app_client.websocket_connect("/ws/chat") as ws:
+        ws.send_json({"query": "Tell me everything about Renke.", "session_id": "ws-gone"})
+        assert ws.receive_json()["event"] == "token"
+    time.sleep(0.2)
+    assert _history(app_client, "ws-gone") == []
+
+
+def test_ws_message_received_mid_stream_is_answered_next(app_client):
+    _slow_replies()
+    with app_client.websocket_connect("/ws/chat") as ws:
+        ws.send_json({"query": "Tell me everything about Renke.", "session_id": "ws-next"})
+        assert ws.receive_json()["event"] == "token"
+        ws.send_json({"query": "Just his email, please.", "session_id": "ws-next"})
+        assert _ws_events(ws)[-1]["event"] == "cancelled"
+        # the message that cancelled the reply is answered, not dropped
+        _events = _ws_events(ws)
+        assert _events[0]["event"] == "token" and _events[-1]["event"] == "end"
+        # a message with an empty query only cancels
+        ws.send_json({"query": "Tell me everything about Renke.", "session_id": "ws-next"})
+        assert ws.receive_json()["event"] == "token"
+        ws.send_json({"query": ""})
+        assert _ws_events(ws)[-1]["event"] == "cancelled"
+        _slow_replies(100000)
+        ws.send_json({"query": "Thanks!", "session_id": "ws-next"})
+        _events = _ws_events(ws)
+        assert _events[0]["event"] == "token" and _events[-1]["event"] == "end"
+    assert _history(app_client, "ws-next")[::2] == ["Just his email, please.", "Thanks!"]
+
+
+class FakeEventStream():
+    """Event stream of a ConverseStream call, yielding a text delta every 10 ms until closed."""
+    def __init__(self):
+        self.closed = False
+
+    def __iter__(self):
+        for i in range(100):
+            if self.closed:
+                return
+            time.sleep(0.01)
+            yield {"contentBlockDelta": {"delta": {"text": f"t{i} "}, "contentBlockIndex": 0}}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.anyio
+async def test_closing_the_bedrock_stream_releases_the_event_stream():
+    model = CancellableChatBedrockConverse(model_id="anthropic.claude-3-haiku-20240307-v1:0", region_name="us-east-1")
+    stream = FakeEventStream()
+    # answers the ConverseStream call without sending it
+    model.client.meta.events.register(
+        "before-call.bedrock-runtime.ConverseStream",
+        lambda **kwargs: (SimpleNamespace(status_code=200, headers={}), {"stream": stream, "ResponseMetadata": {}})
+    )
+    chunks = model.astream([HumanMessage(content="hi")])
+    assert [(await chunks.__anext__()).content for _ in range(2)]
+    await chunks.aclose()
+    await asyncio.sleep(0.1)
+    assert stream.closed